@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+"""Benchmark for the parallel and the binned extraction in seqDataHandler.get_values
+
+Writes synthetic bigwig files to a temporary directory and measures the wall time of get_values for an increasing
+number of worker processes, and of the binned extraction compared with the extraction at full resolution. Run with
+    python3 benchmark/benchGetValues.py [--tracks 8] [--chroms 16] [--chrom-size 2000000] [--bin-sizes 1000 10000]
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+# The benchmarks run as scripts from a source checkout, so the package is imported after adding the repository
+# root to the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datahandler import seqDataHandler as seq  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the parallel extraction in get_values')
+    parser.add_argument('--tracks', type=int, default=8)
+    parser.add_argument('--chroms', type=int, default=16)
+    parser.add_argument('--chrom-size', type=int, default=2000000)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--bin-sizes', type=int, nargs='+', default=[1000, 10000])
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rng = np.random.default_rng(0)
+        paths = []
+        chroms = {'chr%d' % (c + 1): args.chrom_size for c in range(args.chroms)}
+        for t in range(args.tracks):
+            paths.append(os.path.join(tmp_dir, 'track%d.bw' % t))
+            synthetic.write_bigwig(paths[-1], chroms, rng, coverage=1.)
+
+        n_workers = [1]
+        while n_workers[-1] * 2 <= (os.cpu_count() or 1):
+            n_workers.append(n_workers[-1] * 2)
+
+        reference, _ = seq.get_values(paths)
+        print('tracks=%d genome_size=%d' % (args.tracks, args.chroms * args.chrom_size))
+        print('%8s %10s %8s' % ('workers', 'time [s]', 'speedup'))
+        base_time = None
+        for workers in n_workers:
+            times = []
+            for _ in range(args.repeats):
+                start = time.perf_counter()
+                values, _ = seq.get_values(paths, workers=workers)
+                times.append(time.perf_counter() - start)
+            assert all(r.tobytes() == v.tobytes() for r, v in zip(reference, values))
+            best = min(times)
+            base_time = best if base_time is None else base_time
+            print('%8d %10.3f %8.2f' % (workers, best, base_time / best))
+
+        # The bin means are computed from the base-pair values, hence the binned extraction reads as much as the
+        # extraction at full resolution
+        print('%8s %10s %8s' % ('bin_size', 'time [s]', 'ratio'))
+        full_time = None
+        for bin_size in [None] + args.bin_sizes:
+            best = min(timed(seq.get_values, paths, bin_size=bin_size)[0] for _ in range(args.repeats))
+            full_time = best if full_time is None else full_time
+            print('%8s %10.3f %8.2f' % (bin_size or 1, best, best / full_time))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+"""Benchmark for preprocessing.peak_detect_smooth
+
+Compares the linear-time sliding-maximum peak detection with scipy.signal.argrelmax, which was used before, for
+increasing window sizes. Run with
+    python3 benchmark/benchPeakDetect.py [--size 5000000] [--orders 10 100 1000]
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from scipy.signal import argrelmax
+
+# The benchmarks run as scripts from a source checkout, so the package is imported after adding the repository
+# root to the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datahandler import preprocessing  # noqa: E402
+from datahandler.seqDataHandler import smooth  # noqa: E402
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark peak_detect_smooth against scipy.signal.argrelmax')
+    parser.add_argument('--size', type=int, default=5000000)
+    parser.add_argument('--orders', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--mode', default='wrap', choices=['wrap', 'clip'])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    sig = smooth(rng.gamma(2., 2., size=args.size), smooth_size=50)
+    print('size=%d mode=%s' % (args.size, args.mode))
+    print('%8s %14s %14s %8s %8s' % ('order', 'argrelmax [s]', 'sliding [s]', 'speedup', 'peaks'))
+    for order in args.orders:
+        t_ref, ref = timed(argrelmax, sig, order=order, mode=args.mode)
+        t_new, peaks = timed(preprocessing.peak_detect_smooth, sig, peak_range=order, mode=args.mode)
+        assert np.array_equal(ref[0], peaks)
+        print('%8d %14.3f %14.3f %8.1f %8d' % (order, t_ref, t_new, t_ref / t_new, peaks.size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+"""Benchmark suite for the public functions of the datahandler package
+
+Generates synthetic genomes of increasing size (bigwig tracks, a bed annotation and a fasta file, see synthetic.py)
+and measures the wall time (best of several repeats) and the peak memory traced by tracemalloc for every benchmark
+case. The results are written as json file, and a previous result file can be passed to compare two releases. Run
+with
+    python3 benchmark/benchSuite.py [--sizes 1000000 10000000] [--output results.json] [--compare old.json]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import numpy as np
+
+# The benchmarks run as scripts from a source checkout, so the package is imported after adding the repository
+# root to the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from datahandler import reader, intervals, preprocessing, pipeline, coverage, metagene, correlation  # noqa: E402
+from datahandler import seqDataHandler as seq  # noqa: E402
+from datahandler.fasta import IndexedFasta  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def build_inputs(tmp_dir, genome_size, n_chroms, n_tracks, seed):
+    """
+    Generate the synthetic input files and the derived data arrays for one genome size
+    :param tmp_dir: Directory where the files are written
+    :type tmp_dir: str
+    :param genome_size: Total size of the genome
+    :type genome_size: int
+    :param n_chroms: Number of chromosomes
+    :type n_chroms: int
+    :param n_tracks: Number of bigwig tracks
+    :type n_tracks: int
+    :param seed: Seed for the random number generator
+    :type seed: int
+    :return: Dictionary with the inputs of the benchmark cases
+    """
+    rng = np.random.default_rng(seed)
+    chroms = synthetic.make_genome(genome_size, n_chroms=n_chroms)
+    bw_paths = [os.path.join(tmp_dir, 'track%d.bw' % t) for t in range(n_tracks)]
+    for path in bw_paths:
+        synthetic.write_bigwig(path, chroms, rng)
+    bed_path = os.path.join(tmp_dir, 'genes.bed')
+    synthetic.write_bed(bed_path, chroms, rng)
+    fasta_path = os.path.join(tmp_dir, 'genome.fa')
+    synthetic.write_fasta(fasta_path, chroms, rng)
+
+    values, chrom_start = seq.get_values(bw_paths)
+    table = intervals.parse_bed(bed_path)
+    transcripts, _ = seq.annotate(values[0], table, chrom_start)
+    return {
+        'tmp_dir': tmp_dir,
+        'chroms': chroms,
+        'bw_paths': bw_paths,
+        'bed_path': bed_path,
+        'fasta_path': fasta_path,
+        'values': values,
+        'chrom_start': chrom_start,
+        'table': table,
+        'transcripts': transcripts,
+        'rescaled': seq.rescale_all(transcripts, vec_len=1000)
+    }
+
+
+CASES = [
+    ('reader.create_bed_random_fragments',
+     lambda d: lambda: reader.create_bed_random_fragments(d['chroms'], seed=0, in_memory=True)),
+    ('reader.write_big_file', lambda d: lambda: reader.write_big_file(
+        os.path.join(d['tmp_dir'], 'written.bw'), d['values'][0], d['chrom_start'], is_abs_path=True)),
+    ('intervals.parse_bed', lambda d: lambda: intervals.parse_bed(d['bed_path'])),
+    ('coverage.pileup', lambda d: lambda: coverage.pileup(d['bed_path'], d['chroms'])),
+    ('seqDataHandler.get_values', lambda d: lambda: seq.get_values(d['bw_paths'])),
+    ('seqDataHandler.get_values[bin_size=1000]', lambda d: lambda: seq.get_values(d['bw_paths'], bin_size=1000)),
+    ('seqDataHandler.get_values[stacked]', lambda d: lambda: seq.get_values(d['bw_paths'], stacked=True)),
+    ('seqDataHandler.header_stats', lambda d: lambda: seq.header_stats(d['bw_paths'][0])),
+    ('seqDataHandler.array_stats', lambda d: lambda: seq.array_stats(d['values'][0])),
+    ('seqDataHandler.center_norm', lambda d: lambda: seq.center_norm(d['values'][0])),
+    ('seqDataHandler.remap_norm', lambda d: lambda: seq.remap_norm(d['values'][0])),
+    ('seqDataHandler.smooth', lambda d: lambda: seq.smooth(d['values'][0], smooth_size=200,
+                                                           chrom_start=d['chrom_start'])),
+    ('seqDataHandler.smooth_all', lambda d: lambda: seq.smooth_all(d['values'], 200, chrom_start=d['chrom_start'])),
+    ('seqDataHandler.annotate', lambda d: lambda: seq.annotate(d['values'][0], d['table'], d['chrom_start'])),
+    ('seqDataHandler.annotate[ragged]',
+     lambda d: lambda: seq.annotate(d['values'][0], d['table'], d['chrom_start'], ragged=True)),
+    ('seqDataHandler.annotate_all', lambda d: lambda: seq.annotate_all(d['values'], d['table'], d['chrom_start'])),
+    ('seqDataHandler.rescale_all', lambda d: lambda: seq.rescale_all(d['transcripts'], vec_len=1000)),
+    ('metagene.MetageneAggregator',
+     lambda d: lambda: metagene.MetageneAggregator(vec_len=1000, value_range=(0, 10)).add(d['transcripts'])),
+    ('correlation.correlation', lambda d: lambda: correlation.correlation(d['values'])),
+    ('correlation.correlation[bigwig, bin_size=1000]',
+     lambda d: lambda: correlation.correlation(d['bw_paths'], bin_size=1000)),
+    ('seqDataHandler.binning_all', lambda d: lambda: seq.binning_all(d['rescaled'], offset_l=100, offset_r=100)),
+    ('preprocessing.peak_detect_smooth',
+     lambda d: lambda: preprocessing.peak_detect_smooth(d['values'][0], peak_range=200, chrom_start=d['chrom_start'])),
+    ('preprocessing.cancel_noise_cpd',
+     lambda d: lambda: preprocessing.cancel_noise_cpd(d['values'][0].copy(), d['chrom_start'],
+                                                      IndexedFasta(d['fasta_path']))),
+    ('fasta.IndexedFasta.fetch_intervals', lambda d: lambda: IndexedFasta(d['fasta_path']).fetch_intervals(d['table'])),
+    ('pipeline.run_pipeline', lambda d: lambda: pipeline.run_pipeline(d['bw_paths'], d['table'], norm='remap',
+                                                                      smooth_list=[200] * len(d['bw_paths']),
+                                                                      vec_len=1000)),
+]
+
+
+def measure(func, repeats):
+    """
+    Measure the best wall time over several repeats and the peak memory traced by tracemalloc. Memory allocated by C
+    libraries that bypass the Python allocators (e.g. libBigWig) is not traced.
+    :param func: Benchmarked function without arguments
+    :type func: callable
+    :param repeats: Number of timed runs
+    :type repeats: int
+    :return: Best wall time in seconds, peak memory in bytes
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def metadata(args):
+    """
+    Collect the information that identifies a benchmark run
+    :param args: Parsed command line arguments
+    :type args: argparse.Namespace
+    :return: Dictionary with run metadata
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'tracks': args.tracks,
+        'chroms': args.chroms,
+        'repeats': args.repeats,
+        'seed': args.seed
+    }
+
+
+def compare(results, old_path):
+    """
+    Print the time and memory ratio between the current and a previous benchmark run
+    :param results: Current results
+    :type results: list(dict)
+    :param old_path: Path to the json file of the previous run
+    :type old_path: str
+    :return: None
+    """
+    with open(old_path) as old_file:
+        old = {(r['case'], r['genome_size']): r for r in json.load(old_file)['results']}
+    print('\n%-45s %12s %12s %12s' % ('case', 'genome_size', 'time ratio', 'mem ratio'))
+    for r in results:
+        ref = old.get((r['case'], r['genome_size']))
+        if ref is None:
+            continue
+        mem_ratio = r['peak_bytes'] / ref['peak_bytes'] if ref['peak_bytes'] > 0 else float('nan')
+        print('%-45s %12d %12.2f %12.2f' % (r['case'], r['genome_size'], r['time_s'] / ref['time_s'], mem_ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the public functions on synthetic genomes')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000000, 10000000])
+    parser.add_argument('--tracks', type=int, default=2)
+    parser.add_argument('--chroms', type=int, default=16)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cases', nargs='+', default=None, help='Only run cases that contain one of these strings')
+    parser.add_argument('--output', default=None, help='Path of the json result file')
+    parser.add_argument('--compare', default=None, help='Json result file of a previous run')
+    args = parser.parse_args()
+
+    cases = [c for c in CASES if args.cases is None or any(sel in c[0] for sel in args.cases)]
+    results = []
+    print('%-45s %12s %12s %12s' % ('case', 'genome_size', 'time [s]', 'peak [MB]'))
+    for genome_size in args.sizes:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            inputs = build_inputs(tmp_dir, genome_size, args.chroms, args.tracks, args.seed)
+            for name, make_func in cases:
+                best, peak = measure(make_func(inputs), args.repeats)
+                results.append({'case': name, 'genome_size': genome_size, 'time_s': best, 'peak_bytes': peak})
+                print('%-45s %12d %12.4f %12.1f' % (name, genome_size, best, peak / 2.**20))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as out_file:
+            json.dump({'meta': metadata(args), 'results': results}, out_file, indent=2)
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
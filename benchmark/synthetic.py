@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+"""Synthetic input generators for the benchmarks
+
+All inputs are generated locally from a numpy.random.Generator, such that the benchmarks are reproducible and do not
+need any downloads. The provided functions are
+* make_genome - Create the chromosome sizes of a synthetic genome
+* write_bigwig - Write a synthetic bigwig file with gamma-distributed coverage and uncovered gaps
+* write_bed - Write a synthetic bed file with log-normally distributed gene lengths
+* write_fasta - Write a synthetic fasta file
+"""
+from collections import OrderedDict
+import numpy as np
+import pyBigWig
+
+
+def make_genome(genome_size, n_chroms=16):
+    """
+    Create the chromosome sizes of a synthetic genome. The chromosomes get decreasing sizes, similar to real genomes.
+    :param genome_size: Total size of the genome
+    :type genome_size: int
+    :param n_chroms: Number of chromosomes
+    :type n_chroms: int
+    :return: OrderedDict with chromosome name as key and chromosome size as value
+    """
+    weights = np.linspace(2., 1., n_chroms)
+    sizes = np.maximum((weights / weights.sum() * genome_size).astype(np.int64), 1)
+    return OrderedDict(('chr%d' % (c + 1), int(size)) for c, size in enumerate(sizes))
+
+
+def write_bigwig(path, chroms, rng, interval_size=50, coverage=0.9):
+    """
+    Write a synthetic bigwig file with gamma-distributed values on intervals of fixed size. A fraction of the
+    intervals is left without values to mimic uncovered regions.
+    :param path: Path of the created bigwig file
+    :type path: str
+    :param chroms: Dictionary with chromosome name as key and chromosome size as value
+    :type chroms: dict
+    :param rng: Random number generator
+    :type rng: numpy.random.Generator
+    :param interval_size: Size of the intervals with constant value
+    :type interval_size: int
+    :param coverage: Fraction of intervals with values
+    :type coverage: float
+    :return: None
+    """
+    bw = pyBigWig.open(path, 'w')
+    bw.addHeader(list(chroms.items()))
+    for chrom, size in chroms.items():
+        starts = np.arange(0, size, interval_size, dtype=np.int64)
+        starts = starts[rng.random(starts.size) < coverage]
+        if starts.size == 0:
+            continue
+        ends = np.minimum(starts + interval_size, size)
+        bw.addEntries(np.repeat(chrom, starts.size), starts, ends=ends, values=rng.gamma(2., 2., size=starts.size))
+    bw.close()
+
+
+def write_bed(path, chroms, rng, gene_density=1. / 2000, median_length=1500, sigma=0.8):
+    """
+    Write a synthetic bed file with named genes on both strands. The gene lengths follow a log-normal distribution,
+    which resembles the gene length distribution of real annotations.
+    :param path: Path of the created bed file
+    :type path: str
+    :param chroms: Dictionary with chromosome name as key and chromosome size as value
+    :type chroms: dict
+    :param rng: Random number generator
+    :type rng: numpy.random.Generator
+    :param gene_density: Expected number of genes per base
+    :type gene_density: float
+    :param median_length: Median gene length
+    :type median_length: int
+    :param sigma: Standard deviation of the logarithmic gene length
+    :type sigma: float
+    :return: Number of written genes
+    """
+    count = 0
+    with open(path, 'w') as bed:
+        for chrom, size in chroms.items():
+            n_genes = rng.poisson(size * gene_density)
+            lengths = np.clip(rng.lognormal(np.log(median_length), sigma, size=n_genes).astype(np.int64), 1, size)
+            starts = np.sort(rng.integers(0, size - lengths + 1))
+            ends = starts + lengths
+            strands = rng.choice(['+', '-'], size=n_genes)
+            bed.write(''.join('%s\t%d\t%d\tgene%d\t0\t%s\n' % (chrom, s, e, count + num, st)
+                              for num, (s, e, st) in enumerate(zip(starts.tolist(), ends.tolist(), strands))))
+            count += n_genes
+    return count
+
+
+def write_fasta(path, chroms, rng, line_width=60, gc_content=0.4):
+    """
+    Write a synthetic fasta file with random bases
+    :param path: Path of the created fasta file
+    :type path: str
+    :param chroms: Dictionary with chromosome name as key and chromosome size as value
+    :type chroms: dict
+    :param rng: Random number generator
+    :type rng: numpy.random.Generator
+    :param line_width: Number of bases per line
+    :type line_width: int
+    :param gc_content: Fraction of G and C bases
+    :type gc_content: float
+    :return: None
+    """
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+    prob = np.array([1. - gc_content, gc_content, gc_content, 1. - gc_content]) / 2.
+    with open(path, 'wb') as fasta:
+        for chrom, size in chroms.items():
+            seq = rng.choice(bases, size=size, p=prob)
+            n_lines = -(-size // line_width)
+            lines = np.full((n_lines, line_width + 1), ord('\n'), dtype=np.uint8)
+            lines[:, :line_width] = np.append(seq, np.zeros(n_lines * line_width - size, dtype=np.uint8)).reshape(
+                n_lines, line_width)
+            # The last line is shorter if the chromosome size is not a multiple of the line width
+            last = size - (n_lines - 1) * line_width
+            fasta.write(b'>%s\n' % chrom.encode())
+            fasta.write(lines[:-1].tobytes())
+            fasta.write(lines[-1, :last].tobytes() + b'\n')
@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+"""Internal helpers
+
+Helpers that are shared between the modules of the package and are not part of its public interface. The provided
+functions are
+* merge_moments - Merge the moments of a data chunk into accumulated moments
+* combine_moments - Combine two sets of moments with the pairwise update by Chan et al.
+* moments_stats - Convert accumulated moments into normalisation statistics
+* rescale_batch - Batched linear resampling of segments into a preallocated output array
+* as_table - Parse a bed file if it was not parsed yet
+* segment_slices - Create the slices of all intervals in the concatenated genome array
+* big_file - Get a bigwig file from the handle pool of the reader module if a path is passed
+* fill_chrom - Write the values of one chromosome of a bigwig file in place into an array slice
+"""
+import contextlib
+import numpy as np
+import pyBigWig
+from datahandler.reader import open_big_file
+from datahandler import intervals, profiling
+
+# Number of base-pair values that are read at once to compute the bin means
+_BIN_CHUNK_SIZE = 2**22
+
+
+def merge_moments(moments, chunk):
+    """
+    Merge the moments of a chunk into the accumulated moments
+    :param moments: Accumulated moments (count, mean, sum of squared deviations, minimum, maximum) or None
+    :type moments: tuple
+    :param chunk: Data chunk. The moments are computed along the last axis
+    :type chunk: numpy.array
+    :return: Updated moments
+    """
+    if chunk.shape[-1] == 0:
+        return moments
+    mean_b = chunk.mean(axis=-1, dtype=np.float64)
+    m2_b = np.square(chunk - mean_b[..., np.newaxis], dtype=np.float64).sum(axis=-1)
+    return combine_moments(moments, (chunk.shape[-1], mean_b, m2_b, chunk.min(axis=-1), chunk.max(axis=-1)))
+
+
+def combine_moments(moments_a, moments_b):
+    """
+    Combine two sets of moments with the pairwise update by Chan et al.
+    :param moments_a: Moments (count, mean, sum of squared deviations, minimum, maximum) or None
+    :type moments_a: tuple
+    :param moments_b: Moments (count, mean, sum of squared deviations, minimum, maximum)
+    :type moments_b: tuple
+    :return: Combined moments. If moments_a is None, moments_b is returned
+    """
+    if moments_a is None:
+        return moments_b
+    n_a, mean_a, m2_a, min_a, max_a = moments_a
+    n_b, mean_b, m2_b, min_b, max_b = moments_b
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return (n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n,
+            np.minimum(min_a, min_b), np.maximum(max_a, max_b))
+
+
+def moments_stats(moments):
+    """
+    Convert accumulated moments into normalisation statistics
+    :param moments: Accumulated moments (count, mean, sum of squared deviations, minimum, maximum)
+    :type moments: tuple
+    :return: Tuple with minimum, maximum, mean and standard deviation
+    """
+    n, mean, m2, data_min, data_max = moments
+    return data_min, data_max, mean, np.sqrt(m2 / n)
+
+
+def rescale_batch(values, offsets, seg_len, out, chunk_size=2**22):
+    """
+    Batched linear resampling of all segments. The target coordinates and interpolation weights are computed for
+    many segments at once, following the arithmetic of scipy.interpolate.interp1d and numpy.linspace.
+    :param values: Contiguous values buffer with all segments
+    :type values: numpy.array
+    :param offsets: Segment offsets in values (n + 1 entries)
+    :type offsets: numpy.array
+    :param seg_len: Length of every segment
+    :type seg_len: numpy.array
+    :param out: Output array of shape (number of segments, vec_len)
+    :type out: numpy.array
+    :param chunk_size: Approximate number of output values that are computed at once
+    :type chunk_size: int
+    :return: None
+    """
+    vec_len = out.shape[1]
+    if vec_len == 0:
+        return
+    rows = max(1, chunk_size // vec_len)
+    steps = np.arange(vec_len, dtype=np.float64)
+    for first in range(0, seg_len.size, rows):
+        n = seg_len[first:first + rows, np.newaxis]
+        # Target coordinates as numpy.linspace(0, n - 1, vec_len)
+        x_new = steps * ((n - 1) / max(vec_len - 1, 1))
+        if vec_len > 1:
+            x_new[:, -1] = n[:, 0] - 1
+        # Interval selection as in interp1d: searchsorted on the integer grid
+        hi = np.clip(np.ceil(x_new).astype(np.int64), 1, np.maximum(n - 1, 1))
+        lo = hi - 1
+        hi = np.minimum(hi, n - 1)
+        start = offsets[first:first + n.shape[0], np.newaxis]
+        y_lo = values[start + lo]
+        y_hi = values[start + hi]
+        slope = (y_hi - y_lo) / np.maximum(hi - lo, 1)
+        out[first:first + rows] = slope * (x_new - lo) + y_lo
+
+
+def as_table(bed_ref):
+    """
+    Parse a bed file if it was not parsed yet
+    :param bed_ref: Bed file as BedTool object, path to a bed file, iterable with intervals or IntervalTable
+    :type bed_ref: BedTool or str or iterable or IntervalTable
+    :return: IntervalTable
+    """
+    if isinstance(bed_ref, intervals.IntervalTable):
+        return bed_ref
+    return intervals.parse_bed(bed_ref)
+
+
+def segment_slices(table, chrom_start, bin_size=None):
+    """
+    Create the slices for all intervals in the concatenated genome array. Intervals on the minus strand are sliced
+    in reverse order.
+    :param table: Parsed intervals
+    :type table: IntervalTable
+    :param chrom_start: Dictionary with index positions where the chromosomes start
+    :type chrom_start: dict
+    :param bin_size: Bin size if the genome array is binned
+    :type bin_size: int
+    :return: List with one slice per interval
+    """
+    abs_start, abs_end = intervals.absolute_bounds(table, chrom_start, bin_size=bin_size)
+    # Empty intervals are sliced forward, as the reversed slice of an empty interval at index 0 would be [-1::-1]
+    is_minus = (table.strand == -1) & (abs_end > abs_start)
+    sl_start = np.where(is_minus, abs_end - 1, abs_start)
+    sl_stop = np.where(is_minus, abs_start - 1, abs_end)
+    sl_step = np.where(is_minus, -1, 1)
+    return [slice(a, b if b >= 0 else None, c)
+            for a, b, c in zip(sl_start.tolist(), sl_stop.tolist(), sl_step.tolist())]
+
+
+def big_file(bw):
+    """
+    Get a bigwig file from the handle pool of the reader module if a path is passed
+    :param bw: Bigwig file or path to the bigwig file
+    :type bw: bigWigFile or str
+    :return: Context manager that yields the bigWigFile object
+    """
+    if isinstance(bw, str):
+        return open_big_file(bw, is_abs_path=True)
+    return contextlib.nullcontext(bw)
+
+
+@profiling.instrument(chrom_arg='chrom')
+def fill_chrom(chrom_values, bw, chrom, length, bin_size=None, start=0):
+    """
+    Write the values of one chromosome in place into the passed array slice. Missing values are set to zero.
+    :param chrom_values: Array slice of the size of the chromosome (or of its number of bins)
+    :type chrom_values: numpy.array
+    :param bw: Bigwig file
+    :type bw: bigWigFile
+    :param chrom: Chromosome name
+    :type chrom: str
+    :param length: Chromosome size, or end of the region if only a part of the chromosome is read
+    :type length: int
+    :param bin_size: If set, the exact mean value per bin is written. The base-pair values are read in chunks of whole
+    bins and summed per bin
+    :type bin_size: int
+    :param start: Start of the region if only a part of the chromosome is read. Must be a multiple of bin_size
+    :type start: int
+    :return: None
+    """
+    if bin_size is not None:
+        n_full = (length - start) // bin_size
+        # Chunks of whole bins, such that the base-pair values of at most one chunk are held in memory
+        step = max(_BIN_CHUNK_SIZE // bin_size, 1) * bin_size
+        for c_start in range(start, start + n_full * bin_size, step):
+            c_end = min(c_start + step, start + n_full * bin_size)
+            values = _read_values(bw, chrom, c_start, c_end)
+            chrom_values[(c_start - start) // bin_size:(c_end - start) // bin_size] = np.nansum(
+                values.reshape(-1, bin_size), axis=1, dtype=np.float64) / bin_size
+        if n_full < chrom_values.size:
+            values = _read_values(bw, chrom, start + n_full * bin_size, length)
+            chrom_values[n_full] = np.nansum(values, dtype=np.float64) / values.size
+        return
+    chrom_values[:] = _read_values(bw, chrom, start, length)
+    np.nan_to_num(chrom_values, copy=False, nan=0.0)
+
+
+def _read_values(bw, chrom, start, end):
+    """
+    Read the base-pair values of a region of a bigwig file. Missing values are NaN
+    :param bw: Bigwig file
+    :type bw: bigWigFile
+    :param chrom: Chromosome name
+    :type chrom: str
+    :param start: Start of the region
+    :type start: int
+    :param end: End of the region
+    :type end: int
+    :return: numpy.array with the values
+    """
+    if pyBigWig.numpy:
+        return bw.values(chrom, start, end, numpy=True)
+    return np.asarray(bw.values(chrom, start, end), dtype=np.float32)
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+"""Cache module
+
+Persistent on-disk cache for the signal extracted from bigwig files. Every entry consists of a raw .npy array that
+is opened as numpy.memmap and a json sidecar holding the chromosome start indices and the data type. Entries are
+keyed by the resolved bigwig path and validated against its size and modification time, such that several processes
+can share the cached values through the page cache of the operating system. The provided functions are
+* source_info - Resolved path, size and modification time of a source file
+* cache_entry - Create the paths to the cache files of a bigwig file
+* load_cached_values - Load cached values as read-only memory map if the cache entry is valid
+* create_cached_values - Create a writeable memory map for a new cache entry
+* commit_cached_values - Finalise a cache entry that was created with create_cached_values
+* store_values - Store a data array in the cache
+* invalidate - Remove the cache entries of a bigwig file or of all files
+* evict - Remove least recently used cache entries until the cache size is below a size cap
+* cache_size - Total size of the cache in bytes
+"""
+import os
+import json
+import glob
+import hashlib
+import numpy as np
+
+# Glob pattern of the cache keys (first 16 hex digits of the sha1 of the resolved path)
+_KEY_PATTERN = '[0-9a-f]' * 16
+# Keys that every sidecar file written by the cache contains
+_META_KEYS = ('source', 'genome_size', 'chrom_start')
+
+
+def source_info(path):
+    """
+    Retrieve the key properties of a source file, which identify its content without reading it
+    :param path: Path to the file
+    :type path: str
+    :return: Dictionary with resolved path, size and modification time of the file
+    """
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return {'source': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def cache_entry(path, cache_dir, dtype='float32', tag=''):
+    """
+    Create the paths to the cache files of a bigwig file
+    :param path: Path to the bigwig file
+    :type path: str
+    :param cache_dir: Directory where the cache is stored
+    :type cache_dir: str
+    :param dtype: Data type of the cached values
+    :type dtype: str or numpy.dtype
+    :param tag: Additional identifier to distinguish several cached representations of the same file
+    :type tag: str
+    :return: Path to the data file, path to the sidecar file
+    """
+    base = os.path.join(cache_dir, '%s_%s%s' % (_key(path), np.dtype(dtype).name, tag))
+    return base + '.npy', base + '.json'
+
+
+def _key(path):
+    """
+    Create the cache key of a bigwig file
+    :param path: Path to the bigwig file
+    :type path: str
+    :return: Key as hex string
+    """
+    return hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:16]
+
+
+def load_cached_values(path, cache_dir, dtype='float32', tag=''):
+    """
+    Load cached values as read-only memory map if the cache entry is valid. An entry is valid if it was created from
+    a file with the same resolved path, size and modification time.
+    :param path: Path to the bigwig file
+    :type path: str
+    :param cache_dir: Directory where the cache is stored
+    :type cache_dir: str
+    :param dtype: Data type of the cached values
+    :type dtype: str or numpy.dtype
+    :param tag: Additional identifier to distinguish several cached representations of the same file
+    :type tag: str
+    :return: numpy.memmap with the values and dictionary with starting indices for chromosomes, or None if there is
+    no valid cache entry
+    """
+    data_path, meta_path = cache_entry(path, cache_dir, dtype=dtype, tag=tag)
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+    info = source_info(path)
+    if any(meta.get(k) != v for k, v in info.items()) or meta.get('dtype') != np.dtype(dtype).name:
+        return None
+
+    try:
+        values = np.load(data_path, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if values.shape != (meta['genome_size'],):
+        return None
+
+    # Mark the entry as recently used for the eviction policy
+    os.utime(meta_path)
+    return values, dict(meta['chrom_start'])
+
+
+def create_cached_values(path, cache_dir, chrom_start, genome_size, dtype='float32', tag=''):
+    """
+    Create a writeable memory map for a new cache entry. The entry only becomes valid after the values were written
+    and commit_cached_values was called.
+    :param path: Path to the bigwig file
+    :type path: str
+    :param cache_dir: Directory where the cache is stored
+    :type cache_dir: str
+    :param chrom_start: Dictionary with starting indices for chromosomes
+    :type chrom_start: dict
+    :param genome_size: Size of the concatenated genome
+    :type genome_size: int
+    :param dtype: Data type of the cached values
+    :type dtype: str or numpy.dtype
+    :param tag: Additional identifier to distinguish several cached representations of the same file
+    :type tag: str
+    :return: Writeable numpy.memmap
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path, meta_path = cache_entry(path, cache_dir, dtype=dtype, tag=tag)
+    if os.path.isfile(meta_path):
+        os.remove(meta_path)
+    return np.lib.format.open_memmap(_tmp_path(data_path), mode='w+', dtype=dtype, shape=(int(genome_size),))
+
+
+def commit_cached_values(values, path, cache_dir, chrom_start, tag='', info=None):
+    """
+    Finalise a cache entry that was created with create_cached_values
+    :param values: Memory map returned by create_cached_values
+    :type values: numpy.memmap
+    :param path: Path to the bigwig file
+    :type path: str
+    :param cache_dir: Directory where the cache is stored
+    :type cache_dir: str
+    :param chrom_start: Dictionary with starting indices for chromosomes
+    :type chrom_start: dict
+    :param tag: Additional identifier to distinguish several cached representations of the same file
+    :type tag: str
+    :param info: Properties of the bigwig file as returned by source_info, taken before the values were read. The
+    entry is stamped with them; if the file changed since, the entry is discarded. If None, the current properties
+    are used
+    :type info: dict
+    :return: Read-only numpy.memmap with the cached values, or an in-memory copy of the values if the entry was
+    discarded
+    """
+    data_path, meta_path = cache_entry(path, cache_dir, dtype=values.dtype, tag=tag)
+    if info is not None and source_info(path) != info:
+        # The values may have been read from the old and the new file, hence they must not be cached
+        values = np.array(values)
+        os.remove(_tmp_path(data_path))
+        return values
+
+    meta = dict(source_info(path) if info is None else info)
+    meta.update({
+        'dtype': values.dtype.name,
+        'genome_size': values.size,
+        'chrom_start': list(chrom_start.items())
+    })
+    values.flush()
+    os.replace(_tmp_path(data_path), data_path)
+
+    tmp_meta_path = _tmp_path(meta_path)
+    with open(tmp_meta_path, 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(tmp_meta_path, meta_path)
+    return np.load(data_path, mmap_mode='r')
+
+
+def _tmp_path(path):
+    """
+    Create the path of the temporary file that is written before it atomically replaces the cache file
+    :param path: Path to the cache file
+    :type path: str
+    :return: Path to the temporary file
+    """
+    return '%s.%d.tmp' % (path, os.getpid())
+
+
+def store_values(path, cache_dir, values, chrom_start, tag=''):
+    """
+    Store a data array in the cache
+    :param path: Path to the bigwig file
+    :type path: str
+    :param cache_dir: Directory where the cache is stored
+    :type cache_dir: str
+    :param values: Data array with the concatenated values of the bigwig file
+    :type values: numpy.array
+    :param chrom_start: Dictionary with starting indices for chromosomes
+    :type chrom_start: dict
+    :param tag: Additional identifier to distinguish several cached representations of the same file
+    :type tag: str
+    :return: Read-only numpy.memmap with the cached values
+    """
+    cached = create_cached_values(path, cache_dir, chrom_start, values.size, dtype=values.dtype, tag=tag)
+    cached[:] = values
+    return commit_cached_values(cached, path, cache_dir, chrom_start, tag=tag)
+
+
+def invalidate(cache_dir, path=None):
+    """
+    Remove the cache entries of a bigwig file or of all files. Only files that were written by the cache are removed,
+    hence cache_dir can be shared with other files
+    :param cache_dir: Directory where the cache is stored
+    :type cache_dir: str
+    :param path: Path to the bigwig file. If None, the whole cache is cleared
+    :type path: str
+    :return: Number of removed cache entries
+    """
+    pattern = '%s_*' % (_KEY_PATTERN if path is None else _key(path))
+
+    removed = 0
+    for meta_path in glob.glob(os.path.join(cache_dir, pattern + '.json')):
+        if _is_entry(meta_path):
+            _remove_entry(meta_path)
+            removed += 1
+    for ext in ('.npy', '.json'):
+        for tmp_path in glob.glob(os.path.join(cache_dir, pattern + ext + '.*.tmp')):
+            os.remove(tmp_path)
+    return removed
+
+
+def _is_entry(meta_path):
+    """
+    Check whether a sidecar file was written by the cache
+    :param meta_path: Path to the sidecar file
+    :type meta_path: str
+    :return: True if the file is a json object with the keys of a cache sidecar
+    """
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return False
+    return isinstance(meta, dict) and all(k in meta for k in _META_KEYS)
+
+
+def _remove_entry(meta_path):
+    """
+    Remove data and sidecar file of a cache entry
+    :param meta_path: Path to the sidecar file
+    :type meta_path: str
+    :return: None
+    """
+    data_path = meta_path[:-len('.json')] + '.npy'
+    for p in (meta_path, data_path):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+def _entries(cache_dir):
+    """
+    List all cache entries. Files in cache_dir that were not written by the cache are ignored
+    :param cache_dir: Directory where the cache is stored
+    :type cache_dir: str
+    :return: List with tuples of last access time, size in bytes and sidecar path, sorted by last access
+    """
+    entries = []
+    for meta_path in glob.glob(os.path.join(cache_dir, _KEY_PATTERN + '_*.json')):
+        if not _is_entry(meta_path):
+            continue
+        data_path = meta_path[:-len('.json')] + '.npy'
+        try:
+            size = os.path.getsize(meta_path) + os.path.getsize(data_path)
+            entries.append((os.path.getmtime(meta_path), size, meta_path))
+        except OSError:
+            continue
+    return sorted(entries)
+
+
+def cache_size(cache_dir):
+    """
+    Total size of the cache in bytes
+    :param cache_dir: Directory where the cache is stored
+    :type cache_dir: str
+    :return: Size in bytes
+    """
+    return sum(size for _, size, _ in _entries(cache_dir))
+
+
+def evict(cache_dir, max_size, keep=()):
+    """
+    Remove least recently used cache entries until the cache size is below a size cap
+    :param cache_dir: Directory where the cache is stored
+    :type cache_dir: str
+    :param max_size: Maximal size of the cache in bytes
+    :type max_size: int
+    :param keep: Paths to sidecar files which must not be removed
+    :type keep: iterable(str)
+    :return: Number of removed cache entries
+    """
+    entries = _entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    keep = set(keep)
+    removed = 0
+    for _, size, meta_path in entries:
+        if total <= max_size:
+            break
+        if meta_path in keep:
+            continue
+        _remove_entry(meta_path)
+        total -= size
+        removed += 1
+    return removed
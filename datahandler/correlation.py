@@ -0,0 +1,474 @@
+#!/usr/bin/python3
+"""Correlation module
+
+Genome-wide Pearson and Spearman correlation between many tracks without loading the tracks into memory at once.
+The concatenated genome layout of seqDataHandler.get_values is streamed chunk by chunk (within the chromosomes), and
+every chunk of all tracks is reduced to its count, the mean per track and the matrix of co-moments (the centred
+cross-products of all track pairs, computed with one matrix multiplication). The chunk statistics are merged with the
+pairwise update by Chan et al. (see seqDataHandler.array_stats), hence the memory is bounded by the number of tracks
+squared plus the number of tracks times the chunk size, and the chunks can be processed in parallel. The Spearman
+ranks are looked up in a table of fixed size per track: the exact distinct values as long as a track has at most
+rank_bins of them, otherwise the frequent values and a histogram of the other values over the range of the track,
+which gives approximate ranks and a RuntimeWarning. The provided functions are
+* correlation - Correlation matrix of bigwig files or data arrays
+"""
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from datahandler import intervals, profiling, _internal
+
+# State of the worker processes (tracks, blacklist and ranks), which is set once per process by _init_worker
+_worker_state = None
+
+
+@profiling.instrument(path_arg='tracks')
+def correlation(tracks, method='pearson', chrom_start=None, bin_size=None, skip_zeros=False, blacklist=None,
+                chunk_size=2**20, workers=1, rank_bins=2**16):
+    """
+    Compute the correlation matrix of several tracks over the whole genome. Positions where any track is NaN (without
+    bin_size), that overlap with the blacklist or (with skip_zeros) where all tracks are zero are excluded for all
+    track pairs.
+    :param tracks: List with paths to bigwig files, list with data arrays in the concatenated genome layout or
+    two-dimensional array with one row per track (e.g. returned by get_values with stacked=True). Bigwig files are
+    read chunk by chunk and missing values count as zero
+    :type tracks: list(str) or list(numpy.array) or numpy.array
+    :param method: Either 'pearson' or 'spearman'. The Spearman correlation is the Pearson correlation of the ranks,
+    where ties get their average rank. The ranks are computed in an additional pass, see rank_bins
+    :type method: str
+    :param chrom_start: Dictionary with index positions where the chromosomes start. Only used for data arrays; it is
+    required for the blacklist, and with bin_size the bins do not cross chromosome boundaries
+    :type chrom_start: dict
+    :param bin_size: If set, the tracks are averaged over bins of bin_size bases (the last bin of a chromosome can be
+    shorter) and the bins are correlated. Missing values (NaN) count as zero in the bin means, as in get_values with
+    bin_size, for bigwig files and data arrays alike. Data arrays must have base-pair resolution
+    :type bin_size: int
+    :param skip_zeros: If True, positions (or bins) where all tracks are zero are excluded
+    :type skip_zeros: bool
+    :param blacklist: Regions that are excluded, as bed file, BedTool object or IntervalTable
+    :type blacklist: str or BedTool or IntervalTable
+    :param chunk_size: Number of positions (or bins) per track that are processed at a time
+    :type chunk_size: int
+    :param workers: Number of chunks that are processed in parallel. Data arrays are processed in threads, bigwig files
+    in processes that open their own file handles. The result does not depend on the number of workers
+    :type workers: int
+    :param rank_bins: Size of the Spearman rank table per track. Tracks with at most rank_bins distinct values get
+    exact ranks. For tracks with more distinct values, the frequent values (at most rank_bins) are counted exactly and
+    the other values in a histogram of rank_bins bins over the range of the track (in a further pass): values within
+    a bin are ranked by linear interpolation. A RuntimeWarning names the tracks with approximate ranks
+    :type rank_bins: int
+    :return: Correlation matrix with shape (number of tracks, number of tracks). Entries of tracks that are constant
+    over the included positions are NaN
+    """
+    if method not in ('pearson', 'spearman'):
+        raise ValueError('Correlation method %s is not supported. Use pearson or spearman.' % method)
+    if len(tracks) == 0:
+        raise ValueError('List with tracks must not be empty.')
+    if rank_bins < 1:
+        raise ValueError('rank_bins must be positive.')
+    is_path = [isinstance(t, str) for t in tracks]
+    if any(is_path) and not all(is_path):
+        raise ValueError('tracks must either contain paths to bigwig files or data arrays.')
+
+    if all(is_path):
+        tracks = list(tracks)
+        with _internal.big_file(tracks[0]) as bw:
+            sizes = bw.chroms()
+        offsets = None
+    else:
+        tracks = [np.asarray(t) for t in tracks]
+        if any(t.shape != tracks[0].shape or t.ndim != 1 for t in tracks):
+            raise ValueError('All data arrays must be one-dimensional and have the same size.')
+        if chrom_start is not None:
+            sizes = intervals.chrom_sizes(chrom_start, tracks[0].size)
+            offsets = chrom_start
+        else:
+            sizes, offsets = {None: tracks[0].size}, {None: 0}
+
+    layout, _ = intervals.chrom_layout(sizes, bin_size=bin_size)
+    state = {'tracks': tracks, 'offsets': offsets, 'bin_size': bin_size, 'skip_zeros': skip_zeros,
+             'blacklist': None, 'ranks': None, 'rank_bins': rank_bins}
+    if blacklist is not None:
+        if None in layout:
+            raise ValueError('A blacklist requires chrom_start.')
+        table = _internal.as_table(blacklist)
+        # Regions on chromosomes that are not in the layout are ignored, the others are clipped at the chromosome ends
+        lengths = np.asarray([sizes.get(c, -1) for c in table.chrom_names], dtype=np.int64)[table.chrom]
+        keep = (lengths >= 0) & (table.start < lengths)
+        table = table._replace(chrom=table.chrom[keep], start=table.start[keep],
+                               end=np.minimum(table.end[keep], lengths[keep]))
+        layout_all = {c: layout.get(c, 0) for c in table.chrom_names}
+        state['blacklist'] = intervals.absolute_bounds(table, layout_all, bin_size=bin_size)
+
+    step = chunk_size * (1 if bin_size is None else bin_size)
+    tasks = [(chrom, lo, min(lo + step, length), layout[chrom] + lo // (bin_size or 1))
+             for chrom, length in sizes.items() for lo in range(0, length, step)]
+
+    if method == 'spearman':
+        state['ranks'] = _rank_tables(tasks, state, workers, all(is_path))
+
+    moments = None
+    for chunk_moments in _map_chunks(_moments_task, tasks, state, workers, all(is_path)):
+        moments = _merge_comoments(moments, chunk_moments)
+
+    n_tracks = len(tracks)
+    if moments is None:
+        return np.full((n_tracks, n_tracks), np.nan)
+    comoment = moments[2]
+    var = np.diag(comoment)
+    norm = np.sqrt(np.outer(var, var))
+    corr = np.divide(comoment, norm, out=np.full((n_tracks, n_tracks), np.nan), where=norm > 0)
+    return np.clip(corr, -1., 1., out=corr)
+
+
+def _map_chunks(func, tasks, state, workers, is_path):
+    """
+    Apply a chunk function to all chunks, in parallel if workers > 1. The results are returned in the order of the
+    tasks, hence merging them does not depend on the number of workers
+    :param func: Chunk function that takes the task and the state
+    :type func: callable
+    :param tasks: List with tuples of chromosome, start and end in bases, and index of the chunk in the layout
+    :type tasks: list(tuple)
+    :param state: Tracks, blacklist and rank tables
+    :type state: dict
+    :param workers: Number of workers
+    :type workers: int
+    :param is_path: If True, the tracks are paths to bigwig files and the chunks are processed in processes
+    :type is_path: bool
+    :return: Generator with the results of the chunks
+    """
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield func(task, state)
+    elif is_path:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(state,)) as executor:
+            yield from executor.map(_worker_task, [(func, task) for task in tasks])
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from executor.map(lambda task: func(task, state), tasks)
+
+
+def _init_worker(state):
+    """
+    Set the state of a worker process
+    :param state: Tracks, blacklist and rank tables
+    :type state: dict
+    :return: None
+    """
+    global _worker_state
+    _worker_state = state
+
+
+def _worker_task(task):
+    """
+    Apply a chunk function in a worker process
+    :param task: Tuple with chunk function and chunk task
+    :type task: tuple
+    :return: Result of the chunk function
+    """
+    func, chunk = task
+    return func(chunk, _worker_state)
+
+
+def _read_chunk(task, state):
+    """
+    Read a chunk of all tracks and remove the excluded positions
+    :param task: Tuple with chromosome, start and end in bases, and index of the chunk in the layout
+    :type task: tuple
+    :param state: Tracks, blacklist and rank tables
+    :type state: dict
+    :return: numpy.array with shape (number of tracks, number of included positions)
+    """
+    chrom, lo, hi, pos = task
+    tracks, bin_size = state['tracks'], state['bin_size']
+    size = hi - lo if bin_size is None else -(-(hi - lo) // bin_size)
+    block = np.empty((len(tracks), size))
+    if state['offsets'] is None:
+        for row, path in zip(block, tracks):
+            with _internal.big_file(path) as bw:
+                _internal.fill_chrom(row, bw, chrom, hi, bin_size=bin_size, start=lo)
+    else:
+        offset = state['offsets'][chrom]
+        for row, values in zip(block, tracks):
+            chunk = values[offset + lo:offset + hi]
+            if bin_size is None:
+                row[:] = chunk
+            else:
+                edges = np.arange(0, hi - lo, bin_size)
+                row[:] = np.add.reduceat(np.nan_to_num(chunk, nan=0.), edges, dtype=np.float64) / \
+                    np.diff(np.append(edges, hi - lo))
+
+    mask = ~np.isnan(block).any(axis=0)
+    if state['skip_zeros']:
+        mask &= (block != 0).any(axis=0)
+    if state['blacklist'] is not None:
+        mask &= ~_blacklist_mask(state['blacklist'], pos, size)
+    return block[:, mask] if not np.all(mask) else block
+
+
+def _blacklist_mask(blacklist, pos, size):
+    """
+    Mask of the positions of a chunk that overlap with the blacklist
+    :param blacklist: numpy.array with starts and numpy.array with ends of the regions in the layout
+    :type blacklist: tuple
+    :param pos: Index of the chunk in the layout
+    :type pos: int
+    :param size: Size of the chunk
+    :type size: int
+    :return: Boolean numpy.array
+    """
+    start, end = blacklist
+    hit = (end > pos) & (start < pos + size)
+    diff = np.zeros(size + 1, dtype=np.int64)
+    np.add.at(diff, np.clip(start[hit] - pos, 0, size), 1)
+    np.add.at(diff, np.clip(end[hit] - pos, 0, size), -1)
+    return np.cumsum(diff[:size]) > 0
+
+
+def _rank_tables(tasks, state, workers, is_path):
+    """
+    Compute the Spearman rank table of every track. The first pass collects the range and a summary of the distinct
+    values of every track (see _DistinctCounts). If a track has at most rank_bins distinct values, the summary is
+    exact. Otherwise, it contains the frequent values, which are counted exactly in a second pass, and all other values
+    are counted in a histogram with rank_bins bins over the range of the track
+    :param tasks: List with chunk tasks
+    :type tasks: list(tuple)
+    :param state: Tracks, blacklist and rank_bins
+    :type state: dict
+    :param workers: Number of workers
+    :type workers: int
+    :param is_path: If True, the tracks are paths to bigwig files
+    :type is_path: bool
+    :return: List with one dictionary per track with the sorted distinct (or frequent) values and the number of values
+    below them ('values', 'counts', 'below'), and for approximate ranks the range of the histogram, the histogram and
+    the number of values below every bin ('range', 'hist', 'before')
+    """
+    n_bins = state['rank_bins']
+    distinct = [_DistinctCounts(n_bins) for _ in state['tracks']]
+    lo, hi = np.full(len(distinct), np.inf), np.full(len(distinct), -np.inf)
+    for chunk_values in _map_chunks(_distinct_task, tasks, state, workers, is_path):
+        for num, (c_lo, c_hi, summary) in enumerate(chunk_values):
+            lo[num], hi[num] = min(lo[num], c_lo), max(hi[num], c_hi)
+            distinct[num].add(summary)
+
+    tables = []
+    for num, d in enumerate(distinct):
+        values, counts = d.result()
+        tables.append({'values': values, 'counts': counts, 'below': np.append(0, np.cumsum(counts))})
+        if d.reduced:
+            tables[-1]['range'] = (lo[num], hi[num])
+
+    approximate = [num for num, t in enumerate(tables) if 'range' in t]
+    if approximate:
+        warnings.warn('Tracks %s have more than %d distinct values and get approximate Spearman ranks. Increase '
+                      'rank_bins for exact ranks.' % (', '.join(map(str, approximate)), n_bins), RuntimeWarning)
+        state['ranks'] = tables
+        hists = [(np.zeros(t['values'].size, dtype=np.int64), np.zeros(n_bins, dtype=np.int64)) if 'range' in t
+                 else None for t in tables]
+        for chunk_hists in _map_chunks(_histogram_task, tasks, state, workers, is_path):
+            for hist, chunk_hist in zip(hists, chunk_hists):
+                if hist is not None:
+                    hist[0][:] += chunk_hist[0]
+                    hist[1][:] += chunk_hist[1]
+        for table, hist in zip(tables, hists):
+            if hist is not None:
+                table['counts'], table['below'] = hist[0], np.append(0, np.cumsum(hist[0]))
+                table['hist'], table['before'] = hist[1], np.cumsum(hist[1]) - hist[1]
+    return tables
+
+
+def _distinct_task(task, state):
+    """
+    Range and summary of the distinct values per track in a chunk
+    :param task: Chunk task
+    :type task: tuple
+    :param state: Tracks, blacklist and rank_bins
+    :type state: dict
+    :return: List with one tuple of minimum, maximum and summary (see _DistinctCounts.reduce) per track
+    """
+    result = []
+    for row in _read_chunk(task, state):
+        if row.size == 0:
+            result.append((np.inf, -np.inf, (row, np.zeros(0, dtype=np.int64), False)))
+            continue
+        values, counts = np.unique(row, return_counts=True)
+        result.append((values[0], values[-1], _DistinctCounts.reduce(values, counts, state['rank_bins'])))
+    return result
+
+
+def _histogram_task(task, state):
+    """
+    Exact counts of the frequent values and histogram of all other values for every track with approximate ranks in a
+    chunk
+    :param task: Chunk task
+    :type task: tuple
+    :param state: Tracks, blacklist, rank_bins and rank tables with the frequent values and the histogram ranges
+    :type state: dict
+    :return: List with one tuple of counts and histogram (or None) per track
+    """
+    result = []
+    for row, table in zip(_read_chunk(task, state), state['ranks']):
+        if 'range' not in table:
+            result.append(None)
+            continue
+        idx, frequent = _lookup(row, table['values'])
+        bins, _ = _histogram_position(row[~frequent], table['range'], state['rank_bins'])
+        result.append((np.bincount(idx[frequent], minlength=table['values'].size),
+                       np.bincount(bins, minlength=state['rank_bins'])))
+    return result
+
+
+def _lookup(row, values):
+    """
+    Index of every value in the sorted values, and whether it is contained
+    :param row: Values
+    :type row: numpy.array
+    :param values: Sorted values
+    :type values: numpy.array
+    :return: numpy.array with indices, boolean numpy.array
+    """
+    idx = np.searchsorted(values, row)
+    found = values[np.minimum(idx, values.size - 1)] == row if values.size else np.zeros(row.size, dtype=bool)
+    return idx, found
+
+
+def _histogram_position(row, value_range, n_bins):
+    """
+    Histogram bin of every value and relative position of the value within the bin
+    :param row: Values
+    :type row: numpy.array
+    :param value_range: Minimum and maximum of the track
+    :type value_range: tuple
+    :param n_bins: Number of histogram bins
+    :type n_bins: int
+    :return: numpy.array with bin indices, numpy.array with positions between 0 and 1
+    """
+    lo, hi = value_range
+    pos = np.clip((row - lo) * (n_bins / (hi - lo)), 0, n_bins)
+    bins = np.minimum(pos.astype(np.int64), n_bins - 1)
+    return bins, pos - bins
+
+
+def _rank(row, table):
+    """
+    Average ranks of values. The values in the table are ranked exactly; other values are ranked by linear
+    interpolation within their histogram bin
+    :param row: Values
+    :type row: numpy.array
+    :param table: Rank table of the track (see _rank_tables)
+    :type table: dict
+    :return: numpy.array with ranks
+    """
+    idx, found = _lookup(row, table['values'])
+    if 'hist' not in table:
+        return table['below'][idx] + (table['counts'][idx] + 1) / 2.
+    bins, frac = _histogram_position(row, table['range'], table['hist'].size)
+    ties = np.where(found, (np.append(table['counts'], 0)[idx] + 1) / 2., .5)
+    return table['below'][idx] + table['before'][bins] + frac * table['hist'][bins] + ties
+
+
+class _DistinctCounts:
+    """
+    Summary of the distinct values of a track and their counts, accumulated chunk by chunk. As long as there are at
+    most max_size distinct values, the counts are exact. Otherwise, the summary is reduced as by Misra and Gries:
+    the (max_size + 1)-th largest count is subtracted from all counts and values without remaining count are removed.
+    Every value that makes up more than 1 / (max_size + 1) of all values is kept in the summary. The chunk summaries
+    are collected and only merged when they are at least as large as the merged summary, such that every value takes
+    part in a logarithmic number of merges.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.reduced = False
+        self.values = np.zeros(0)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.pending_size = 0
+
+    @staticmethod
+    def reduce(values, counts, max_size):
+        """
+        Reduce distinct values and counts to at most max_size values
+        :param values: Sorted distinct values
+        :type values: numpy.array
+        :param counts: Number of occurrences per value
+        :type counts: numpy.array
+        :param max_size: Maximal number of values
+        :type max_size: int
+        :return: Tuple with sorted values, counts and whether the summary was reduced
+        """
+        if values.size <= max_size:
+            return values, counts, False
+        threshold = np.partition(counts, counts.size - max_size - 1)[counts.size - max_size - 1]
+        keep = counts > threshold
+        return values[keep], counts[keep] - threshold, True
+
+    def add(self, summary):
+        """
+        Add the summary of a chunk
+        :param summary: Tuple with sorted values, counts and whether the summary was reduced
+        :type summary: tuple
+        :return: None
+        """
+        values, counts, reduced = summary
+        self.reduced |= reduced
+        self.pending.append((values, counts))
+        self.pending_size += values.size
+        if self.pending_size >= self.values.size:
+            self._merge()
+
+    def _merge(self):
+        if not self.pending:
+            return
+        values, inverse = np.unique(np.concatenate([self.values] + [v for v, _ in self.pending]), return_inverse=True)
+        counts = np.concatenate([self.counts] + [c for _, c in self.pending])
+        counts = np.bincount(inverse.ravel(), weights=counts, minlength=values.size).astype(np.int64)
+        self.values, self.counts, reduced = self.reduce(values, counts, self.max_size)
+        self.reduced |= reduced
+        self.pending, self.pending_size = [], 0
+
+    def result(self):
+        """
+        Merged summary
+        :return: numpy.array with the sorted values, numpy.array with the counts
+        """
+        self._merge()
+        return self.values, self.counts
+
+
+def _moments_task(task, state):
+    """
+    Count, means and co-moment matrix of a chunk of all tracks. Values are replaced by their ranks if set in the state
+    :param task: Chunk task
+    :type task: tuple
+    :param state: Tracks, blacklist and rank tables
+    :type state: dict
+    :return: Tuple with count, numpy.array with means and numpy.array with co-moments, or None for an empty chunk
+    """
+    block = _read_chunk(task, state)
+    if block.shape[1] == 0:
+        return None
+    if state['ranks'] is not None:
+        for row, table in zip(block, state['ranks']):
+            row[:] = _rank(row, table)
+    mean = block.mean(axis=1)
+    block -= mean[:, np.newaxis]
+    return block.shape[1], mean, block @ block.T
+
+
+def _merge_comoments(moments, chunk):
+    """
+    Merge the co-moments of a chunk into the accumulated co-moments with the pairwise update by Chan et al.
+    :param moments: Accumulated count, means and co-moments or None
+    :type moments: tuple
+    :param chunk: Count, means and co-moments of the chunk or None
+    :type chunk: tuple
+    :return: Merged count, means and co-moments
+    """
+    if chunk is None:
+        return moments
+    if moments is None:
+        return chunk
+    n_a, mean_a, com_a = moments
+    n_b, mean_b, com_b = chunk
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, com_a + com_b + np.outer(delta, delta) * n_a * n_b / n
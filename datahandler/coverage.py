@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+"""Coverage module
+
+Pile up reads or intervals from bed (or bam) files into the concatenated genome array layout of seqDataHandler, i.e.
+one data array for the whole genome plus the dictionary chrom_start with the index positions where the chromosomes
+start. No intermediate bigwig file is needed. The intervals are parsed in chunks (without their names) and every
+chunk only adds +1 at the interval starts and -1 at the interval ends to a difference array; the coverage is its
+cumulative sum. Hence, the memory is bounded by the genome size and the chunk size, independent of the number of
+intervals. The provided
+functions are
+* pileup - Compute the coverage of a bed or bam file in the concatenated genome array layout
+"""
+import warnings
+import numpy as np
+from pybedtools import BedTool
+from datahandler import intervals, profiling
+
+
+@profiling.instrument(path_arg='bed_ref')
+def pileup(bed_ref, chroms, strand=None, five_prime=False, dtype='float32', out=None, chunk_size=2**20):
+    """
+    Compute the coverage of a bed or bam file in the concatenated genome array layout that is also returned by
+    seqDataHandler.get_values. Intervals are clipped at the chromosome ends; intervals on chromosomes that are not in
+    chroms are ignored with a warning.
+    :param bed_ref: Bed file as BedTool object, path to a bed or bam file or iterable with intervals or field lists.
+    Bam files are converted with BedTool.bam_to_bed, which requires bedtools
+    :type bed_ref: BedTool or str or iterable
+    :param chroms: Dictionary with chromosome name as key and chromosome size as value, which determines the layout
+    of the genome array (e.g. bigWigFile.chroms())
+    :type chroms: dict
+    :param strand: If '+' or '-', only intervals on this strand are counted. Intervals without strand are ignored
+    in this case. If None, all intervals are counted
+    :type strand: str
+    :param five_prime: If True, only the 5' end of every interval is counted (the start on the + strand and the last
+    position on the - strand). Intervals without strand are treated as + strand
+    :type five_prime: bool
+    :param dtype: Data type of the returned array
+    :type dtype: str or numpy.dtype
+    :param out: Preallocated output array of the size of the genome
+    :type out: numpy.array
+    :param chunk_size: Number of intervals that are parsed at a time, and number of positions per cumulative sum step
+    :type chunk_size: int
+    :return: Coverage array, dictionary with index positions where the chromosomes start
+    """
+    if strand not in (None, '+', '-'):
+        raise ValueError('strand must be None, + or -.')
+    if isinstance(bed_ref, str) and bed_ref.endswith('.bam'):
+        bed_ref = BedTool(bed_ref)
+    if isinstance(bed_ref, BedTool) and getattr(bed_ref, '_isbam', False):
+        bed_ref = bed_ref.bam_to_bed()
+
+    chrom_start, genome_size = intervals.chrom_layout(chroms)
+    if out is None:
+        out = np.empty(genome_size, dtype=dtype)
+    elif out.shape != (genome_size,):
+        raise ValueError('out must have the size of the concatenated genome (%d).' % genome_size)
+
+    # One entry more than the genome size for the ends of the intervals on the last chromosome
+    diff = np.zeros(genome_size + 1, dtype=np.int32)
+    ignored = set()
+    for table in intervals.iter_bed_chunks(bed_ref, chunk_size=chunk_size, names=False):
+        offsets = np.asarray([chrom_start.get(c, -1) for c in table.chrom_names], dtype=np.int64)[table.chrom]
+        lengths = np.asarray([chroms.get(c, 0) for c in table.chrom_names], dtype=np.int64)[table.chrom]
+        mask = offsets >= 0
+        if not np.all(mask):
+            ignored.update(table.chrom_names[c] for c in np.unique(table.chrom[~mask]).tolist())
+        if strand is not None:
+            mask &= table.strand == (1 if strand == '+' else -1)
+
+        start, end = table.start[mask], table.end[mask]
+        if five_prime:
+            start = np.where(table.strand[mask] == -1, end - 1, start)
+            end = start + 1
+        start = np.clip(start, 0, lengths[mask])
+        end = np.clip(end, 0, lengths[mask])
+        valid = start < end
+        offsets = offsets[mask][valid]
+        _add_counts(diff, offsets + start[valid], 1)
+        _add_counts(diff, offsets + end[valid], -1)
+
+    if ignored:
+        warnings.warn('Chromosomes %s are not in chroms. Their intervals are ignored.' % ', '.join(sorted(ignored)),
+                      RuntimeWarning)
+
+    diff = diff[:genome_size]
+    carry = 0
+    for c_start in range(0, genome_size, chunk_size):
+        coverage = np.cumsum(diff[c_start:c_start + chunk_size], dtype=np.int64)
+        coverage += carry
+        carry = coverage[-1]
+        out[c_start:c_start + coverage.size] = coverage
+    return out, chrom_start
+
+
+def _add_counts(diff, positions, sign):
+    """
+    Add the number of occurrences of every position to the difference array. The positions are counted with
+    numpy.bincount over the range they span, which is compact for sorted bed files. For widely scattered positions,
+    the distinct positions and their counts are computed by sorting instead, such that no array of the size of the
+    genome is allocated per chunk.
+    :param diff: Difference array
+    :type diff: numpy.array
+    :param positions: Positions in the difference array
+    :type positions: numpy.array
+    :param sign: 1 for interval starts, -1 for interval ends
+    :type sign: int
+    :return: None
+    """
+    if positions.size == 0:
+        return
+    lo, hi = int(positions.min()), int(positions.max()) + 1
+    if hi - lo <= 4 * positions.size:
+        counts = np.bincount(positions - lo, minlength=hi - lo)
+        diff[lo:hi] += (sign * counts).astype(diff.dtype, copy=False)
+    else:
+        unique, counts = np.unique(positions, return_counts=True)
+        diff[unique] += (sign * counts).astype(diff.dtype, copy=False)
@@ -0,0 +1,377 @@
+#!/usr/bin/python3
+"""Indexed fasta module
+
+Random access to fasta files without parsing them into SeqRecord objects. The sequence is served from a memory map
+of the file through a faidx index (compatible with samtools faidx), or optionally from a compact 2-bit packed cache
+that keeps lower case (soft-masked) bases in a bit mask. All accessors return numpy.uint8 arrays with the ASCII codes
+of the bases, such that the memory use is proportional to the accessed regions rather than to the genome size. The
+provided functions are
+* IndexedFasta - Random access to a fasta file
+* build_index - Create the faidx index of a fasta file
+* read_index - Read a faidx index
+* pack_two_bit - Create the 2-bit packed cache of a fasta file
+"""
+import os
+from collections import OrderedDict
+import numpy as np
+from datahandler import intervals, segments
+
+# 2-bit encoding: A: 0, C: 1, G: 2, T: 3. All other bases are stored as N blocks
+_TWO_BIT_CODE = np.full(256, -1, dtype=np.int8)
+for _num, _base in enumerate('ACGT'):
+    _TWO_BIT_CODE[ord(_base)] = _num
+    _TWO_BIT_CODE[ord(_base.lower())] = _num
+_TWO_BIT_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+# Packed byte -> its four bases, such that a packed slice is decoded with one lookup per byte
+_TWO_BIT_DECODE = _TWO_BIT_BASES[(np.arange(256, dtype=np.uint8)[:, np.newaxis] >> np.array([6, 4, 2, 0],
+                                                                                            dtype=np.uint8)) & 3]
+_IS_LOWER = np.zeros(256, dtype=bool)
+_IS_LOWER[ord('a'):ord('z') + 1] = True
+# Mask byte -> the 0x20 bit of its eight bases, which converts upper case ASCII letters to lower case
+_MASK_DECODE = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1) << 5
+
+
+def build_index(path, index_path=None):
+    """
+    Create the faidx index of a fasta file. Every line of a record must have the same length except the last one.
+    :param path: Path to the fasta file
+    :type path: str
+    :param index_path: Path to the index file. Default is path + '.fai'
+    :type index_path: str
+    :return: Path to the index file
+    """
+    index_path = path + '.fai' if index_path is None else index_path
+    entries = []
+    with open(path, 'rb') as fasta:
+        offset = 0
+        record = None
+        for line in fasta:
+            line_len = len(line)
+            offset += line_len
+            if line.startswith(b'>'):
+                if record is not None:
+                    entries.append(record[:5])
+                name = line[1:].split()[0].decode() if line[1:].strip() else ''
+                # name, length, offset, line bases, line width, whether a shorter (last) line was found
+                record = [name, 0, offset, 0, 0, False]
+                continue
+            bases = len(line.rstrip(b'\r\n'))
+            if record is None or bases == 0:
+                continue
+            if record[3] == 0:
+                record[3], record[4] = bases, line_len
+            elif record[5] or bases > record[3] or (bases == record[3] and line_len != record[4]
+                                                    and line.endswith(b'\n')):
+                raise ValueError('Record %s in %s has lines of different length.' % (record[0], path))
+            record[5] = bases < record[3]
+            record[1] += bases
+        if record is not None:
+            entries.append(record[:5])
+
+    with open(index_path, 'w') as index:
+        for name, length, offset, line_bases, line_width in entries:
+            index.write('%s\t%d\t%d\t%d\t%d\n' % (name, length, offset, line_bases, line_width))
+    return index_path
+
+
+def read_index(index_path):
+    """
+    Read a faidx index
+    :param index_path: Path to the index file
+    :type index_path: str
+    :return: OrderedDict with chromosome name as key and tuple of length, offset, line bases and line width as value
+    """
+    index = OrderedDict()
+    with open(index_path) as index_file:
+        for line in index_file:
+            fields = line.rstrip('\n').split('\t')
+            index[fields[0]] = tuple(int(f) for f in fields[1:5])
+    return index
+
+
+def pack_two_bit(fasta, cache_path):
+    """
+    Create the 2-bit packed cache of a fasta file. The packed bases are stored in cache_path + '.npy', the bit mask
+    of the lower case bases in cache_path + '.mask.npy' (empty if there are none) and the layout (chromosome names,
+    lengths, offsets and N blocks) in cache_path + '.npz'.
+    :param fasta: Indexed fasta file
+    :type fasta: IndexedFasta
+    :param cache_path: Path prefix of the cache files
+    :type cache_path: str
+    :return: None
+    """
+    chroms = fasta.chroms()
+    lengths = np.asarray(list(chroms.values()), dtype=np.int64)
+    packed_offsets = np.zeros(lengths.size + 1, dtype=np.int64)
+    np.cumsum((lengths + 3) // 4, out=packed_offsets[1:])
+    mask_offsets = np.zeros(lengths.size + 1, dtype=np.int64)
+    np.cumsum((lengths + 7) // 8, out=mask_offsets[1:])
+    chrom_start, _ = intervals.chrom_layout(chroms)
+    is_soft_masked = any(np.any(_IS_LOWER[fasta.fetch(chrom)]) for chrom in chroms)
+
+    tmp_path = '%s.%d.tmp.npy' % (cache_path, os.getpid())
+    tmp_mask_path = '%s.mask.%d.tmp.npy' % (cache_path, os.getpid())
+    packed = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(int(packed_offsets[-1]),))
+    mask = np.lib.format.open_memmap(tmp_mask_path, mode='w+', dtype=np.uint8,
+                                     shape=(int(mask_offsets[-1]) if is_soft_masked else 0,))
+    n_starts, n_ends = [], []
+    for num, chrom in enumerate(chroms):
+        seq = fasta.fetch(chrom)
+        if is_soft_masked:
+            mask[mask_offsets[num]:mask_offsets[num + 1]] = np.packbits(_IS_LOWER[seq])
+        codes = _TWO_BIT_CODE[seq]
+        is_n = np.concatenate([[False], codes < 0, [False]])
+        change = np.flatnonzero(is_n[1:] != is_n[:-1])
+        n_starts.append(change[::2] + chrom_start[chrom])
+        n_ends.append(change[1::2] + chrom_start[chrom])
+
+        codes = np.maximum(codes, 0).astype(np.uint8)
+        codes = np.concatenate([codes, np.zeros(-codes.size % 4, dtype=np.uint8)]).reshape(-1, 4)
+        packed[packed_offsets[num]:packed_offsets[num + 1]] = (
+            (codes[:, 0] << 6) | (codes[:, 1] << 4) | (codes[:, 2] << 2) | codes[:, 3])
+    packed.flush()
+    mask.flush()
+    del packed, mask
+    os.replace(tmp_path, cache_path + '.npy')
+    os.replace(tmp_mask_path, cache_path + '.mask.npy')
+    np.savez(
+        cache_path + '.npz',
+        names=np.asarray(list(chroms.keys()), dtype=str),
+        lengths=lengths,
+        packed_offsets=packed_offsets,
+        mask_offsets=mask_offsets,
+        n_starts=np.concatenate(n_starts).astype(np.int64) if n_starts else np.zeros(0, dtype=np.int64),
+        n_ends=np.concatenate(n_ends).astype(np.int64) if n_ends else np.zeros(0, dtype=np.int64)
+    )
+
+
+class IndexedFasta:
+    """
+    Random access to a fasta file. The faidx index is created if it does not exist or is older than the fasta file.
+    If two_bit is set, the sequence is served from a 2-bit packed cache (created if necessary), which needs a quarter
+    of the space of the fasta file, plus an eighth for the bit mask of soft-masked genomes. The case of the bases is
+    preserved; bases other than ACGT are returned as N (or n).
+    Iterating over an IndexedFasta object yields tuples with chromosome name and sequence, which can be passed to
+    preprocessing.cancel_noise_cpd.
+    """
+    def __init__(self, path, two_bit=False, index_path=None, two_bit_path=None):
+        """
+        :param path: Path to the fasta file
+        :type path: str
+        :param two_bit: If True, use the 2-bit packed cache
+        :type two_bit: bool
+        :param index_path: Path to the faidx index. Default is path + '.fai'
+        :type index_path: str
+        :param two_bit_path: Path prefix of the 2-bit cache files. Default is path + '.2bit'
+        :type two_bit_path: str
+        """
+        self.path = path
+        self.index_path = path + '.fai' if index_path is None else index_path
+        if not _is_up_to_date(self.index_path, path):
+            build_index(path, self.index_path)
+        self.index = read_index(self.index_path)
+        self._chrom_idx = {chrom: num for num, chrom in enumerate(self.index)}
+        self._layout = np.asarray(list(self.index.values()), dtype=np.int64).reshape(-1, 4)
+        self._data = np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) > 0 else np.zeros(0, np.uint8)
+
+        self.two_bit = False
+        if two_bit:
+            two_bit_path = path + '.2bit' if two_bit_path is None else two_bit_path
+            # Caches of older versions have no bit mask, as they did not preserve the case of the bases
+            if not all(_is_up_to_date(two_bit_path + ext, path) for ext in ('.npy', '.mask.npy', '.npz')):
+                pack_two_bit(self, two_bit_path)
+            self.two_bit = True
+            layout = np.load(two_bit_path + '.npz')
+            self._packed = np.load(two_bit_path + '.npy', mmap_mode='r')
+            self._packed_offsets = layout['packed_offsets']
+            self._mask = np.load(two_bit_path + '.mask.npy', mmap_mode='r')
+            self._mask_offsets = layout['mask_offsets']
+            self._n_starts, self._n_ends = layout['n_starts'], layout['n_ends']
+            self._genome_offsets = np.zeros(self._layout.shape[0] + 1, dtype=np.int64)
+            np.cumsum(self._layout[:, 0], out=self._genome_offsets[1:])
+
+    def chroms(self):
+        """
+        Chromosome sizes
+        :return: Dictionary with chromosome name as key and chromosome size as value
+        """
+        return OrderedDict((chrom, entry[0]) for chrom, entry in self.index.items())
+
+    def __iter__(self):
+        for chrom in self.index:
+            yield chrom, self.fetch(chrom)
+
+    def __len__(self):
+        return len(self.index)
+
+    def fetch(self, chrom, start=0, end=None):
+        """
+        Retrieve the sequence of a chromosome or region
+        :param chrom: Chromosome name
+        :type chrom: str
+        :param start: Start position (0-based)
+        :type start: int
+        :param end: End position (exclusive). If None, the chromosome end is used
+        :type end: int
+        :return: numpy.array with dtype uint8. Regions within one line of the fasta file are returned as read-only view
+        """
+        length, offset, line_bases, line_width = self.index[chrom]
+        end = length if end is None else min(end, length)
+        start = max(start, 0)
+        if end <= start:
+            return np.zeros(0, dtype=np.uint8)
+        if self.two_bit:
+            return self._fetch_two_bit(np.full(1, self._chrom_idx[chrom]), np.asarray([start]), np.asarray([end]),
+                                       end - start)
+
+        first_line, last_line = start // line_bases, (end - 1) // line_bases
+        line_offset = start - first_line * line_bases
+        block_start = offset + first_line * line_width
+        if first_line == last_line:
+            return self._data[block_start + line_offset:block_start + line_offset + end - start]
+
+        n_lines = last_line - first_line + 1
+        block = self._data[block_start:block_start + n_lines * line_width]
+        if block.size < n_lines * line_width:
+            # The last line of the file has no line break
+            block = np.concatenate([block, np.zeros(n_lines * line_width - block.size, dtype=np.uint8)])
+        return block.reshape(n_lines, line_width)[:, :line_bases].reshape(-1)[line_offset:line_offset + end - start]
+
+    def fetch_intervals(self, bed_ref, chunk_size=2**24):
+        """
+        Retrieve the sequences of many intervals at once
+        :param bed_ref: Intervals as bed file or IntervalTable
+        :type bed_ref: BedTool or str or IntervalTable
+        :param chunk_size: Approximate number of bases that are gathered at once
+        :type chunk_size: int
+        :return: Segments container with the sequences (numpy.uint8) of all intervals
+        """
+        table = bed_ref if isinstance(bed_ref, intervals.IntervalTable) else intervals.parse_bed(bed_ref)
+        chrom_idx = np.asarray([self._chrom_idx[c] for c in table.chrom_names], dtype=np.int64)
+        chrom_idx = chrom_idx[table.chrom] if chrom_idx.size > 0 else np.zeros(0, dtype=np.int64)
+        lengths = self._layout[chrom_idx, 0]
+        starts = np.clip(table.start, 0, lengths)
+        ends = np.clip(table.end, starts, lengths)
+
+        offsets = np.zeros(starts.size + 1, dtype=np.int64)
+        np.cumsum(ends - starts, out=offsets[1:])
+        values = np.empty(offsets[-1], dtype=np.uint8)
+        bounds = np.append(np.unique(np.searchsorted(offsets, np.arange(0, offsets[-1], chunk_size), side='right') - 1),
+                           starts.size)
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            if first < last:
+                values[offsets[first]:offsets[last]] = self._fetch_positions(
+                    chrom_idx[first:last], starts[first:last], ends[first:last], offsets[last] - offsets[first])
+
+        names = None if table.names is None else [table.names[n] if n >= 0 else None for n in table.name.tolist()]
+        return segments.Segments(values=values, offsets=offsets, names=names)
+
+    def _fetch_positions(self, chrom_idx, starts, ends, total):
+        """
+        Gather the bases of several regions through vectorised position arithmetic
+        :param chrom_idx: Chromosome index per region
+        :type chrom_idx: numpy.array
+        :param starts: Start position per region
+        :type starts: numpy.array
+        :param ends: End position per region
+        :type ends: numpy.array
+        :param total: Total number of bases
+        :type total: int
+        :return: numpy.array with dtype uint8
+        """
+        if self.two_bit:
+            return self._fetch_two_bit(chrom_idx, starts, ends, total)
+        lengths = ends - starts
+        region_offsets = np.cumsum(lengths) - lengths
+        pos = np.arange(total, dtype=np.int64) - np.repeat(region_offsets - starts, lengths)
+        chrom_idx = np.repeat(chrom_idx, lengths)
+        _, offset, line_bases, line_width = self._layout[chrom_idx].T
+        return self._data[offset + (pos // line_bases) * line_width + pos % line_bases]
+
+    def _fetch_two_bit(self, chrom_idx, starts, ends, total):
+        """
+        Gather the bases of several regions from the 2-bit packed cache. The packed bytes of every region are decoded
+        with a lookup table into four bases per byte, and the surplus bases at the region boundaries are dropped,
+        such that the temporary arrays need a few bytes per base. A single region is decoded from a slice of the cache.
+        The lower case bases are restored from the bit mask in the same way, with eight bases per byte
+        :param chrom_idx: Chromosome index per region
+        :type chrom_idx: numpy.array
+        :param starts: Start position per region
+        :type starts: numpy.array
+        :param ends: End position per region
+        :type ends: numpy.array
+        :param total: Total number of bases
+        :type total: int
+        :return: numpy.array with dtype uint8
+        """
+        bases = _decode_regions(self._packed, self._packed_offsets, _TWO_BIT_DECODE, chrom_idx, starts, ends, total)
+        lengths = ends - starts
+
+        # N blocks that overlap with the regions
+        abs_start = self._genome_offsets[chrom_idx] + starts
+        first = np.searchsorted(self._n_ends, abs_start, side='right')
+        n_blocks = np.maximum(np.searchsorted(self._n_starts, abs_start + lengths, side='left') - first, 0)
+        if n_blocks.sum() > 0:
+            region = np.repeat(np.arange(starts.size), n_blocks)
+            block = first[region] + np.arange(region.size) - np.repeat(np.cumsum(n_blocks) - n_blocks, n_blocks)
+            out_start = np.cumsum(lengths) - lengths - abs_start
+            n_start = np.maximum(self._n_starts[block], abs_start[region]) + out_start[region]
+            n_end = np.minimum(self._n_ends[block], abs_start[region] + lengths[region]) + out_start[region]
+            for n_s, n_e in zip(n_start.tolist(), n_end.tolist()):
+                bases[n_s:n_e] = ord('N')
+        if self._mask.size > 0:
+            bases |= _decode_regions(self._mask, self._mask_offsets, _MASK_DECODE, chrom_idx, starts, ends, total)
+        return bases
+
+
+def _decode_regions(packed_data, packed_offsets, decode, chrom_idx, starts, ends, total):
+    """
+    Decode the bases of several regions from packed bytes with a fixed number of bases per byte
+    :param packed_data: Packed bytes of all chromosomes
+    :type packed_data: numpy.array
+    :param packed_offsets: Offset of every chromosome in packed_data (number of chromosomes + 1 entries)
+    :type packed_offsets: numpy.array
+    :param decode: Lookup table from byte to its bases, with shape (256, bases per byte)
+    :type decode: numpy.array
+    :param chrom_idx: Chromosome index per region
+    :type chrom_idx: numpy.array
+    :param starts: Start position per region
+    :type starts: numpy.array
+    :param ends: End position per region
+    :type ends: numpy.array
+    :param total: Total number of bases
+    :type total: int
+    :return: numpy.array with the decoded bases
+    """
+    per_byte = decode.shape[1]
+    byte_start = packed_offsets[chrom_idx] + starts // per_byte
+    n_bytes = packed_offsets[chrom_idx] + (ends + per_byte - 1) // per_byte - byte_start
+    if starts.size == 1:
+        packed = packed_data[byte_start[0]:byte_start[0] + n_bytes[0]]
+    else:
+        byte_offsets = np.cumsum(n_bytes) - n_bytes
+        packed = packed_data[np.arange(n_bytes.sum(), dtype=np.int64) - np.repeat(byte_offsets - byte_start, n_bytes)]
+    decoded = decode[packed].reshape(-1)
+    if starts.size == 1:
+        return decoded[starts[0] % per_byte:starts[0] % per_byte + total]
+    # Keep the bases from the start of every region to its end, marked in a difference array
+    # (empty regions are skipped, all others have distinct starts)
+    lengths = ends - starts
+    non_empty = lengths > 0
+    keep_start = (per_byte * byte_offsets + starts % per_byte)[non_empty]
+    keep = np.zeros(decoded.size + 1, dtype=np.int8)
+    keep[keep_start] = 1
+    keep[keep_start + lengths[non_empty]] -= 1
+    return decoded[np.cumsum(keep[:-1], dtype=np.int8).view(bool)]
+
+
+def _is_up_to_date(path, source):
+    """
+    Check whether a derived file exists and is at least as new as its source
+    :param path: Path to the derived file
+    :type path: str
+    :param source: Path to the source file
+    :type source: str
+    :return: True if the derived file is up to date
+    """
+    return os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(source)
@@ -0,0 +1,474 @@
+#!/usr/bin/python3
+"""Interval module
+
+Array-backed representation of genomic intervals. A bed file is parsed once into an IntervalTable, which stores
+every column as numpy array and can be reused for any number of data arrays. The provided functions are
+* IntervalTable - Parsed intervals with chromosome index, start, end, strand and name index per interval
+* parse_bed - Parse a bed file into an IntervalTable
+* iter_bed_chunks - Parse a bed file into a sequence of IntervalTables with a bounded number of intervals each
+* parse_gff - Parse a gff file into an IntervalTable, optionally cached on disk
+* absolute_bounds - Compute the interval boundaries in the concatenated genome array
+* chrom_layout - Compute the starting indices of the chromosomes in the concatenated genome array
+* chrom_sizes - Compute the chromosome sizes from the starting indices in the concatenated genome array
+* IntervalIndex - Sorted interval boundaries in the concatenated genome array for vectorised overlap queries
+* build_index - Build an IntervalIndex from an IntervalTable
+* count_overlaps - Count the intervals that overlap with query positions or query intervals
+* find_overlaps - Find the intervals that overlap with query positions or query intervals
+* nearest - Find the nearest interval on the same chromosome for query positions
+* save_index - Save an IntervalIndex as .npz file
+* load_index - Load an IntervalIndex that was saved with save_index
+"""
+import os
+import hashlib
+import itertools
+from collections import namedtuple
+import numpy as np
+
+IntervalTable = namedtuple('IntervalTable', ['chrom', 'start', 'end', 'strand', 'name', 'chrom_names', 'names'])
+IntervalTable.__doc__ = """
+Parsed intervals. chrom (int32), start, end (int64), strand (int8; 1: '+', -1: '-', 0: unknown) and name (int64)
+are arrays with one entry per interval. chrom and name are indices into the lists chrom_names and names. names is None
+if the bed file does not provide annotation names.
+"""
+_STRANDS = {'+': 1, '-': -1}
+
+IntervalIndex = namedtuple('IntervalIndex', ['start', 'end', 'max_end', 'max_id', 'id', 'sorted_end', 'chrom_bounds'])
+IntervalIndex.__doc__ = """
+Interval boundaries in the concatenated genome array, sorted by start. start, end (int64) and id (the row of the
+interval in the IntervalTable) have one entry per interval. max_end is the running maximum of end and max_id the id
+of the interval that reaches max_end, which bound the candidates of an overlap query. sorted_end contains the sorted
+ends for counting, and chrom_bounds the sorted starting indices of the chromosomes plus the genome size.
+"""
+
+
+def _iter_fields(bed_ref):
+    """
+    Iterate over the fields of all intervals
+    :param bed_ref: Bed file as BedTool object, path to a bed file or iterable with intervals or field lists
+    :type bed_ref: BedTool or str or iterable
+    :return: Generator with the list of fields per interval
+    """
+    if isinstance(bed_ref, str):
+        with open(bed_ref) as bed_file:
+            for line in bed_file:
+                if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                    continue
+                yield line.rstrip('\n').split('\t')
+        return
+
+    for interval in bed_ref:
+        if hasattr(interval, 'fields'):
+            yield interval.fields
+        elif isinstance(interval, str):
+            yield interval.rstrip('\n').split('\t')
+        else:
+            yield list(interval)
+
+
+def _parse_fields(fields_iter, chrom_idx, name_idx, has_names=None):
+    """
+    Parse the fields of bed intervals into an IntervalTable
+    :param fields_iter: Iterable with the list of fields per interval
+    :type fields_iter: iterable
+    :param chrom_idx: Dictionary that maps chromosome names to indices. New chromosomes are added
+    :type chrom_idx: dict
+    :param name_idx: Dictionary that maps annotation names to indices. New names are added
+    :type name_idx: dict
+    :param has_names: Whether the bed file provides annotation names. If None, this is determined by the first interval
+    :type has_names: bool
+    :return: IntervalTable, has_names
+    """
+    chrom, start, end, strand, name = [], [], [], [], []
+    for fields in fields_iter:
+        # index 0: Chromosome, 1: start, 2: end, 3: name, 5: strand
+        if has_names is None:
+            has_names = len(fields) >= 4
+        chrom.append(chrom_idx.setdefault(fields[0], len(chrom_idx)))
+        start.append(int(fields[1]))
+        end.append(int(fields[2]))
+        strand.append(_STRANDS.get(fields[5], 0) if len(fields) > 5 else 0)
+        name.append(name_idx.setdefault(fields[3], len(name_idx)) if has_names and len(fields) >= 4 else -1)
+
+    table = IntervalTable(
+        chrom=np.asarray(chrom, dtype=np.int32),
+        start=np.asarray(start, dtype=np.int64),
+        end=np.asarray(end, dtype=np.int64),
+        strand=np.asarray(strand, dtype=np.int8),
+        name=np.asarray(name, dtype=np.int64),
+        chrom_names=list(chrom_idx.keys()),
+        names=list(name_idx.keys()) if has_names else None
+    )
+    return table, has_names
+
+
+def parse_bed(bed_ref):
+    """
+    Parse a bed file into an IntervalTable
+    :param bed_ref: Bed file as BedTool object, path to a bed file or iterable with intervals or field lists
+    :type bed_ref: BedTool or str or iterable
+    :return: IntervalTable
+    """
+    if isinstance(bed_ref, str) and not os.path.isfile(bed_ref):
+        raise FileNotFoundError('Bed file %s does not exist.' % bed_ref)
+    table, _ = _parse_fields(_iter_fields(bed_ref), {}, {})
+    return table
+
+
+def iter_bed_chunks(bed_ref, chunk_size=2**20, names=True):
+    """
+    Parse a bed file into a sequence of IntervalTables with at most chunk_size intervals each, such that large files
+    can be processed without holding all intervals in memory. The chromosome and name indices are consistent across
+    the chunks; the chrom_names and names lists of a chunk contain all names seen so far.
+    :param bed_ref: Bed file as BedTool object, path to a bed file or iterable with intervals or field lists
+    :type bed_ref: BedTool or str or iterable
+    :param chunk_size: Maximal number of intervals per chunk
+    :type chunk_size: int
+    :param names: If False, the annotation names are not parsed (names is None and all name indices are -1). As the
+    name index grows with every new name, this is needed to bound the memory for files with one name per interval,
+    e.g. reads converted from bam files
+    :type names: bool
+    :return: Generator with IntervalTables
+    """
+    if isinstance(bed_ref, str) and not os.path.isfile(bed_ref):
+        raise FileNotFoundError('Bed file %s does not exist.' % bed_ref)
+
+    chrom_idx, name_idx = {}, {}
+    has_names = None if names else False
+    fields_iter = _iter_fields(bed_ref)
+    while True:
+        table, has_names = _parse_fields(itertools.islice(fields_iter, chunk_size), chrom_idx, name_idx, has_names)
+        if table.chrom.size == 0:
+            return
+        yield table
+
+
+def parse_gff(gff_path, gff_source_type=None, cache_dir=None):
+    """
+    Parse a gff file into an IntervalTable in a single pass. The start positions are converted to 0-based
+    coordinates and the ID attribute (or the Name attribute if there is no ID) is used as name. If cache_dir is set,
+    the table is stored as .npz file and reused as long as the modification time of the gff file does not change.
+    :param gff_path: Path to the gff file
+    :type gff_path: str
+    :param gff_source_type: List with (source, type) tuples for which the gff file is filtered. If None, all features
+    are kept
+    :type gff_source_type: list(tuple(str))
+    :param cache_dir: Directory where the parsed table is cached. If None, the table is not cached
+    :type cache_dir: str
+    :return: IntervalTable
+    """
+    source_type = None if gff_source_type is None else set(tuple(st) for st in gff_source_type)
+    cache_path = None
+    if cache_dir is not None:
+        key = '%s|%s' % (os.path.realpath(gff_path), sorted(source_type) if source_type is not None else None)
+        cache_path = os.path.join(cache_dir, 'gff_%s.npz' % hashlib.sha1(key.encode()).hexdigest()[:16])
+        table = _load_table(cache_path, gff_path)
+        if table is not None:
+            return table
+
+    chrom_idx, name_idx = {}, {}
+    chrom, start, end, strand, name = [], [], [], [], []
+    with open(gff_path) as gff:
+        for line in gff:
+            if line.startswith('##FASTA'):
+                break
+            if line.startswith('#') or not line.strip():
+                continue
+            # index 0: seqid, 1: source, 2: type, 3: start (1-based), 4: end, 6: strand, 8: attributes
+            fields = line.rstrip('\n').split('\t')
+            if source_type is not None and (fields[1], fields[2]) not in source_type:
+                continue
+            attributes = dict(a.split('=', 1) for a in fields[8].split(';') if '=' in a) if len(fields) > 8 else {}
+            feature_name = attributes.get('ID', attributes.get('Name'))
+            chrom.append(chrom_idx.setdefault(fields[0], len(chrom_idx)))
+            start.append(int(fields[3]) - 1)
+            end.append(int(fields[4]))
+            strand.append(_STRANDS.get(fields[6], 0))
+            name.append(name_idx.setdefault(feature_name, len(name_idx)) if feature_name is not None else -1)
+
+    table = IntervalTable(
+        chrom=np.asarray(chrom, dtype=np.int32),
+        start=np.asarray(start, dtype=np.int64),
+        end=np.asarray(end, dtype=np.int64),
+        strand=np.asarray(strand, dtype=np.int8),
+        name=np.asarray(name, dtype=np.int64),
+        chrom_names=list(chrom_idx.keys()),
+        names=list(name_idx.keys())
+    )
+    if cache_path is not None:
+        _save_table(cache_path, table, gff_path)
+    return table
+
+
+def _save_table(path, table, source):
+    """
+    Save an IntervalTable as .npz file together with the modification time of its source file
+    :param path: Path to the .npz file
+    :type path: str
+    :param table: Parsed intervals
+    :type table: IntervalTable
+    :param source: Path to the file from which the table was parsed
+    :type source: str
+    :return: None
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = '%s.%d.tmp.npz' % (path[:-len('.npz')], os.getpid())
+    np.savez(
+        tmp_path,
+        chrom=table.chrom, start=table.start, end=table.end, strand=table.strand, name=table.name,
+        chrom_names=np.asarray(table.chrom_names, dtype=str),
+        names=np.asarray(table.names if table.names is not None else [], dtype=str),
+        has_names=table.names is not None,
+        mtime_ns=os.stat(source).st_mtime_ns
+    )
+    os.replace(tmp_path, path)
+
+
+def _load_table(path, source):
+    """
+    Load an IntervalTable that was saved with _save_table if it is up to date
+    :param path: Path to the .npz file
+    :type path: str
+    :param source: Path to the file from which the table was parsed
+    :type source: str
+    :return: IntervalTable or None if there is no valid cached table
+    """
+    try:
+        cached = np.load(path)
+    except (OSError, ValueError):
+        return None
+    with cached:
+        if int(cached['mtime_ns']) != os.stat(source).st_mtime_ns:
+            return None
+        return IntervalTable(
+            chrom=cached['chrom'], start=cached['start'], end=cached['end'], strand=cached['strand'],
+            name=cached['name'], chrom_names=cached['chrom_names'].tolist(),
+            names=cached['names'].tolist() if bool(cached['has_names']) else None
+        )
+
+
+def absolute_bounds(table, chrom_start, bin_size=None):
+    """
+    Compute the interval boundaries in the concatenated genome array
+    :param table: Parsed intervals
+    :type table: IntervalTable
+    :param chrom_start: Dictionary with index positions where the chromosomes start
+    :type chrom_start: dict
+    :param bin_size: If set, the boundaries are computed for a binned genome array (see chrom_layout). Every interval
+    covers all bins it overlaps, but at least one bin
+    :type bin_size: int
+    :return: numpy.array with absolute start indices, numpy.array with absolute end indices
+    """
+    start, end = table.start, table.end
+    if bin_size is not None:
+        start = start // bin_size
+        end = np.maximum(-(-end // bin_size), start + 1)
+    offsets = np.asarray([chrom_start[c] for c in table.chrom_names], dtype=np.int64)
+    if offsets.size == 0:
+        return start.copy(), end.copy()
+    return offsets[table.chrom] + start, offsets[table.chrom] + end
+
+
+def chrom_layout(chroms, bin_size=None):
+    """
+    Compute the starting indices of the chromosomes in the concatenated genome array. In a binned genome array, every
+    chromosome is split into bins of bin_size bases (the last bin of a chromosome can be shorter), such that position
+    p of a chromosome is found at index chrom_start[chrom] + p // bin_size.
+    :param chroms: Dictionary with chromosome name as key and chromosome size as value
+    :type chroms: dict
+    :param bin_size: Number of bases per bin. If None, the layout has base-pair resolution
+    :type bin_size: int
+    :return: Dictionary with starting indices for chromosomes, size of the concatenated genome
+    """
+    counter = 0
+    chrom_start = {}
+    for chrom, length in chroms.items():
+        chrom_start[chrom] = counter
+        counter += length if bin_size is None else -(-length // bin_size)
+    return chrom_start, counter
+
+
+def chrom_sizes(chrom_start, genome_size):
+    """
+    Compute the chromosome sizes from the starting indices in the concatenated genome array
+    :param chrom_start: Dictionary with starting indices for chromosomes
+    :type chrom_start: dict
+    :param genome_size: Size of the concatenated genome
+    :type genome_size: int
+    :return: Dictionary with chromosome name as key and chromosome size as value
+    """
+    chroms = sorted(chrom_start.items(), key=lambda c: c[1])
+    ends = [start for _, start in chroms[1:]] + [genome_size]
+    return {chrom: end - start for (chrom, start), end in zip(chroms, ends)}
+
+
+def build_index(table, chrom_start, bin_size=None, genome_size=None):
+    """
+    Build an IntervalIndex from an IntervalTable, with the intervals mapped into the concatenated genome array (e.g.
+    the coordinates of the peaks returned by preprocessing.peak_detect_smooth)
+    :param table: Parsed intervals
+    :type table: IntervalTable
+    :param chrom_start: Dictionary with index positions where the chromosomes start
+    :type chrom_start: dict
+    :param bin_size: If set, the index is built for a binned genome array (see chrom_layout)
+    :type bin_size: int
+    :param genome_size: Size of the concatenated genome array. Only needed to find the nearest interval on the last
+    chromosome; if None, the last chromosome is assumed to end after the last interval
+    :type genome_size: int
+    :return: IntervalIndex
+    """
+    start, end = absolute_bounds(table, chrom_start, bin_size=bin_size)
+    order = np.argsort(start, kind='stable')
+    start, end = start[order], end[order]
+    max_end = np.maximum.accumulate(end) if end.size > 0 else end.copy()
+    # Position of the interval that reaches the running maximum: the last position where end equals max_end
+    reaches = np.flatnonzero(end == max_end)
+    max_pos = reaches[np.searchsorted(reaches, np.arange(end.size), side='right') - 1]
+    bounds = sorted(chrom_start.values())
+    if genome_size is None:
+        genome_size = max(int(max_end[-1]) if end.size > 0 else 0, bounds[-1] if bounds else 0)
+    return IntervalIndex(
+        start=start,
+        end=end,
+        max_end=max_end,
+        max_id=order[max_pos],
+        id=order,
+        sorted_end=np.sort(end),
+        chrom_bounds=np.asarray(bounds + [genome_size], dtype=np.int64)
+    )
+
+
+def _query_bounds(start, end):
+    """
+    Convert query positions or intervals into half-open query intervals
+    :param start: Query positions or query interval starts
+    :type start: numpy.array or int
+    :param end: Query interval ends or None for positions
+    :type end: numpy.array or int
+    :return: numpy.array with query starts, numpy.array with query ends
+    """
+    start = np.atleast_1d(np.asarray(start, dtype=np.int64))
+    end = start + 1 if end is None else np.atleast_1d(np.asarray(end, dtype=np.int64))
+    if start.shape != end.shape:
+        raise ValueError('Query starts and ends must have the same shape.')
+    return start, end
+
+
+def count_overlaps(index, start, end=None):
+    """
+    Count the intervals that overlap with query positions or query intervals. An interval [s, e) overlaps with the
+    query [qs, qe) if s < qe and e > qs, hence the count is the number of intervals with s < qe minus the number of
+    intervals with e <= qs, which are two binary searches per query.
+    :param index: Interval index
+    :type index: IntervalIndex
+    :param start: Query positions or query interval starts in the concatenated genome array
+    :type start: numpy.array or int
+    :param end: Query interval ends (exclusive). If None, start contains positions
+    :type end: numpy.array or int
+    :return: numpy.array with the number of overlapping intervals per query
+    """
+    start, end = _query_bounds(start, end)
+    return np.searchsorted(index.start, end, side='left') - np.searchsorted(index.sorted_end, start, side='right')
+
+
+def find_overlaps(index, start, end=None, chunk_size=2**20):
+    """
+    Find the intervals that overlap with query positions or query intervals. The candidates of a query are the
+    intervals with start before the query end whose running maximum of the ends lies after the query start.
+    :param index: Interval index
+    :type index: IntervalIndex
+    :param start: Query positions or query interval starts in the concatenated genome array
+    :type start: numpy.array or int
+    :param end: Query interval ends (exclusive). If None, start contains positions
+    :type end: numpy.array or int
+    :param chunk_size: Maximal number of candidate pairs that are processed at once
+    :type chunk_size: int
+    :return: numpy.array with query indices, numpy.array with the ids of the overlapping intervals (rows in the
+    IntervalTable). The pairs are sorted by query and by interval start
+    """
+    start, end = _query_bounds(start, end)
+    lo = np.searchsorted(index.max_end, start, side='right')
+    hi = np.maximum(np.searchsorted(index.start, end, side='left'), lo)
+    n_cand = hi - lo
+    cum = np.cumsum(n_cand)
+    query_idx, feature_idx = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    first = 0
+    while first < start.size:
+        # Queries whose candidates fit into one chunk, but at least one query
+        last = max(int(np.searchsorted(cum, (cum[first - 1] if first > 0 else 0) + chunk_size, side='right')),
+                   first + 1)
+        counts = n_cand[first:last]
+        queries = np.repeat(np.arange(first, last, dtype=np.int64), counts)
+        # Position of every candidate in the sorted index: lo of its query plus its rank within the query
+        ranks = np.arange(queries.size, dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = lo[queries] + ranks
+        hit = index.end[candidates] > start[queries]
+        query_idx.append(queries[hit])
+        feature_idx.append(index.id[candidates[hit]])
+        first = last
+    return np.concatenate(query_idx), np.concatenate(feature_idx)
+
+
+def nearest(index, positions):
+    """
+    Find the nearest interval on the same chromosome for query positions. Overlapping intervals have distance 0. If
+    the intervals to the left and to the right have the same distance, the interval to the left is returned.
+    :param index: Interval index
+    :type index: IntervalIndex
+    :param positions: Query positions in the concatenated genome array
+    :type positions: numpy.array or int
+    :return: numpy.array with the id of the nearest interval (-1 if there is no interval on the chromosome),
+    numpy.array with the distance (-1 if there is no interval on the chromosome)
+    """
+    positions = np.atleast_1d(np.asarray(positions, dtype=np.int64))
+    if index.start.size == 0:
+        return np.full(positions.shape, -1, dtype=np.int64), np.full(positions.shape, -1, dtype=np.int64)
+    chrom = np.searchsorted(index.chrom_bounds, positions, side='right') - 1
+    chrom_begin = index.chrom_bounds[np.clip(chrom, 0, index.chrom_bounds.size - 1)]
+    chrom_end = index.chrom_bounds[np.clip(chrom + 1, 0, index.chrom_bounds.size - 1)]
+
+    # Left: the interval with start <= position that reaches furthest
+    left = np.searchsorted(index.start, positions, side='right') - 1
+    has_left = left >= 0
+    left_c = np.maximum(left, 0)
+    left_end = np.where(has_left, index.max_end[left_c], chrom_begin)
+    has_left &= left_end > chrom_begin
+    left_dist = np.maximum(positions - (left_end - 1), 0)
+    left_id = index.max_id[left_c]
+
+    # Right: the first interval with start > position
+    right = left + 1
+    has_right = right < index.start.size
+    right_c = np.minimum(right, index.start.size - 1)
+    right_start = index.start[right_c]
+    has_right &= right_start < chrom_end
+    right_dist = right_start - positions
+    right_id = index.id[right_c]
+
+    use_left = has_left & (~has_right | (left_dist <= right_dist))
+    use_right = has_right & ~use_left
+    ids = np.where(use_left, left_id, np.where(use_right, right_id, -1))
+    distance = np.where(use_left, left_dist, np.where(use_right, right_dist, -1))
+    return ids, distance
+
+
+def save_index(path, index):
+    """
+    Save an IntervalIndex as .npz file
+    :param path: Path to the .npz file
+    :type path: str
+    :param index: Interval index
+    :type index: IntervalIndex
+    :return: None
+    """
+    np.savez(path, **index._asdict())
+
+
+def load_index(path):
+    """
+    Load an IntervalIndex that was saved with save_index
+    :param path: Path to the .npz file
+    :type path: str
+    :return: IntervalIndex
+    """
+    with np.load(path) as saved:
+        return IntervalIndex(**{field: saved[field] for field in IntervalIndex._fields})
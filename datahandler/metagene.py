@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+"""Metagene module
+
+Streaming aggregation of segmented data (e.g. the transcripts returned by seqDataHandler.annotate) into metagene
+profiles. The segments are rescaled batch by batch and reduced to running statistics per rescaled position, such that
+the dense matrix of seqDataHandler.rescale_all is never materialised and the memory is bounded by the vector length
+times the number of groups, independent of the number of segments. Aggregators can be merged, e.g. the aggregators of
+several worker processes or tracks. The provided functions are
+* MetageneAggregator - Running mean, variance, minimum, maximum and approximate quantiles per rescaled position
+* merge_all - Merge a list of aggregators into a new aggregator
+"""
+import copy
+import numpy as np
+from datahandler import segments
+from datahandler import _internal
+
+
+class MetageneAggregator:
+    """
+    Running statistics per rescaled position, optionally for several groups of segments (e.g. expression classes).
+    Mean, variance, minimum and maximum are exact; they are merged with the pairwise update by Chan et al. (see
+    seqDataHandler.array_stats). Quantiles are approximated with a fixed-bin histogram per position over value_range,
+    which can be merged by adding the counts; the error is at most one bin width, and values outside of value_range
+    are counted in the outermost bins.
+    """
+    def __init__(self, vec_len=1000, value_range=None, n_bins=256):
+        """
+        :param vec_len: Length to which all segments are rescaled (see seqDataHandler.rescale_all)
+        :type vec_len: int
+        :param value_range: Tuple with lower and upper bound of the quantile histograms, e.g. (0, 1) for data that was
+        normalised with remap_norm. If None, quantiles are not computed
+        :type value_range: tuple(float)
+        :param n_bins: Number of histogram bins per position
+        :type n_bins: int
+        """
+        if vec_len < 1:
+            raise ValueError('vec_len must be at least 1.')
+        if value_range is not None and not value_range[0] < value_range[1]:
+            raise ValueError('The lower bound of value_range must be smaller than the upper bound.')
+        self.vec_len = vec_len
+        self.value_range = None if value_range is None else (float(value_range[0]), float(value_range[1]))
+        self.n_bins = n_bins
+        # Group label -> moments (count, mean, sum of squared deviations, minimum, maximum) per position
+        self._moments = {}
+        # Group label -> histogram with shape (vec_len, n_bins)
+        self._hist = {}
+
+    @property
+    def groups(self):
+        """
+        Group labels in the order in which they were added
+        :return: List with group labels
+        """
+        return list(self._moments.keys())
+
+    def add(self, transcript_data, groups=None, batch_size=256):
+        """
+        Rescale a list or container of segments batch by batch and add them to the statistics
+        :param transcript_data: List with data arrays or Segments container, e.g. returned by seqDataHandler.annotate
+        :type transcript_data: list(numpy.array) or Segments
+        :param groups: Group label for all segments, or sequence with one group label per segment. If None, all
+        segments are added to the group None
+        :type groups: object or list
+        :param batch_size: Number of segments that are rescaled at once
+        :type batch_size: int
+        :return: The aggregator itself
+        """
+        n = len(transcript_data.offsets) - 1 if isinstance(transcript_data, segments.Segments) else len(transcript_data)
+        if groups is None or isinstance(groups, (str, int, float)):
+            labels, group_idx = [groups], np.zeros(n, dtype=np.int64)
+        else:
+            if len(groups) != n:
+                raise ValueError('groups must contain one label per segment.')
+            group_idx = np.empty(n, dtype=np.int64)
+            label_idx = {}
+            for num, g in enumerate(groups):
+                group_idx[num] = label_idx.setdefault(g, len(label_idx))
+            labels = list(label_idx.keys())
+
+        for first in range(0, n, batch_size):
+            block = self._rescale(transcript_data, first, min(first + batch_size, n))
+            batch_groups = group_idx[first:first + batch_size]
+            for g in np.unique(batch_groups).tolist():
+                rows = block[batch_groups == g] if len(labels) > 1 else block
+                self._update(labels[g], rows)
+        return self
+
+    def _rescale(self, transcript_data, first, last):
+        """
+        Rescale the segments first to last
+        :param transcript_data: List with data arrays or Segments container
+        :type transcript_data: list(numpy.array) or Segments
+        :param first: Index of the first segment
+        :type first: int
+        :param last: Index after the last segment
+        :type last: int
+        :return: numpy.array with shape (last - first, vec_len)
+        """
+        if isinstance(transcript_data, segments.Segments):
+            offsets = transcript_data.offsets[first:last + 1]
+            values = transcript_data.values[offsets[0]:offsets[-1]]
+            offsets = offsets - offsets[0]
+        else:
+            batch = segments.from_list(transcript_data[first:last], dtype=np.float64)
+            values, offsets = batch.values, batch.offsets
+        seg_len = np.diff(offsets)
+        if np.any(seg_len == 0):
+            raise ValueError('Empty data arrays cannot be rescaled.')
+        out = np.empty((last - first, self.vec_len))
+        _internal.rescale_batch(values, offsets, seg_len, out)
+        return out
+
+    def _update(self, label, rows):
+        """
+        Add the rescaled segments of one group
+        :param label: Group label
+        :type label: object
+        :param rows: Rescaled segments with shape (number of segments, vec_len)
+        :type rows: numpy.array
+        :return: None
+        """
+        self._moments[label] = _internal.merge_moments(self._moments.get(label), rows.T)
+        if self.value_range is None:
+            return
+        low, high = self.value_range
+        bins = np.clip(((rows - low) * (self.n_bins / (high - low))).astype(np.int64), 0, self.n_bins - 1)
+        bins += np.arange(self.vec_len, dtype=np.int64) * self.n_bins
+        counts = np.bincount(bins.ravel(), minlength=self.vec_len * self.n_bins).reshape(self.vec_len, self.n_bins)
+        if label in self._hist:
+            self._hist[label] += counts
+        else:
+            self._hist[label] = counts
+
+    def merge(self, other):
+        """
+        Merge the statistics of another aggregator into this aggregator
+        :param other: Aggregator with the same vec_len, value_range and n_bins
+        :type other: MetageneAggregator
+        :return: The aggregator itself
+        """
+        if (other.vec_len, other.value_range, other.n_bins) != (self.vec_len, self.value_range, self.n_bins):
+            raise ValueError('Only aggregators with the same vec_len, value_range and n_bins can be merged.')
+        for label, moments in other._moments.items():
+            if label not in self._moments:
+                moments = tuple(m.copy() if isinstance(m, np.ndarray) else m for m in moments)
+            self._moments[label] = _internal.combine_moments(self._moments.get(label), moments)
+        for label, hist in other._hist.items():
+            if label in self._hist:
+                self._hist[label] = self._hist[label] + hist
+            else:
+                self._hist[label] = hist.copy()
+        return self
+
+    def _group_moments(self, group):
+        if group not in self._moments:
+            raise KeyError('Group %s has not been added.' % str(group))
+        return self._moments[group]
+
+    def count(self, group=None):
+        """
+        Number of aggregated segments
+        :param group: Group label
+        :type group: object
+        :return: Number of segments
+        """
+        return int(self._group_moments(group)[0])
+
+    def mean(self, group=None):
+        """
+        Mean per rescaled position
+        :param group: Group label
+        :type group: object
+        :return: numpy.array with vec_len entries
+        """
+        return self._group_moments(group)[1]
+
+    def var(self, group=None, ddof=0):
+        """
+        Variance per rescaled position
+        :param group: Group label
+        :type group: object
+        :param ddof: Delta degrees of freedom
+        :type ddof: int
+        :return: numpy.array with vec_len entries
+        """
+        n, _, m2, _, _ = self._group_moments(group)
+        return m2 / max(n - ddof, 0) if n > ddof else np.full(self.vec_len, np.nan)
+
+    def std(self, group=None, ddof=0):
+        """
+        Standard deviation per rescaled position
+        :param group: Group label
+        :type group: object
+        :param ddof: Delta degrees of freedom
+        :type ddof: int
+        :return: numpy.array with vec_len entries
+        """
+        return np.sqrt(self.var(group=group, ddof=ddof))
+
+    def min(self, group=None):
+        """
+        Minimum per rescaled position
+        :param group: Group label
+        :type group: object
+        :return: numpy.array with vec_len entries
+        """
+        return self._group_moments(group)[3]
+
+    def max(self, group=None):
+        """
+        Maximum per rescaled position
+        :param group: Group label
+        :type group: object
+        :return: numpy.array with vec_len entries
+        """
+        return self._group_moments(group)[4]
+
+    def quantile(self, q, group=None):
+        """
+        Approximate quantiles per rescaled position, linearly interpolated within the histogram bins and clipped to
+        the exact minimum and maximum
+        :param q: Quantile or sequence of quantiles between 0 and 1
+        :type q: float or list(float)
+        :param group: Group label
+        :type group: object
+        :return: numpy.array with vec_len entries, or with shape (number of quantiles, vec_len) for a sequence
+        """
+        if self.value_range is None:
+            raise ValueError('Quantiles are only available if value_range is set.')
+        _, _, _, data_min, data_max = self._group_moments(group)
+        hist = self._hist[group]
+        low, high = self.value_range
+        width = (high - low) / self.n_bins
+        cum = np.cumsum(hist, axis=-1)
+        q_arr = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        if np.any((q_arr < 0) | (q_arr > 1)):
+            raise ValueError('Quantiles must be between 0 and 1.')
+        result = np.empty((q_arr.size, self.vec_len))
+        for num, quant in enumerate(q_arr.tolist()):
+            target = quant * cum[:, -1]
+            k = np.minimum((cum < target[:, np.newaxis]).sum(axis=-1), self.n_bins - 1)
+            positions = np.arange(self.vec_len)
+            before = cum[positions, k] - hist[positions, k]
+            frac = np.divide(target - before, hist[positions, k], out=np.zeros(self.vec_len),
+                             where=hist[positions, k] > 0)
+            result[num] = np.clip(low + (k + frac) * width, data_min, data_max)
+        return result if np.ndim(q) > 0 else result[0]
+
+    def summary(self, group=None, quantiles=(0.25, 0.5, 0.75)):
+        """
+        All statistics of a group
+        :param group: Group label
+        :type group: object
+        :param quantiles: Quantiles that are returned if value_range is set
+        :type quantiles: list(float)
+        :return: Dictionary with count, mean, std, min, max and (if value_range is set) quantiles
+        """
+        result = {'count': self.count(group), 'mean': self.mean(group), 'std': self.std(group),
+                  'min': self.min(group), 'max': self.max(group)}
+        if self.value_range is not None:
+            result['quantiles'] = dict(zip(quantiles, self.quantile(list(quantiles), group)))
+        return result
+
+
+def merge_all(aggregators):
+    """
+    Merge a list of aggregators, e.g. of several worker processes or tracks, into a new aggregator
+    :param aggregators: List with aggregators with the same vec_len, value_range and n_bins
+    :type aggregators: list(MetageneAggregator)
+    :return: MetageneAggregator
+    """
+    if len(aggregators) == 0:
+        raise ValueError('List with aggregators must not be empty.')
+    merged = copy.deepcopy(aggregators[0])
+    for aggregator in aggregators[1:]:
+        merged.merge(aggregator)
+    return merged
@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+"""Pipeline module
+
+Streaming version of the typical seqDataHandler workflow get_values -> remap_norm/center_norm -> smooth ->
+annotate -> rescale_all. Instead of holding every whole-genome track in memory, the steps are chained as generators
+that process one chromosome at a time, such that the peak memory is bounded by the largest chromosome times the
+number of tracks. Every stream yields tuples with the chromosome name and a list with one data array per track.
+Normalisation needs global statistics, which are derived from the bigwig headers or, for binned values, computed
+in a first pass over the bigwig files that only collects the statistics. The provided functions are
+* iter_chroms - Stream the values of all bigwig files chromosome by chromosome
+* norm_stats - Compute the global statistics for normalisation in a single pass over a stream
+* normalize - Normalise every chromosome of a stream with precomputed global statistics
+* smooth_chroms - Smooth every chromosome of a stream independently
+* annotate_chroms - Segment every chromosome of a stream according to a bed file
+* collect_annotation - Gather the streamed segments in the order of the bed file
+* run_pipeline - Run the complete workflow chromosome by chromosome
+"""
+import contextlib
+import numpy as np
+from datahandler import intervals, _internal
+from datahandler import seqDataHandler as seq
+
+
+def iter_chroms(bw_list, dtype='float32', bin_size=None):
+    """
+    Stream the values of all bigwig files chromosome by chromosome. The chromosomes are processed in the order of the
+    first bigwig file, which is the same layout as used by seqDataHandler.get_values.
+    :param bw_list: List with bigwig files or paths to bigwig files
+    :type bw_list: list(bigWigFile) or list(str)
+    :param dtype: Data type of the returned arrays
+    :type dtype: str or numpy.dtype
+    :param bin_size: If set, the mean value per bin is returned (see seqDataHandler.get_values)
+    :type bin_size: int
+    :return: Generator with tuples of chromosome name and list with one data array per bigwig file
+    """
+    if len(bw_list) == 0:
+        raise ValueError('List with bigwig objects must not be empty.')
+    # The handles are returned to the handle pool when the stream is exhausted or closed
+    with contextlib.ExitStack() as stack:
+        bw_files = [stack.enter_context(_internal.big_file(bw)) for bw in bw_list]
+        chroms = bw_files[0].chroms()
+        sizes = intervals.chrom_sizes(*intervals.chrom_layout(chroms, bin_size=bin_size))
+        for chrom, length in chroms.items():
+            chrom_values = []
+            for bw in bw_files:
+                values = np.empty(sizes[chrom], dtype=dtype)
+                _internal.fill_chrom(values, bw, chrom, length, bin_size=bin_size)
+                chrom_values.append(values)
+            yield chrom, chrom_values
+
+
+def norm_stats(stream):
+    """
+    Compute the global statistics for normalisation in a single pass over a stream. The per-chromosome moments are
+    merged with the pairwise update by Chan et al., which is numerically stable (see seqDataHandler.array_stats).
+    :param stream: Generator with tuples of chromosome name and list with data arrays
+    :type stream: iterable
+    :return: List with one tuple (minimum, maximum, mean, standard deviation) per track
+    """
+    moments = None
+    for _, chrom_values in stream:
+        if moments is None:
+            moments = [None for _ in chrom_values]
+        moments = [_internal.merge_moments(m, values) for m, values in zip(moments, chrom_values)]
+
+    if moments is None or any(m is None for m in moments):
+        raise ValueError('Stream must not be empty.')
+    return [_internal.moments_stats(m) for m in moments]
+
+
+def normalize(stream, stats, norm='center'):
+    """
+    Normalise every chromosome of a stream with precomputed global statistics. The result is the same as applying
+    seqDataHandler.remap_norm or seqDataHandler.center_norm to the concatenated genome array (up to the floating point
+    rounding of the mean and standard deviation for center_norm).
+    :param stream: Generator with tuples of chromosome name and list with data arrays
+    :type stream: iterable
+    :param stats: Global statistics per track as returned by norm_stats
+    :type stats: list(tuple)
+    :param norm: Normalisation method. Possible are 'center' (center_norm) and 'remap' (remap_norm)
+    :type norm: str
+    :return: Generator with tuples of chromosome name and list with normalised data arrays
+    """
+    if norm not in ('center', 'remap'):
+        raise ValueError('Normalisation method %s is not supported. Use center or remap.' % norm)
+    for chrom, chrom_values in stream:
+        normed = []
+        for (t_min, t_max, mean, std), values in zip(stats, chrom_values):
+            scalar = values.dtype.type if values.dtype.kind == 'f' else np.float64
+            if norm == 'center':
+                normed.append((values - scalar(mean)) / scalar(std))
+            else:
+                # Same operation order as remap_norm to obtain identical values
+                normed.append((values - scalar(t_min)) / (scalar(t_max) - scalar(t_min)))
+        yield chrom, normed
+
+
+def smooth_chroms(stream, smooth_list):
+    """
+    Smooth every chromosome of a stream independently. The result is the same as seqDataHandler.smooth_all with
+    chrom_start.
+    :param stream: Generator with tuples of chromosome name and list with data arrays
+    :type stream: iterable
+    :param smooth_list: Size of the moving average window per track. If an entry is None, the track is not smoothed
+    :type smooth_list: list(int)
+    :return: Generator with tuples of chromosome name and list with smoothed data arrays
+    """
+    for chrom, chrom_values in stream:
+        yield chrom, [values if smooth_size is None else seq.smooth(values, smooth_size=smooth_size,
+                                                                    chrom_start={chrom: 0})
+                      for values, smooth_size in zip(chrom_values, smooth_list)]
+
+
+def annotate_chroms(stream, bed_ref, bin_size=None):
+    """
+    Segment every chromosome of a stream according to a bed file. The segments are copied, such that the
+    chromosome arrays can be released after processing. Missing values are set to zero.
+    :param stream: Generator with tuples of chromosome name and list with data arrays
+    :type stream: iterable
+    :param bed_ref: reference to bed file or bed file parsed with intervals.parse_bed
+    :type bed_ref: BedTool or IntervalTable
+    :param bin_size: Bin size if the stream contains binned values
+    :type bin_size: int
+    :return: Generator with tuples of chromosome name, numpy.array with the indices of the intervals in the bed file
+    and list with the list of segments per track
+    """
+    table = _internal.as_table(bed_ref)
+    for chrom, chrom_values in stream:
+        if chrom not in table.chrom_names:
+            continue
+        idx = np.flatnonzero(table.chrom == table.chrom_names.index(chrom))
+        chrom_table = intervals.IntervalTable(
+            chrom=np.zeros(idx.size, dtype=np.int32), start=table.start[idx], end=table.end[idx],
+            strand=table.strand[idx], name=table.name[idx], chrom_names=[chrom], names=table.names
+        )
+        slices = _internal.segment_slices(chrom_table, {chrom: 0}, bin_size=bin_size)
+        yield chrom, idx, [[np.nan_to_num(values[sl], nan=0.) for sl in slices] for values in chrom_values]
+
+
+def collect_annotation(stream, bed_ref):
+    """
+    Gather the streamed segments in the order of the bed file. The result is the same as seqDataHandler.annotate_all
+    :param stream: Generator returned by annotate_chroms
+    :type stream: iterable
+    :param bed_ref: reference to bed file or bed file parsed with intervals.parse_bed. Must be the same as passed to
+    annotate_chroms
+    :type bed_ref: BedTool or IntervalTable
+    :return: List with segmented data arrays, list with dictionaries which map from gene name to data array
+    """
+    table = _internal.as_table(bed_ref)
+    bw_gen_mapping = []
+    found = np.zeros(table.start.size, dtype=bool)
+    for _, idx, track_segments in stream:
+        if not bw_gen_mapping:
+            bw_gen_mapping = [[None] * table.start.size for _ in track_segments]
+        for gen_mapping, chrom_segments in zip(bw_gen_mapping, track_segments):
+            for i, frag_values in zip(idx.tolist(), chrom_segments):
+                gen_mapping[i] = frag_values
+        found[idx] = True
+
+    if not np.all(found):
+        missing = table.chrom_names[table.chrom[np.argmin(found)]]
+        raise KeyError('Chromosome %s of the bed file is not contained in the bigwig files.' % missing)
+
+    t_dict_list = []
+    for gen_mapping in bw_gen_mapping:
+        t_dict = {}
+        if table.names is not None:
+            t_dict = {table.names[n]: frag_values for n, frag_values in zip(table.name.tolist(), gen_mapping)
+                      if n >= 0}
+        t_dict_list.append(t_dict)
+    return bw_gen_mapping, t_dict_list
+
+
+def run_pipeline(bw_list, bed_ref, norm=None, smooth_list=None, vec_len=None, dtype='float32', bin_size=None):
+    """
+    Run the complete workflow get_values -> remap_norm/center_norm -> smooth -> annotate -> rescale_all chromosome by
+    chromosome. The global statistics for normalisation are taken from the bigwig headers if bw_list contains paths.
+    Otherwise, and for binned values, the bigwig files are read twice: the first pass computes the global statistics,
+    the second pass applies all steps.
+    :param bw_list: List with bigwig files or paths to bigwig files
+    :type bw_list: list(bigWigFile) or list(str)
+    :param bed_ref: reference to bed file or bed file parsed with intervals.parse_bed
+    :type bed_ref: BedTool or IntervalTable
+    :param norm: Normalisation method ('center' or 'remap'). If None, the data is not normalised
+    :type norm: str
+    :param smooth_list: Size of the moving average window per track. If None, the data is not smoothed
+    :type smooth_list: list(int)
+    :param vec_len: If set, all segments are rescaled to this length with seqDataHandler.rescale_all
+    :type vec_len: int
+    :param dtype: Data type of the extracted values
+    :type dtype: str or numpy.dtype
+    :param bin_size: If set, the mean value per bin is processed instead of the base-pair values
+    :type bin_size: int
+    :return: List with segmented data arrays (or rescaled data arrays if vec_len is set) per track, list with
+    dictionaries which map from gene name to segmented data array per track
+    """
+    table = _internal.as_table(bed_ref)
+    stream = iter_chroms(bw_list, dtype=dtype, bin_size=bin_size)
+    if norm is not None:
+        if bin_size is None and all(isinstance(bw, str) for bw in bw_list):
+            # The bigwig headers provide the statistics in constant time
+            stats = [seq.header_stats(bw) for bw in bw_list]
+        else:
+            stats = norm_stats(iter_chroms(bw_list, dtype=dtype, bin_size=bin_size))
+        stream = normalize(stream, stats, norm=norm)
+    if smooth_list is not None:
+        stream = smooth_chroms(stream, smooth_list)
+    bw_gen_mapping, t_dict_list = collect_annotation(annotate_chroms(stream, table, bin_size=bin_size), table)
+    if vec_len is not None:
+        bw_gen_mapping = [seq.rescale_all(gen_mapping, vec_len=vec_len) for gen_mapping in bw_gen_mapping]
+    return bw_gen_mapping, t_dict_list
@@ -6,14 +6,18 @@ before a sophisticated in depth analysis is carried out. Available functions are
 * peak_detect_smooth -  Find the relative peak values for the signal
 * cancel_noise_cpd - Filter CPD signal for values where CPDs are possible
 """
-import re
+import warnings
 import numpy as np
-from scipy.signal import argrelmax
+from datahandler import intervals, profiling
 
 
-def peak_detect_smooth(sig, peak_range=200, mode='wrap'):
+@profiling.instrument
+def peak_detect_smooth(sig, peak_range=200, mode='wrap', chrom_start=None):
     """
-    Find the relative peak values for the signal. It uses a moving window for determining relative maxima.
+    Find the relative peak values for the signal. It uses a moving window for determining relative maxima. A value is
+    a peak if it is strictly larger than all values within peak_range to the left and to the right, which is the
+    definition of scipy.signal.argrelmax. The window maxima are computed with the van Herk/Gil-Werman algorithm, which
+    takes linear time independent of the window size, and the signal is processed in chunks to bound the memory.
     :param sig: Data values
     :type sig: numpy.array
     :param peak_range: Size of the the moving window. This means how many values to the left and the right are
@@ -22,37 +26,183 @@ def peak_detect_smooth(sig, peak_range=200, mode='wrap'):
     :param mode: Behaviour at the edges. Possible are 'wrap' or 'clip.
     See scipy.signal.argrelmax documentation for more information
     :type mode: str
+    :param chrom_start: Dictionary with index positions where the chromosomes start. If passed, the peaks are
+    detected for every chromosome separately, with the edge behaviour given by mode applied at the chromosome ends
+    :type chrom_start: dict
     :return: numpy.array with indices for the peak values
     """
-    peaks, = argrelmax(sig, order=peak_range, mode=mode)
-    return peaks
+    if peak_range < 1:
+        raise ValueError('peak_range must be an integer greater than or equal to 1')
+    if mode not in ('wrap', 'clip'):
+        raise ValueError('mode must be either wrap or clip')
+
+    sig = np.asarray(sig)
+    if chrom_start is None:
+        return _relative_maxima(sig, peak_range, mode)
+
+    peaks = []
+    for chrom, size in intervals.chrom_sizes(chrom_start, sig.size).items():
+        start = chrom_start[chrom]
+        with profiling.region('preprocessing.peak_detect_smooth:chrom', chrom=chrom, size=size):
+            peaks.append(_relative_maxima(sig[start:start + size], peak_range, mode) + start)
+    return np.concatenate(peaks) if peaks else np.zeros(0, dtype=np.int64)
+
+
+def _sliding_max(data, size):
+    """
+    Maximum of all windows data[j:j + size] with the van Herk/Gil-Werman algorithm
+    :param data: Data values
+    :type data: numpy.array
+    :param size: Window size
+    :type size: int
+    :return: numpy.array with data.size - size + 1 window maxima
+    """
+    n_blocks = -(-data.size // size)
+    blocks = np.full(n_blocks * size, _lowest(data.dtype), dtype=data.dtype)
+    blocks[:data.size] = data
+    blocks = blocks.reshape(n_blocks, size)
+    prefix_max = np.maximum.accumulate(blocks, axis=1).reshape(-1)
+    suffix_max = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].reshape(-1)
+    return np.maximum(suffix_max[:data.size - size + 1], prefix_max[size - 1:data.size])
+
+
+def _lowest(dtype):
+    """
+    Smallest value of a data type, which is used for padding
+    :param dtype: Data type
+    :type dtype: numpy.dtype
+    :return: Smallest value
+    """
+    if np.issubdtype(dtype, np.integer):
+        return np.iinfo(dtype).min
+    if np.issubdtype(dtype, np.bool_):
+        return False
+    return -np.inf
+
+
+def _relative_maxima(sig, order, mode, chunk_size=2**22):
+    """
+    Relative maxima with the same semantics as scipy.signal.argrelmax
+    :param sig: Data values
+    :type sig: numpy.array
+    :param order: Number of values to the left and the right that are compared
+    :type order: int
+    :param mode: Behaviour at the edges. Possible are 'wrap' or 'clip'
+    :type mode: str
+    :param chunk_size: Number of values that are processed at once
+    :type chunk_size: int
+    :return: numpy.array with indices of the relative maxima
+    """
+    n = sig.size
+    peaks = []
+    for c_start in range(0, n, chunk_size):
+        c_end = min(c_start + chunk_size, n)
+        # Chunk with a halo of order values at both sides
+        if mode == 'wrap':
+            ext = sig.take(np.arange(c_start - order, c_end + order), mode='wrap')
+        else:
+            ext = np.full(c_end - c_start + 2 * order, _lowest(sig.dtype), dtype=sig.dtype)
+            lo, hi = max(c_start - order, 0), min(c_end + order, n)
+            ext[lo - c_start + order:hi - c_start + order] = sig[lo:hi]
+
+        window_max = _sliding_max(ext, order)
+        center = ext[order:order + c_end - c_start]
+        is_peak = (center > window_max[:c_end - c_start]) & (center > window_max[order + 1:order + 1 + c_end - c_start])
+        if mode == 'clip':
+            # Clipped neighbours at the edges are the edge values themselves
+            if c_start == 0:
+                is_peak[0] = False
+            if c_end == n:
+                is_peak[-1] = False
+        peaks.append(np.flatnonzero(is_peak) + c_start)
+
+    return np.concatenate(peaks) if peaks else np.zeros(0, dtype=np.int64)
 
 
+@profiling.instrument
 def cancel_noise_cpd(cpd_sig, chrom_start, dna_seq):
     """
-    Set CPD signal to zero where there is no adjacent pyrimidines
+    Set CPD signal to zero where there is no adjacent pyrimidines (on either strand). The sequence is encoded as
+    bytes and the adjacent-dinucleotide mask is computed with shifted comparisons, chromosome by chromosome. The
+    sequences are matched to chrom_start by their name.
     :param cpd_sig: Data array with the cpd signal
     :type cpd_sig: numpy.array
     :param chrom_start: Dictionary with chromosome names as indices and the indices where the chromosomes start in
     the cpd_sig array
     :type chrom_start: dict
-    :param dna_seq: The DNA sequence as parsed fasta or fastq
+    :param dna_seq: The DNA sequence as parsed fasta or fastq. Every record is only used once, hence a streaming
+    iterator (e.g. from reader.load_fast with stream=True) can be passed. Tuples with name and sequence are accepted
+    as well
     :type dna_seq: iterable
     :return: Filtered CPD signal
     """
-    combinations = ['TT', 'CT', 'TC', 'CC', 'AA', 'GA', 'AG', 'GG']
-    for start, seq in zip(chrom_start.values(), dna_seq):
-        seq = seq.seq
-        ind = set()
-        for c in combinations:
-            c_ind = set([m.start() for m in re.finditer(c, str(seq))])
-            ind = ind.union(c_ind)
-
-        sig_mask = np.zeros(len(seq)).astype('bool')
-        sig_mask[np.asarray(list(ind))] = True
-        sig_mask[np.asarray(list(ind)) + 1] = True
-        cpd_sig[start:start + len(seq)][~sig_mask] = 0
+    sizes = intervals.chrom_sizes(chrom_start, cpd_sig.size)
+    for name, seq in _iter_sequences(dna_seq):
+        if name not in chrom_start:
+            warnings.warn('Sequence %s not found in chrom_start. It is ignored.' % name, RuntimeWarning)
+            continue
+        seq = _encode_sequence(seq)
+        if seq.size != sizes[name]:
+            raise ValueError('Sequence %s has length %d, but the chromosome in cpd_sig has length %d.'
+                             % (name, seq.size, sizes[name]))
+        start = chrom_start[name]
+        with profiling.region('preprocessing.cancel_noise_cpd:chrom', chrom=name, size=seq.size):
+            for c_start, c_end, sig_mask in _iter_cpd_mask(seq):
+                cpd_sig[start + c_start:start + c_end][~sig_mask] = 0
 
     return cpd_sig
 
 
+# Class per base: 1 for pyrimidines (C, T), 2 for purines (A, G). Two adjacent bases of the same class form a
+# pyrimidine dimer on one of the strands
+_BASE_CLASS = np.zeros(256, dtype=np.int8)
+_BASE_CLASS[[ord('C'), ord('T')]] = 1
+_BASE_CLASS[[ord('A'), ord('G')]] = 2
+
+
+def _iter_sequences(dna_seq):
+    """
+    Iterate over names and sequences
+    :param dna_seq: Parsed fasta or fastq records or tuples with name and sequence
+    :type dna_seq: iterable
+    :return: Generator with tuples of name and sequence
+    """
+    for record in dna_seq:
+        if isinstance(record, tuple):
+            yield record
+        else:
+            yield record.id, record.seq
+
+
+def _encode_sequence(seq):
+    """
+    Encode a sequence as numpy array of bytes
+    :param seq: Sequence
+    :type seq: Bio.Seq.Seq or str or bytes or numpy.array
+    :return: numpy.array with dtype uint8
+    """
+    if isinstance(seq, np.ndarray):
+        return seq.view(np.uint8)
+    if isinstance(seq, str):
+        seq = seq.encode('ascii')
+    return np.frombuffer(bytes(seq), dtype=np.uint8)
+
+
+def _iter_cpd_mask(seq, chunk_size=2**24):
+    """
+    Compute the mask of all positions which are part of two adjacent pyrimidines in chunks
+    :param seq: Encoded sequence
+    :type seq: numpy.array
+    :param chunk_size: Number of positions per chunk
+    :type chunk_size: int
+    :return: Generator with chunk start, chunk end and boolean mask of the chunk
+    """
+    for c_start in range(0, seq.size, chunk_size):
+        c_end = min(c_start + chunk_size, seq.size)
+        lo, hi = max(c_start - 1, 0), min(c_end + 1, seq.size)
+        base_class = _BASE_CLASS[seq[lo:hi]]
+        pair = (base_class[:-1] == base_class[1:]) & (base_class[:-1] != 0)
+        sig_mask = np.zeros(hi - lo, dtype='bool')
+        sig_mask[:-1] |= pair
+        sig_mask[1:] |= pair
+        yield c_start, c_end, sig_mask[c_start - lo:c_end - lo]
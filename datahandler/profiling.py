@@ -0,0 +1,376 @@
+#!/usr/bin/python3
+"""Profiling module
+
+Opt-in instrumentation of the reader, seqDataHandler and preprocessing functions. When profiling is enabled, every
+instrumented call records its wall time, the total size of the input files, the sizes of the numpy arrays that are
+passed and returned and, optionally, the peak memory allocated during the call (traced with tracemalloc). Hot loops
+additionally record one entry per chromosome. When profiling is disabled, an instrumented call costs a single flag
+check. Profiling is enabled either with the context manager profile or by setting the environment variable
+DATAHANDLER_PROFILE before the package is imported (DATAHANDLER_PROFILE=1 prints a summary to stderr at exit, a path
+ending with .json writes the records as json file; DATAHANDLER_PROFILE_MEMORY=1 enables memory tracing). Worker
+processes are not profiled. The provided functions are
+* Profile - Collection of call records with aggregation and export
+* profile - Context manager that enables profiling and collects all records in a Profile
+* enabled - Check whether profiling is enabled
+* add_hook - Register a function that is called with every record, e.g. to forward it to a metrics collector
+* remove_hook - Remove a registered hook
+* instrument - Decorator that records every call of a function
+* region - Context manager that records a code region, e.g. the processing of one chromosome
+"""
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import functools
+import inspect
+import tracemalloc
+from collections import OrderedDict
+import numpy as np
+
+
+class _State:
+    """
+    Global profiling state. active is the only attribute that is read when profiling is disabled.
+    """
+    def __init__(self):
+        self.active = False
+        self.trace_memory = False
+        self.profiles = []
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+_state = _State()
+
+
+class Profile:
+    """
+    Collection of call records. Every record is a dictionary with the keys function, chrom, seconds, input_size (total
+    size of the input files in bytes), in_size and out_size (number of array elements passed and returned) and
+    peak_bytes (None if memory tracing is disabled).
+    """
+    def __init__(self):
+        self.records = []
+
+    def aggregate(self, by_chrom=False):
+        """
+        Aggregate the records per function (and per chromosome)
+        :param by_chrom: If True, the records are aggregated per function and chromosome
+        :type by_chrom: bool
+        :return: OrderedDict with function name (or tuple of function name and chromosome) as key and dictionary with
+        calls, total, mean and maximal time, input file size, array sizes and maximal peak memory as value
+        """
+        summary = OrderedDict()
+        for r in self.records:
+            if by_chrom and r['chrom'] is None:
+                continue
+            key = (r['function'], r['chrom']) if by_chrom else r['function']
+            entry = summary.setdefault(key, {'calls': 0, 'total_s': 0., 'max_s': 0., 'input_size': 0, 'in_size': 0,
+                                             'out_size': 0, 'peak_bytes': None})
+            entry['calls'] += 1
+            entry['total_s'] += r['seconds']
+            entry['max_s'] = max(entry['max_s'], r['seconds'])
+            entry['input_size'] += r['input_size']
+            entry['in_size'] += r['in_size']
+            entry['out_size'] += r['out_size']
+            if r['peak_bytes'] is not None:
+                entry['peak_bytes'] = max(entry['peak_bytes'] or 0, r['peak_bytes'])
+        for entry in summary.values():
+            entry['mean_s'] = entry['total_s'] / entry['calls']
+        return summary
+
+    def to_json(self, path=None):
+        """
+        Export the records and the aggregation per function and per chromosome as json
+        :param path: If set, the json is written to this file
+        :type path: str
+        :return: json string
+        """
+        per_chrom = [dict(function=f, chrom=c, **v) for (f, c), v in self.aggregate(by_chrom=True).items()]
+        content = json.dumps({
+            'functions': self.aggregate(),
+            'chromosomes': per_chrom,
+            'records': self.records
+        }, indent=2)
+        if path is not None:
+            with open(path, 'w') as json_file:
+                json_file.write(content)
+        return content
+
+    def format_summary(self, by_chrom=False):
+        """
+        Create a human-readable summary table sorted by total time
+        :param by_chrom: If True, one row per function and chromosome is created
+        :type by_chrom: bool
+        :return: Summary table as string
+        """
+        summary = self.aggregate(by_chrom=by_chrom)
+        lines = ['%-50s %7s %11s %11s %11s %12s %11s' % (
+            'function', 'calls', 'total [s]', 'mean [s]', 'max [s]', 'input [MB]', 'peak [MB]')]
+        for key, v in sorted(summary.items(), key=lambda kv: -kv[1]['total_s']):
+            name = '%s [%s]' % key if by_chrom else key
+            peak = '%11.1f' % (v['peak_bytes'] / 2.**20) if v['peak_bytes'] is not None else '%11s' % '-'
+            lines.append('%-50s %7d %11.4f %11.4f %11.4f %12.1f %s' % (
+                name, v['calls'], v['total_s'], v['mean_s'], v['max_s'], v['input_size'] / 2.**20, peak))
+        return '\n'.join(lines)
+
+
+class profile:
+    """
+    Context manager that enables profiling and collects all records in a Profile, which is returned on entering
+    """
+    def __init__(self, trace_memory=False):
+        """
+        :param trace_memory: If True, the peak memory of every call is traced with tracemalloc, which slows down the
+        execution considerably
+        :type trace_memory: bool
+        """
+        self.trace_memory = trace_memory
+        self.profile = Profile()
+        self._started_tracing = False
+
+    def __enter__(self):
+        with _state.lock:
+            _state.profiles.append(self.profile)
+            _state.active = True
+            if self.trace_memory:
+                _state.trace_memory = True
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self._started_tracing = True
+        return self.profile
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with _state.lock:
+            _state.profiles.remove(self.profile)
+            _state.active = bool(_state.profiles or _state.hooks)
+            if self._started_tracing:
+                tracemalloc.stop()
+                _state.trace_memory = False
+        return False
+
+
+def enabled():
+    """
+    Check whether profiling is enabled
+    :return: True if calls are recorded
+    """
+    return _state.active
+
+
+def add_hook(hook):
+    """
+    Register a function that is called with every record, e.g. to forward it to a metrics collector. Registering a
+    hook enables profiling.
+    :param hook: Function that is called with the record dictionary
+    :type hook: callable
+    :return: None
+    """
+    with _state.lock:
+        _state.hooks.append(hook)
+        _state.active = True
+
+
+def remove_hook(hook):
+    """
+    Remove a registered hook
+    :param hook: Registered function
+    :type hook: callable
+    :return: None
+    """
+    with _state.lock:
+        _state.hooks.remove(hook)
+        _state.active = bool(_state.profiles or _state.hooks)
+
+
+def _array_size(obj):
+    """
+    Number of elements of the numpy arrays in obj (also within a list or tuple)
+    :param obj: Any object
+    :type obj: object
+    :return: Number of elements
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.size
+    if isinstance(obj, (list, tuple)):
+        return sum(o.size for o in obj if isinstance(o, np.ndarray))
+    return 0
+
+
+class _Call:
+    """
+    Measurement of one instrumented call or region
+    """
+    def __init__(self, name, chrom=None, input_size=0, in_size=0):
+        self.name = name
+        self.chrom = chrom
+        self.input_size = input_size
+        self.in_size = in_size
+        self.child_peak = 0
+
+    def __enter__(self):
+        if _state.trace_memory:
+            stack = getattr(_state.local, 'stack', None)
+            if stack is None:
+                stack = _state.local.stack = []
+            current, peak = tracemalloc.get_traced_memory()
+            # Keep the peak of the enclosing call before the peak is reset for this call
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = current
+            stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def finish(self, result=None):
+        seconds = time.perf_counter() - self.start
+        peak_bytes = None
+        if _state.trace_memory and getattr(self, 'start_memory', None) is not None:
+            stack = _state.local.stack
+            stack.pop()
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            peak_bytes = peak - self.start_memory
+            if stack:
+                stack[-1].child_peak = max(stack[-1].child_peak, peak)
+        _emit({
+            'function': self.name,
+            'chrom': self.chrom,
+            'seconds': seconds,
+            'input_size': self.input_size,
+            'in_size': self.in_size,
+            'out_size': _array_size(result),
+            'peak_bytes': peak_bytes
+        })
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+        return False
+
+
+def _emit(record):
+    """
+    Store a record in all active profiles and pass it to the hooks
+    :param record: Call record
+    :type record: dict
+    :return: None
+    """
+    with _state.lock:
+        for p in _state.profiles:
+            p.records.append(record)
+        hooks = list(_state.hooks)
+    for hook in hooks:
+        hook(record)
+
+
+class _NullRegion:
+    """
+    Region that does nothing, used when profiling is disabled
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_REGION = _NullRegion()
+
+
+def region(name, chrom=None, input_size=0, size=0):
+    """
+    Context manager that records a code region, e.g. the processing of one chromosome
+    :param name: Name of the region
+    :type name: str
+    :param chrom: Chromosome that is processed in the region
+    :type chrom: str
+    :param input_size: Size of the files that are processed in the region in bytes
+    :type input_size: int
+    :param size: Number of processed array elements
+    :type size: int
+    :return: Context manager
+    """
+    if not _state.active:
+        return _NULL_REGION
+    return _Call(name, chrom=chrom, input_size=input_size, in_size=size)
+
+
+def instrument(func=None, name=None, chrom_arg=None, path_arg=None):
+    """
+    Decorator that records every call of a function when profiling is enabled
+    :param func: Decorated function
+    :type func: callable
+    :param name: Name of the record. Default is module.function
+    :type name: str
+    :param chrom_arg: Name of the argument that holds the chromosome name, to aggregate the calls per chromosome
+    :type chrom_arg: str
+    :param path_arg: Name of the argument that holds a file path (or list of paths); the file sizes are recorded as
+    input size. This is not the number of bytes that are actually read, e.g. header_stats only reads the header and
+    cached values are read from the cache instead
+    :type path_arg: str
+    :return: Instrumented function
+    """
+    if func is None:
+        return functools.partial(instrument, name=name, chrom_arg=chrom_arg, path_arg=path_arg)
+
+    if name is None:
+        name = '%s.%s' % (func.__module__.rsplit('.', 1)[-1], func.__name__)
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state.active:
+            return func(*args, **kwargs)
+        bound = signature.bind_partial(*args, **kwargs).arguments
+        in_size = sum(_array_size(v) for v in bound.values())
+        call = _Call(name, chrom=bound.get(chrom_arg) if chrom_arg else None,
+                     input_size=_file_size(bound.get(path_arg)) if path_arg else 0, in_size=in_size)
+        call.__enter__()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return result
+        finally:
+            call.finish(result)
+    return wrapper
+
+
+def _file_size(path):
+    """
+    Size of a file or the total size of several files
+    :param path: Path or list of paths. Other objects are ignored
+    :type path: str or list(str)
+    :return: Size in bytes
+    """
+    paths = path if isinstance(path, (list, tuple)) else [path]
+    size = 0
+    for p in paths:
+        if isinstance(p, str) and os.path.isfile(p):
+            size += os.path.getsize(p)
+    return size
+
+
+def _profile_from_env():
+    """
+    Enable profiling for the whole process if the environment variable DATAHANDLER_PROFILE is set
+    :return: None
+    """
+    target = os.environ.get('DATAHANDLER_PROFILE')
+    if not target or target == '0':
+        return
+    context = profile(trace_memory=os.environ.get('DATAHANDLER_PROFILE_MEMORY', '0') not in ('', '0'))
+    prof = context.__enter__()
+
+    def report():
+        context.__exit__(None, None, None)
+        if target.endswith('.json'):
+            prof.to_json(target)
+        else:
+            sys.stderr.write(prof.format_summary() + '\n')
+    atexit.register(report)
+
+
+_profile_from_env()
@@ -7,14 +7,28 @@ The provided functions are
 * load_bam_bed_file - Load bam or bed file
 * load_gff - Load gff annotation file
 * load_big_file - load bigwig file
+* write_big_file - Write a concatenated genome array as bigwig file
 * load_fast - Load fasta or fastq file
+* load_fasta_index - Load fasta file with random access through a faidx index
+* HandlePool - Pool of open file handles with least-recently-used eviction
+* open_big_file - Context-managed bigwig file from the handle pool
+* open_bam_bed_file - Context-managed bam or bed file from the handle pool
+* open_gff - Context-managed gff annotation file from the handle pool
+* set_max_open_files - Set the maximal number of open files in the handle pool
+* close_files - Close all idle files in the handle pool
 * create_bed_random_fragments - Create random fragments and save them in a bed file
 """
 import os
+import threading
+import contextlib
+import functools
+from collections import OrderedDict
 import numpy as np
 import pyBigWig
 from pybedtools import BedTool
 from Bio import SeqIO
+from datahandler.fasta import IndexedFasta
+from datahandler import intervals, profiling
 
 
 def set_path(name, rel_path='data', is_abs_path=False):
@@ -35,6 +49,148 @@ def set_path(name, rel_path='data', is_abs_path=False):
         return name
 
 
+def _file_stamp(path):
+    """
+    Identity of the file content as inode, size and modification time. A file that was rewritten or replaced gets a
+    different stamp
+    :param path: Path to file
+    :type path: str
+    :return: Tuple with inode, size and modification time in nanoseconds
+    """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def _close_handle(handle):
+    """
+    Close a file handle if it can be closed
+    :param handle: File handle
+    :type handle: object
+    :return: None
+    """
+    close = getattr(handle, 'close', None)
+    if close is not None:
+        close()
+
+
+# Function that opens a file and flag whether a handle can be used by several users at the same time. Text files have
+# a file position, hence every user gets a handle of its own
+_OPENERS = {
+    'bigwig': (pyBigWig.open, True),
+    'bed': (BedTool, True),
+    'text': (open, False)
+}
+
+
+class HandlePool:
+    """
+    Pool of open file handles with least-recently-used eviction. Handles are keyed by kind and resolved path and are
+    handed out as context managers, such that they are returned to the pool even if an exception is raised. Every
+    handle is stored with the inode, size and modification time of the file when it was opened; if the file was
+    rewritten or replaced since, the handle is dropped and the file is opened again. Idle
+    handles are closed when the number of pooled files exceeds max_open; handles that are in use are never closed.
+    A handle is only shared within a thread, since bigwig handles are not thread-safe. If the process was forked,
+    the inherited handles are dropped and the child process opens its own handles.
+    """
+    def __init__(self, max_open=64):
+        """
+        :param max_open: Maximal number of open files in the pool
+        :type max_open: int
+        """
+        if max_open < 1:
+            raise ValueError('max_open must be at least 1.')
+        self.max_open = max_open
+        self._reset()
+
+    def _reset(self):
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Inherited handles share the file offsets with the parent process and must not be used
+            self._reset()
+
+    @contextlib.contextmanager
+    def open(self, path, kind='bigwig'):
+        """
+        Get a handle from the pool or open the file
+        :param path: Path to the file
+        :type path: str
+        :param kind: Kind of the file. Possible are 'bigwig' (bigWigFile), 'bed' (BedTool) and 'text' (file object)
+        :type kind: str
+        :return: Context manager that yields the file handle
+        """
+        if kind not in _OPENERS:
+            raise ValueError('Kind %s is not supported. Use bigwig, bed or text.' % kind)
+        key = (kind, os.path.realpath(path))
+        handle, pooled = self._acquire(key, _file_stamp(key[1]))
+        try:
+            yield handle
+        finally:
+            self._release(key, handle, pooled)
+
+    def _acquire(self, key, stamp):
+        opener, shared = _OPENERS[key[0]]
+        self._check_pid()
+        thread = threading.get_ident()
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is not None and entry[3] != stamp:
+                # The file changed on disk. An idle handle is closed; a handle in use is closed on release
+                del self._handles[key]
+                if entry[1] == 0:
+                    _close_handle(entry[0])
+                entry = None
+            if entry is not None and (entry[1] == 0 or (shared and entry[2] == thread)):
+                entry[1] += 1
+                entry[2] = thread
+                self._handles.move_to_end(key)
+                if entry[1] == 1 and not shared:
+                    entry[0].seek(0)
+                return entry[0], True
+        handle = opener(key[1])
+        with self._lock:
+            if key in self._handles:
+                # The file is in use by another thread or another user, hence the handle is not pooled
+                return handle, False
+            self._handles[key] = [handle, 1, thread, stamp]
+            self._evict()
+        return handle, True
+
+    def _release(self, key, handle, pooled):
+        with self._lock:
+            entry = self._handles.get(key)
+            if pooled and entry is not None and entry[0] is handle and self._pid == os.getpid():
+                entry[1] -= 1
+                self._evict()
+                return
+        if self._pid == os.getpid():
+            _close_handle(handle)
+
+    def _evict(self):
+        idle = [key for key, entry in self._handles.items() if entry[1] == 0]
+        for key in idle[:max(len(self._handles) - self.max_open, 0)]:
+            _close_handle(self._handles.pop(key)[0])
+
+    def close(self):
+        """
+        Close all idle handles. Handles that are in use are closed when they are released
+        :return: None
+        """
+        self._check_pid()
+        with self._lock:
+            for key in [key for key, entry in self._handles.items() if entry[1] == 0]:
+                _close_handle(self._handles.pop(key)[0])
+            # Handles in use are removed from the pool, which closes them on release
+            self._handles.clear()
+
+    def __len__(self):
+        return len(self._handles)
+
+
+@profiling.instrument(path_arg='name')
 def load_bam_bed_file(name, rel_path='data', is_abs_path=False):
     """
     Load bam or bed file
@@ -51,6 +207,7 @@ def load_bam_bed_file(name, rel_path='data', is_abs_path=False):
     return file
 
 
+@profiling.instrument(path_arg='name')
 def load_gff(name, rel_path='data', is_abs_path=False):
     """
     Load gff annotation file
@@ -60,13 +217,14 @@ def load_gff(name, rel_path='data', is_abs_path=False):
     :type rel_path: str
     :param is_abs_path: If True, name is interpreted as absolute path.
     :type is_abs_path: bool
-    :return: Pipe to file
+    :return: Pipe to file, which must be closed by the caller. Use open_gff to get a context-managed file
     """
     path = set_path(name, rel_path=rel_path, is_abs_path=is_abs_path)
     file = open(path)
     return file
 
 
+@profiling.instrument(path_arg='name')
 def load_big_file(name, rel_path='data', is_abs_path=False):
     """
     Load bigwig file
@@ -83,7 +241,134 @@ def load_big_file(name, rel_path='data', is_abs_path=False):
     return file
 
 
-def load_fast(name, rel_path='data', is_abs_path=False, is_fastq=True):
+@profiling.instrument
+def write_big_file(name, values, chrom_start, rel_path='data', is_abs_path=False, bin_size=None, chroms=None,
+                   skip_zeros=True, batch_size=2**22):
+    """
+    Write a concatenated genome array (e.g. returned by seqDataHandler.get_values, smooth or remap_norm) as bigwig
+    file. Stretches of constant values are run-length encoded with vectorised comparisons and written as bedGraph
+    entries in large batches. With bin_size, the values are written as fixed-step entries with span and step
+    bin_size. NaN values are treated as missing and not written (and as zero when averaging a bin).
+    :param name: Name of the file or absolute path if is_abs_path is set to True
+    :type name: str
+    :param values: Concatenated genome array
+    :type values: numpy.array
+    :param chrom_start: Dictionary with index positions where the chromosomes start
+    :type chrom_start: dict
+    :param rel_path: Relative path without the name from current directory
+    :type rel_path: str
+    :param is_abs_path: If True, name is interpreted as absolute path.
+    :type is_abs_path: bool
+    :param bin_size: If set, fixed-step entries of this size are written. A base-pair array is averaged per bin
+    first. If the array is already binned (see seqDataHandler.get_values), chroms must be passed
+    :type bin_size: int
+    :param chroms: Dictionary with chromosome name as key and chromosome size as value. Needed for binned arrays, where
+    the chromosome sizes cannot be derived from chrom_start. If None, the sizes are derived from chrom_start
+    :type chroms: dict
+    :param skip_zeros: If True, zero values are not written, which is equivalent for get_values since missing
+    values are set to zero
+    :type skip_zeros: bool
+    :param batch_size: Number of array values that are encoded and written per batch
+    :type batch_size: int
+    :return: None
+    """
+    values = np.asarray(values)
+    layout = intervals.chrom_sizes(chrom_start, values.size)
+    if chroms is None:
+        chroms = layout
+    is_binned = bin_size is not None and intervals.chrom_layout(chroms, bin_size=bin_size)[0] == chrom_start \
+        and sum(-(-length // bin_size) for length in chroms.values()) == values.size
+    if not is_binned and any(layout[chrom] != length for chrom, length in chroms.items()):
+        raise ValueError('The chromosome sizes do not match the layout of the genome array.')
+
+    path = set_path(name, rel_path=rel_path, is_abs_path=is_abs_path)
+    bw = pyBigWig.open(path, 'w')
+    try:
+        bw.addHeader([(chrom, int(length)) for chrom, length in chroms.items()])
+        for chrom, length in chroms.items():
+            chrom_values = values[chrom_start[chrom]:chrom_start[chrom] + layout[chrom]]
+            if bin_size is None:
+                _write_runs(bw, chrom, chrom_values, skip_zeros, batch_size)
+                continue
+            if not is_binned:
+                # Mean per bin, where missing values count as zero; the last bin of the chromosome can be shorter
+                edges = np.arange(0, length, bin_size)
+                chrom_values = np.add.reduceat(np.nan_to_num(chrom_values), edges, dtype=np.float64) / np.diff(
+                    np.append(edges, length))
+            _write_fixed_step(bw, chrom, length, chrom_values, bin_size, skip_zeros, batch_size)
+    finally:
+        bw.close()
+
+
+def _write_runs(bw, chrom, chrom_values, skip_zeros, batch_size):
+    """
+    Run-length encode the values of one chromosome and write them as bedGraph entries
+    :param bw: Bigwig file opened for writing
+    :type bw: bigWigFile
+    :param chrom: Chromosome name
+    :type chrom: str
+    :param chrom_values: Values of the chromosome
+    :type chrom_values: numpy.array
+    :param skip_zeros: If True, zero runs are not written
+    :type skip_zeros: bool
+    :param batch_size: Number of values that are encoded per batch
+    :type batch_size: int
+    :return: None
+    """
+    for b_start in range(0, chrom_values.size, batch_size):
+        batch = chrom_values[b_start:b_start + batch_size]
+        missing = np.isnan(batch)
+        # A run ends where the value changes; adjacent NaN values belong to the same run
+        change = np.flatnonzero((batch[1:] != batch[:-1]) & ~(missing[1:] & missing[:-1])) + 1
+        starts = np.concatenate([[0], change])
+        ends = np.append(change, batch.size)
+        run_values = batch[starts].astype(np.float64)
+        keep = ~missing[starts]
+        if skip_zeros:
+            keep &= run_values != 0
+        if not np.any(keep):
+            continue
+        bw.addEntries(np.repeat(chrom, np.count_nonzero(keep)), (starts[keep] + b_start).astype(np.int64),
+                      ends=(ends[keep] + b_start).astype(np.int64), values=run_values[keep])
+
+
+def _write_fixed_step(bw, chrom, length, bin_values, bin_size, skip_zeros, batch_size):
+    """
+    Write the binned values of one chromosome as fixed-step entries. Every contiguous stretch of written bins is one
+    fixed-step block; the last bin is written as bedGraph entry if it is shorter than bin_size.
+    :param bw: Bigwig file opened for writing
+    :type bw: bigWigFile
+    :param chrom: Chromosome name
+    :type chrom: str
+    :param length: Chromosome size
+    :type length: int
+    :param bin_values: Values per bin
+    :type bin_values: numpy.array
+    :param bin_size: Number of bases per bin
+    :type bin_size: int
+    :param skip_zeros: If True, zero bins are not written
+    :type skip_zeros: bool
+    :param batch_size: Maximal number of bins per fixed-step block
+    :type batch_size: int
+    :return: None
+    """
+    bin_values = np.asarray(bin_values, dtype=np.float64)
+    keep = ~np.isnan(bin_values)
+    if skip_zeros:
+        keep &= bin_values != 0
+    n_full = length // bin_size
+    # Boundaries of the stretches of kept full bins
+    edges = np.diff(np.concatenate([[False], keep[:n_full], [False]]).astype(np.int8))
+    for r_start, r_end in zip(np.flatnonzero(edges == 1).tolist(), np.flatnonzero(edges == -1).tolist()):
+        for b_start in range(r_start, r_end, batch_size):
+            b_end = min(b_start + batch_size, r_end)
+            bw.addEntries(chrom, b_start * bin_size, values=bin_values[b_start:b_end], span=bin_size, step=bin_size)
+    if n_full < bin_values.size and keep[n_full]:
+        bw.addEntries([chrom], [n_full * bin_size], ends=[int(length)], values=[float(bin_values[n_full])])
+
+
+@profiling.instrument(path_arg='name')
+def load_fast(name, rel_path='data', is_abs_path=False, is_fastq=True, stream=False):
     """
     Load fasta or fastq file
     :param name: Name of the file or absolute path if is_abs_path is set to True
@@ -94,41 +379,196 @@ def load_fast(name, rel_path='data', is_abs_path=False, is_fastq=True):
     :type is_abs_path: bool
     :param is_fastq: If true, the loaded file is interpreted as fastq
     :type is_fastq: bool
-    :return: Parsed fasta/fastq file converted to a list to make it reusable
+    :param stream: If true, the records are parsed lazily one at a time instead of loading the whole file
+    :type stream: bool
+    :return: Parsed fasta/fastq file converted to a list to make it reusable, or an iterator if stream is set
     """
     path = set_path(name, rel_path=rel_path, is_abs_path=is_abs_path)
-    if is_fastq:
-        return list(SeqIO.parse(path, 'fastq'))
-    else:
-        return list(SeqIO.parse(path, 'fasta'))
+    records = SeqIO.parse(path, 'fastq' if is_fastq else 'fasta')
+    if stream:
+        return records
+    return list(records)
 
 
-def create_bed_random_fragments(chrom_dict, max_chunk=6000, name='random_fragments', path='/'):
+@profiling.instrument(path_arg='name')
+def load_fasta_index(name, rel_path='data', is_abs_path=False, two_bit=False):
+    """
+    Load fasta file with random access through a faidx index. The index is created next to the fasta file if it does
+    not exist yet. The sequence is served as memory-mapped numpy.uint8 arrays instead of being parsed into memory.
+    :param name: Name of the file or absolute path if is_abs_path is set to True
+    :type name: str
+    :param rel_path: Relative path without the name from current directory
+    :type rel_path: str
+    :param is_abs_path: If True, name is interpreted as absolute path.
+    :type is_abs_path: bool
+    :param two_bit: If True, the sequence is served from a compact 2-bit packed cache next to the fasta file
+    :type two_bit: bool
+    :return: IndexedFasta object
     """
-    Create random fragments and save them in a bed file
+    path = set_path(name, rel_path=rel_path, is_abs_path=is_abs_path)
+    return IndexedFasta(path, two_bit=two_bit)
+
+
+_pool = HandlePool()
+
+
+def open_big_file(name, rel_path='data', is_abs_path=False):
+    """
+    Get a bigwig file from the handle pool. The file stays open after the with block and is reused by later calls
+    with the same path. Usage: with open_big_file(path, is_abs_path=True) as bw: ...
+    :param name: Name of the file or absolute path if is_abs_path is set to True
+    :type name: str
+    :param rel_path: Relative path without the name from current directory
+    :type rel_path: str
+    :param is_abs_path: If True, name is interpreted as absolute path.
+    :type is_abs_path: bool
+    :return: Context manager that yields a bigWigFile object
+    """
+    return _pool.open(set_path(name, rel_path=rel_path, is_abs_path=is_abs_path), kind='bigwig')
+
+
+def open_bam_bed_file(name, rel_path='data', is_abs_path=False):
+    """
+    Get a bam or bed file from the handle pool
+    :param name: Name of the file or absolute path if is_abs_path is set to True
+    :type name: str
+    :param rel_path: Relative path without the name from current directory
+    :type rel_path: str
+    :param is_abs_path: If True, name is interpreted as absolute path.
+    :type is_abs_path: bool
+    :return: Context manager that yields a BedTool file object
+    """
+    return _pool.open(set_path(name, rel_path=rel_path, is_abs_path=is_abs_path), kind='bed')
+
+
+def open_gff(name, rel_path='data', is_abs_path=False):
+    """
+    Get a gff annotation file from the handle pool. The file is positioned at the beginning
+    :param name: Name of the file or absolute path if is_abs_path is set to True
+    :type name: str
+    :param rel_path: Relative path without the name from current directory
+    :type rel_path: str
+    :param is_abs_path: If True, name is interpreted as absolute path.
+    :type is_abs_path: bool
+    :return: Context manager that yields the file object
+    """
+    return _pool.open(set_path(name, rel_path=rel_path, is_abs_path=is_abs_path), kind='text')
+
+
+def set_max_open_files(max_open):
+    """
+    Set the maximal number of open files in the handle pool. Idle files beyond the limit are closed
+    :param max_open: Maximal number of open files
+    :type max_open: int
+    :return: None
+    """
+    if max_open < 1:
+        raise ValueError('max_open must be at least 1.')
+    with _pool._lock:
+        _pool.max_open = max_open
+        _pool._evict()
+
+
+def close_files():
+    """
+    Close all idle files in the handle pool
+    :return: None
+    """
+    _pool.close()
+
+
+@profiling.instrument
+def create_bed_random_fragments(chrom_dict, max_chunk=6000, name='random_fragments', path='/', seed=None,
+                                lengths=None, replicates=1, in_memory=False):
+    """
+    Create random fragments and save them in a bed file. Every chromosome is tiled with consecutive fragments whose
+    lengths are drawn in batches from a numpy.random.Generator. By default, the lengths are uniformly distributed
+    between 1 and max_chunk; alternatively, they are sampled from a given length distribution.
     :param chrom_dict: Dictionary with chromosome name as key and chromosome size as value
     :type chrom_dict: dict
-    :param max_chunk: Maximal size of a fragment
+    :param max_chunk: Maximal size of a fragment. Ignored if lengths is passed
     :type max_chunk: int
-    :param name: Name of the bed file that is to be created
+    :param name: Name of the bed file that is to be created. If replicates is larger than 1, the replicate number is
+    appended to the name (e.g. random_fragments_0.bed)
     :type name: str
     :param path: Path where the bed file is to be saved
     :type path: str
-    :return: None
+    :param seed: Seed or numpy.random.Generator to make the fragments reproducible
+    :type seed: int or numpy.random.Generator
+    :param lengths: Fragment lengths whose distribution is matched, e.g. the interval lengths of a reference bed file.
+    Can be an array with lengths, an IntervalTable, or a bed file as path or BedTool object
+    :type lengths: numpy.array or IntervalTable or str or BedTool
+    :param replicates: Number of independent fragment sets that are created
+    :type replicates: int
+    :param in_memory: If True, no file is written and the fragments are returned as IntervalTable
+    :type in_memory: bool
+    :return: None, or IntervalTable (list of IntervalTables if replicates is larger than 1) if in_memory is set
     """
-    curr_dir = os.getcwd()
-    bed = open('%s/%s/%s.bed' % (curr_dir, path, name), 'w+')
-    for chrom, length in chrom_dict.items():
-        count = 0
-        while True:
-            next_stop = count + int(np.random.random() * max_chunk)
-            if next_stop >= length:
-                next_stop = length - 1
+    rng = np.random.default_rng(seed)
+    if lengths is not None:
+        if isinstance(lengths, (str, BedTool)):
+            lengths = intervals.parse_bed(lengths)
+        if isinstance(lengths, intervals.IntervalTable):
+            lengths = lengths.end - lengths.start
+        lengths = np.asarray(lengths, dtype=np.int64)
+        lengths = lengths[lengths > 0]
+        if lengths.size == 0:
+            raise ValueError('The length distribution must contain at least one positive length.')
+        draw = functools.partial(rng.choice, lengths)
+        mean_length = lengths.mean()
+    else:
+        draw = functools.partial(rng.integers, 1, max_chunk, endpoint=True)
+        mean_length = (1 + max_chunk) / 2.
+
+    tables = []
+    for _ in range(replicates):
+        chrom, start, end = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for num, length in enumerate(chrom_dict.values()):
+            f_start, f_end = _random_tiling(length, draw, mean_length)
+            chrom.append(np.full(f_start.size, num, dtype=np.int32))
+            start.append(f_start)
+            end.append(f_end)
+        start = np.concatenate(start)
+        tables.append(intervals.IntervalTable(
+            chrom=np.concatenate(chrom),
+            start=start,
+            end=np.concatenate(end),
+            strand=np.zeros(start.size, dtype=np.int8),
+            name=np.full(start.size, -1, dtype=np.int64),
+            chrom_names=list(chrom_dict.keys()),
+            names=None
+        ))
+
+    if in_memory:
+        return tables[0] if replicates == 1 else tables
 
-            bed.write('%s\t%s\t%s\n' % (chrom, count, next_stop))
-            if next_stop >= length - 1:
-                break
-            count = next_stop
+    curr_dir = os.getcwd()
+    for num, table in enumerate(tables):
+        file_name = name if replicates == 1 else '%s_%d' % (name, num)
+        with open('%s/%s/%s.bed' % (curr_dir, path, file_name), 'w+') as bed:
+            bed.write(''.join(
+                '%s\t%d\t%d\n' % (table.chrom_names[c], s, e)
+                for c, s, e in zip(table.chrom.tolist(), table.start.tolist(), table.end.tolist())
+            ))
 
-    bed.close()
 
+def _random_tiling(length, draw, mean_length):
+    """
+    Tile a chromosome with consecutive fragments of random length. The lengths are drawn in batches that cover the
+    chromosome with high probability; the last fragment is clipped at the chromosome end.
+    :param length: Chromosome size
+    :type length: int
+    :param draw: Function that draws n fragment lengths
+    :type draw: callable
+    :param mean_length: Expected fragment length that is used to estimate the batch size
+    :type mean_length: float
+    :return: numpy.array with start positions, numpy.array with end positions
+    """
+    ends = np.zeros(1, dtype=np.int64)
+    while ends[-1] < length:
+        batch = int((length - ends[-1]) / mean_length * 1.1) + 16
+        ends = np.concatenate([ends, ends[-1] + np.cumsum(draw(batch), dtype=np.int64)])
+    n = int(np.searchsorted(ends, length)) + 1
+    ends = ends[:n]
+    ends[-1] = length
+    return ends[:-1], ends[1:]
@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+"""Runner module
+
+Batch runner for the typical workflow get_values -> remap_norm/center_norm -> smooth -> annotate -> rescale_all over
+many samples. The samples, the annotation and the processing steps are described in a json manifest, e.g.
+    {
+        "output_dir": "results",
+        "annotation": "genes.bed",
+        "steps": {"norm": "remap", "smooth": 200, "vec_len": 1000},
+        "samples": [{"name": "wt", "tracks": ["wt_rep1.bw", "wt_rep2.bw"]}, ...]
+    }
+Relative paths are interpreted relative to the manifest. For gff annotations, the optional entry "chrom_map" (a
+format string such as "chr%s" or a dictionary) maps the gff sequence ids to the bigwig chromosome names; by default,
+sequence ids that are not bigwig chromosomes are prefixed with "chr" if this gives a bigwig chromosome. The samples
+are processed in parallel in a process pool. A failing sample is reported and does not stop the other samples.
+Every sample is written atomically as .npz file together with a json sidecar that holds the hash of the inputs (the
+resolved paths, sizes and modification times of the files and the processing parameters), such that completed
+samples are skipped when the manifest is run again. Run with
+    seqdatahandler-run manifest.json --workers 4
+The provided functions are
+* load_manifest - Load and validate a manifest file
+* sample_hash - Hash of the inputs and parameters of a sample
+* is_complete - Check whether the outputs of a sample exist and were created from the same inputs
+* run_sample - Process one sample and write its outputs
+* run_manifest - Process all samples of a manifest in parallel
+* main - Command line entry point
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from datahandler import cache, intervals, pipeline, segments, _internal
+from datahandler import seqDataHandler as seq
+
+_STEPS = {'norm', 'smooth', 'vec_len', 'bin_size', 'dtype'}
+
+
+def load_manifest(path):
+    """
+    Load and validate a manifest file. Relative paths are resolved relative to the directory of the manifest.
+    :param path: Path to the json manifest
+    :type path: str
+    :return: Dictionary with output_dir, annotation (or None), gff_source_type, chrom_map, steps and samples
+    """
+    with open(path) as manifest_file:
+        manifest = json.load(manifest_file)
+    base = os.path.dirname(os.path.abspath(path))
+
+    def resolve(p):
+        return p if p is None else os.path.normpath(os.path.join(base, p))
+
+    steps = dict(manifest.get('steps', {}))
+    unknown = set(steps) - _STEPS
+    if unknown:
+        raise ValueError('Unknown processing steps %s. Possible are %s.' % (sorted(unknown), sorted(_STEPS)))
+    if steps.get('norm') not in (None, 'center', 'remap'):
+        raise ValueError('Normalisation method %s is not supported. Use center or remap.' % steps['norm'])
+    if steps.get('vec_len') is not None and manifest.get('annotation') is None:
+        raise ValueError('Rescaling (vec_len) requires an annotation.')
+
+    samples = manifest.get('samples', [])
+    if not samples:
+        raise ValueError('The manifest must contain at least one sample.')
+    names = [s['name'] for s in samples]
+    if len(set(names)) != len(names):
+        raise ValueError('Sample names must be unique.')
+    for sample in samples:
+        if not sample.get('tracks'):
+            raise ValueError('Sample %s does not contain any tracks.' % sample['name'])
+
+    return {
+        'output_dir': resolve(manifest.get('output_dir', 'results')),
+        'annotation': resolve(manifest.get('annotation')),
+        'gff_source_type': manifest.get('gff_source_type'),
+        'chrom_map': manifest.get('chrom_map'),
+        'steps': steps,
+        'samples': [{'name': s['name'], 'tracks': [resolve(t) for t in s['tracks']]} for s in samples]
+    }
+
+
+def sample_hash(sample, manifest):
+    """
+    Hash of the inputs and parameters of a sample. The files are identified by resolved path, size and modification
+    time (as for the cache of get_values), hence they are not read.
+    :param sample: Sample with name and tracks
+    :type sample: dict
+    :param manifest: Manifest returned by load_manifest
+    :type manifest: dict
+    :return: Hash as hex string
+    """
+    files = list(sample['tracks'])
+    if manifest['annotation'] is not None:
+        files.append(manifest['annotation'])
+    key = {
+        'inputs': [cache.source_info(f) for f in files],
+        'annotation': manifest['annotation'] is not None,
+        'gff_source_type': manifest['gff_source_type'],
+        'chrom_map': manifest.get('chrom_map'),
+        'steps': manifest['steps']
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def _output_paths(sample, manifest):
+    """
+    Paths to the output files of a sample
+    :param sample: Sample with name and tracks
+    :type sample: dict
+    :param manifest: Manifest returned by load_manifest
+    :type manifest: dict
+    :return: Path to the .npz file, path to the json sidecar
+    """
+    base = os.path.join(manifest['output_dir'], sample['name'])
+    return base + '.npz', base + '.json'
+
+
+def is_complete(sample, manifest, digest=None):
+    """
+    Check whether the outputs of a sample exist and were created from the same inputs
+    :param sample: Sample with name and tracks
+    :type sample: dict
+    :param manifest: Manifest returned by load_manifest
+    :type manifest: dict
+    :param digest: Hash of the sample. Computed if None
+    :type digest: str
+    :return: True if the sample does not need to be processed again
+    """
+    data_path, meta_path = _output_paths(sample, manifest)
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return False
+    digest = sample_hash(sample, manifest) if digest is None else digest
+    return meta.get('hash') == digest and os.path.isfile(data_path)
+
+
+def _load_annotation(manifest, chroms):
+    """
+    Parse the annotation of a manifest. The sequence ids of gff annotations are mapped to the bigwig chromosome names
+    :param manifest: Manifest returned by load_manifest
+    :type manifest: dict
+    :param chroms: Chromosome names of the bigwig files
+    :type chroms: iterable(str)
+    :return: IntervalTable
+    """
+    path = manifest['annotation']
+    if not path.endswith(('.gff', '.gff3')):
+        return intervals.parse_bed(path)
+    table = intervals.parse_gff(path, gff_source_type=manifest['gff_source_type'])
+    chrom_map = manifest.get('chrom_map')
+    if isinstance(chrom_map, str):
+        chrom_names = [chrom_map % c for c in table.chrom_names]
+    elif isinstance(chrom_map, dict):
+        chrom_names = [chrom_map.get(c, c) for c in table.chrom_names]
+    else:
+        chroms = set(chroms)
+        chrom_names = [c if c in chroms or 'chr%s' % c not in chroms else 'chr%s' % c for c in table.chrom_names]
+    return table._replace(chrom_names=chrom_names)
+
+
+def _process(sample, manifest):
+    """
+    Apply the processing steps to the tracks of a sample
+    :param sample: Sample with name and tracks
+    :type sample: dict
+    :param manifest: Manifest returned by load_manifest
+    :type manifest: dict
+    :return: Dictionary with the arrays that are saved in the .npz file
+    """
+    steps = manifest['steps']
+    dtype = steps.get('dtype', 'float32')
+    bin_size = steps.get('bin_size')
+    smooth_list = steps.get('smooth')
+    if smooth_list is not None and not isinstance(smooth_list, list):
+        smooth_list = [smooth_list] * len(sample['tracks'])
+
+    arrays = {}
+    if manifest['annotation'] is None:
+        all_values, chrom_start = seq.get_values(sample['tracks'], dtype=dtype, bin_size=bin_size)
+        if steps.get('norm') == 'center':
+            all_values = seq.center_norm_all(all_values)
+        elif steps.get('norm') == 'remap':
+            all_values = seq.remap_norm_all(all_values)
+        if smooth_list is not None:
+            all_values = seq.smooth_all(all_values, smooth_list, chrom_start=chrom_start)
+        for num, values in enumerate(all_values):
+            arrays['track%d' % num] = values
+        arrays['chrom_names'] = np.asarray(list(chrom_start.keys()), dtype=str)
+        arrays['chrom_start'] = np.asarray(list(chrom_start.values()), dtype=np.int64)
+        return arrays
+
+    with _internal.big_file(sample['tracks'][0]) as bw:
+        table = _load_annotation(manifest, bw.chroms().keys())
+    bw_gen_mapping, _ = pipeline.run_pipeline(sample['tracks'], table, norm=steps.get('norm'), smooth_list=smooth_list,
+                                              vec_len=steps.get('vec_len'), dtype=dtype, bin_size=bin_size)
+    for num, track in enumerate(bw_gen_mapping):
+        if steps.get('vec_len') is not None:
+            arrays['track%d' % num] = track
+        else:
+            container = segments.from_list(track, dtype=dtype)
+            arrays['track%d_values' % num] = container.values
+            arrays['track%d_offsets' % num] = container.offsets
+    if table.names is not None:
+        arrays['names'] = np.asarray([table.names[n] if n >= 0 else '' for n in table.name.tolist()], dtype=str)
+    return arrays
+
+
+def run_sample(sample, manifest, digest=None):
+    """
+    Process one sample and write its outputs. The .npz file and the json sidecar are written to temporary files and
+    renamed, hence an interrupted run never leaves a sample that looks complete.
+    :param sample: Sample with name and tracks
+    :type sample: dict
+    :param manifest: Manifest returned by load_manifest
+    :type manifest: dict
+    :param digest: Hash of the sample. Computed if None
+    :type digest: str
+    :return: Dictionary with name, processing time in seconds and input size (total size of the tracks in bytes)
+    """
+    digest = sample_hash(sample, manifest) if digest is None else digest
+    start = time.perf_counter()
+    arrays = _process(sample, manifest)
+    seconds = time.perf_counter() - start
+
+    data_path, meta_path = _output_paths(sample, manifest)
+    os.makedirs(manifest['output_dir'], exist_ok=True)
+    tmp_data = '%s.%d.tmp.npz' % (data_path[:-len('.npz')], os.getpid())
+    np.savez(tmp_data, **arrays)
+    os.replace(tmp_data, data_path)
+    stats = {
+        'name': sample['name'],
+        'seconds': seconds,
+        'input_size': sum(os.path.getsize(t) for t in sample['tracks'])
+    }
+    tmp_meta = '%s.%d.tmp' % (meta_path, os.getpid())
+    with open(tmp_meta, 'w') as meta_file:
+        json.dump(dict(stats, hash=digest, tracks=sample['tracks']), meta_file)
+    os.replace(tmp_meta, meta_path)
+    return stats
+
+
+def _run_sample_task(task):
+    """
+    Process one sample in a worker process
+    :param task: Tuple with sample, manifest and hash
+    :type task: tuple
+    :return: Dictionary with name, processing time and input size
+    """
+    return run_sample(*task)
+
+
+def run_manifest(manifest, workers=1, force=False, progress=None):
+    """
+    Process all samples of a manifest in parallel. Samples whose outputs were created from the same inputs are skipped.
+    A sample that fails (e.g. because a track is missing) is reported and does not stop the other samples.
+    :param manifest: Manifest returned by load_manifest
+    :type manifest: dict
+    :param workers: Number of worker processes. If 1, the samples are processed in the current process
+    :type workers: int
+    :param force: If True, completed samples are processed again
+    :type force: bool
+    :param progress: Stream to which the progress is reported, e.g. sys.stderr. If None, nothing is reported
+    :type progress: file
+    :return: List with one dictionary per processed sample (name, processing time and input size), list with the
+    names of the skipped samples and list with tuples of name and error message of the failed samples
+    """
+    tasks, skipped, failed = [], [], []
+    for sample in manifest['samples']:
+        try:
+            digest = sample_hash(sample, manifest)
+        except OSError as err:
+            failed.append((sample['name'], str(err)))
+            continue
+        if not force and is_complete(sample, manifest, digest=digest):
+            skipped.append(sample['name'])
+        else:
+            tasks.append((sample, manifest, digest))
+    if progress is not None and skipped:
+        progress.write('Skipping %d completed samples\n' % len(skipped))
+    if progress is not None:
+        for name, message in failed:
+            progress.write('%s failed: %s\n' % (name, message))
+
+    start = time.perf_counter()
+    done, input_size = [], 0
+
+    def report(name, stats=None, error=None):
+        nonlocal input_size
+        if error is not None:
+            failed.append((name, '%s: %s' % (type(error).__name__, error)))
+        else:
+            done.append(stats)
+            input_size += stats['input_size']
+        if progress is None:
+            return
+        elapsed = time.perf_counter() - start
+        finished = len(done) + len(failed)
+        if error is not None:
+            progress.write('[%d/%d] %s failed: %s\n' % (finished, len(tasks), name, failed[-1][1]))
+        else:
+            progress.write('[%d/%d] %s finished in %.1f s | %.2f samples/min, %.1f MB input/s\n' % (
+                finished, len(tasks), name, stats['seconds'], len(done) / elapsed * 60.,
+                input_size / 2.**20 / elapsed))
+        progress.flush()
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_run_sample_task, t): t[0]['name'] for t in tasks}
+            for future in as_completed(futures):
+                try:
+                    report(futures[future], stats=future.result())
+                except Exception as err:
+                    report(futures[future], error=err)
+    else:
+        for task in tasks:
+            try:
+                report(task[0]['name'], stats=_run_sample_task(task))
+            except Exception as err:
+                report(task[0]['name'], error=err)
+    return done, skipped, failed
+
+
+def main(argv=None):
+    """
+    Command line entry point
+    :param argv: Command line arguments. If None, sys.argv is used
+    :type argv: list(str)
+    :return: Exit code, which is 1 if any sample failed
+    """
+    parser = argparse.ArgumentParser(description='Process the samples of a manifest in parallel')
+    parser.add_argument('manifest', help='Path to the json manifest')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--force', action='store_true', help='Process completed samples again')
+    parser.add_argument('--output-dir', default=None, help='Overrides the output directory of the manifest')
+    parser.add_argument('--quiet', action='store_true', help='Do not report the progress')
+    args = parser.parse_args(argv)
+
+    manifest = load_manifest(args.manifest)
+    if args.output_dir is not None:
+        manifest['output_dir'] = os.path.abspath(args.output_dir)
+    done, skipped, failed = run_manifest(manifest, workers=args.workers, force=args.force,
+                                         progress=None if args.quiet else sys.stderr)
+    if not args.quiet:
+        sys.stderr.write('Processed %d samples, skipped %d, failed %d\n' % (len(done), len(skipped), len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
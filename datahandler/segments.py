@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+"""Segments module
+
+Compact ragged container for segmented data, e.g. the transcripts returned by seqDataHandler.annotate. All segments
+are stored in one contiguous values buffer and an int64 offsets array, such that segment i is
+values[offsets[i]:offsets[i + 1]]. The container can be memory mapped, shared with worker processes or saved without
+per-object overhead. The provided functions are
+* Segments - Ragged container with values buffer, offsets and segment names
+* from_list - Create a Segments container from a list of data arrays
+* to_list - Convert a Segments container to a list of data arrays
+* lengths - Length of every segment
+* save_segments - Save a Segments container with numpy.save
+* load_segments - Load a Segments container, optionally as memory map
+* reduce_segments - Reduce every segment with a numpy ufunc
+"""
+from collections import namedtuple
+import numpy as np
+
+Segments = namedtuple('Segments', ['values', 'offsets', 'names'])
+Segments.__doc__ = """
+Ragged container for segmented data. values is the contiguous data buffer, offsets an int64 array with n + 1 entries
+where segment i is values[offsets[i]:offsets[i + 1]], and names is a list with one name per segment or None.
+"""
+
+
+def from_list(arrays, names=None, dtype=None):
+    """
+    Create a Segments container from a list of data arrays
+    :param arrays: List with data arrays
+    :type arrays: list(numpy.array)
+    :param names: Name per data array
+    :type names: list(str)
+    :param dtype: Data type of the values buffer. If None, it is derived from the data arrays
+    :type dtype: str or numpy.dtype
+    :return: Segments
+    """
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum([len(a) for a in arrays], out=offsets[1:])
+    if dtype is None:
+        dtype = np.result_type(*map(np.asarray, arrays)) if len(arrays) > 0 else np.float64
+    values = np.empty(offsets[-1], dtype=dtype)
+    for a, start, end in zip(arrays, offsets[:-1], offsets[1:]):
+        values[start:end] = a
+    return Segments(values=values, offsets=offsets, names=None if names is None else list(names))
+
+
+def to_list(segments):
+    """
+    Convert a Segments container to a list of data arrays. The data arrays are views on the values buffer.
+    :param segments: Segmented data
+    :type segments: Segments
+    :return: List with data arrays
+    """
+    offsets = segments.offsets.tolist()
+    return [segments.values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def lengths(segments):
+    """
+    Length of every segment
+    :param segments: Segmented data
+    :type segments: Segments
+    :return: numpy.array with segment lengths
+    """
+    return np.diff(segments.offsets)
+
+
+def save_segments(path, segments):
+    """
+    Save a Segments container with numpy.save. The values, offsets and names are stored in the files
+    path.values.npy, path.offsets.npy and path.names.npy
+    :param path: Path prefix of the created files
+    :type path: str
+    :param segments: Segmented data
+    :type segments: Segments
+    :return: None
+    """
+    np.save('%s.values.npy' % path, segments.values)
+    np.save('%s.offsets.npy' % path, segments.offsets)
+    if segments.names is not None:
+        np.save('%s.names.npy' % path, np.asarray(segments.names, dtype=str))
+
+
+def load_segments(path, mmap_mode=None):
+    """
+    Load a Segments container, optionally as memory map
+    :param path: Path prefix of the files that were created with save_segments
+    :type path: str
+    :param mmap_mode: Memory map mode passed to numpy.load (e.g. 'r'). If None, the values are loaded into memory
+    :type mmap_mode: str
+    :return: Segments
+    """
+    values = np.load('%s.values.npy' % path, mmap_mode=mmap_mode)
+    offsets = np.load('%s.offsets.npy' % path)
+    try:
+        names = np.load('%s.names.npy' % path).tolist()
+    except FileNotFoundError:
+        names = None
+    return Segments(values=values, offsets=offsets, names=names)
+
+
+def _nonempty_starts(segments):
+    """
+    Start indices of the non-empty segments, which can be passed to numpy.ufunc.reduceat
+    :param segments: Segmented data
+    :type segments: Segments
+    :return: numpy.array with boolean mask of non-empty segments, numpy.array with start indices
+    """
+    nonempty = np.diff(segments.offsets) > 0
+    return nonempty, segments.offsets[:-1][nonempty]
+
+
+def reduce_segments(ufunc, segments, empty=np.nan):
+    """
+    Reduce every segment with a numpy ufunc (e.g. numpy.add or numpy.maximum)
+    :param ufunc: Reduction function
+    :type ufunc: numpy.ufunc
+    :param segments: Segmented data
+    :type segments: Segments
+    :param empty: Value for empty segments
+    :type empty: float
+    :return: numpy.array with one value per segment
+    """
+    nonempty, starts = _nonempty_starts(segments)
+    result = np.full(nonempty.size, empty, dtype=np.result_type(segments.values.dtype, type(empty)))
+    if starts.size > 0:
+        result[nonempty] = ufunc.reduceat(segments.values, starts)
+    return result
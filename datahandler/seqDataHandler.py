@@ -6,6 +6,8 @@ manipulate them. This includes the following functions
 
 * center_norm - Normalise data by subtracting the mean and dividing the standard deviation
 * remap_norm - Normalise data by remapping all data values between 0 (minimum) and 1 (maximum)
+* header_stats - Derive the global normalisation statistics from the bigwig header
+* array_stats - Compute the global normalisation statistics of a data array in a single pass over chunks
 * smooth - Smooth data with a moving-average window
 * annotate_gff_from_bw - Segment bigwig file according to gff annotation file
 * annotate - Segment data according to bed annotation file
@@ -17,115 +19,457 @@ manipulate them. This includes the following functions
 * rescale_all - Wrapper function to rescale all data arrays in a list
 * get_values  - Retrieve all data values from bigwig file and concatenate them together
 """
+import os
+import shutil
+import struct
+import tempfile
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import scipy.interpolate as interp
-from BCBio import GFF
-from datahandler.reader import load_gff
+import pyBigWig
+from datahandler import cache, intervals, profiling, segments
+from datahandler._internal import as_table as _interval_table, segment_slices as _segment_slices
+from datahandler._internal import big_file as _big_file, fill_chrom as _fill_chrom
+from datahandler._internal import merge_moments as _merge_moments, moments_stats as _moments_stats
+from datahandler._internal import rescale_batch as _rescale_batch
 
+_BIGWIG_MAGIC = 0x888FFC26
+# Smallest variance, relative to the mean of the squares, that header_stats derives from the sums in the header
+_MIN_HEADER_VAR = 1e-8
 
-def center_norm(data):
+
+@profiling.instrument
+def center_norm(data, out=None, stats=None, chunk_size=2**22):
     """
-    Normalise data by subtracting the mean and dividing the standard deviation
+    Normalise data by subtracting the mean and dividing the standard deviation. The data is processed in chunks, hence
+    no temporary array of the size of data is created.
     :param data: Data array
     :type data: numpy.array
+    :param out: Optional output array with the size of data. Pass data itself to normalise in place
+    :type out: numpy.array
+    :param stats: Precomputed statistics (minimum, maximum, mean, standard deviation) as returned by header_stats or
+    array_stats. If None, they are computed from data
+    :type stats: tuple
+    :param chunk_size: Number of values that are processed at once
+    :type chunk_size: int
     :return: Normalised data array
     """
-    return (data - data.mean()) / data.std()
+    _, _, mean, std = array_stats(data, chunk_size=chunk_size) if stats is None else stats
+    out = _norm_out(data, out)
+    scalar = out.dtype.type
+    for start in range(0, data.size, chunk_size):
+        chunk = np.subtract(data[start:start + chunk_size], scalar(mean), out=out[start:start + chunk_size])
+        chunk /= scalar(std)
+    return out
 
 
-def remap_norm(data):
+@profiling.instrument
+def remap_norm(data, out=None, stats=None, chunk_size=2**22):
     """
-    Normalise data by remapping all data values between 0 (minimum) and 1 (maximum)
+    Normalise data by remapping all data values between 0 (minimum) and 1 (maximum). The data is processed in chunks,
+    hence no temporary array of the size of data is created. data is only changed if it is passed as out.
     :param data: Data array
     :type data: numpy array
+    :param out: Optional output array with the size of data. Pass data itself to normalise in place
+    :type out: numpy.array
+    :param stats: Precomputed statistics (minimum, maximum, mean, standard deviation) as returned by header_stats or
+    array_stats. If None, minimum and maximum are computed from data
+    :type stats: tuple
+    :param chunk_size: Number of values that are processed at once
+    :type chunk_size: int
     :return: Normalised data array
     """
-    data -= data.min()
-    return data / data.max()
+    data_min, data_max = (data.min(), data.max()) if stats is None else stats[:2]
+    out = _norm_out(data, out)
+    scalar = out.dtype.type
+    data_range = scalar(data_max) - scalar(data_min)
+    for start in range(0, data.size, chunk_size):
+        chunk = np.subtract(data[start:start + chunk_size], scalar(data_min), out=out[start:start + chunk_size])
+        chunk /= data_range
+    return out
+
+
+def _norm_out(data, out):
+    """
+    Create or check the output array of the normalisation functions
+    :param data: Data array
+    :type data: numpy.array
+    :param out: Output array or None
+    :type out: numpy.array
+    :return: Output array
+    """
+    if out is None:
+        return np.empty(data.shape, dtype=data.dtype if data.dtype.kind == 'f' else np.float64)
+    if out.shape != data.shape:
+        raise ValueError('out must have the same shape as data.')
+    return out
+
+
+@profiling.instrument(path_arg='bw_path')
+def header_stats(bw_path, bin_size=None):
+    """
+    Derive the global normalisation statistics of the concatenated genome array from the bigwig header. Bases without
+    values count as zero, which is the same as for the arrays returned by get_values. The statistics are computed in
+    constant time from the total summary, which is read directly from the file, since pyBigWig reports the summary
+    values in bigWigFile.header() as integers. libBigWig never compares the first value of a file with the maximum of
+    the total summary, hence the maximum is corrected with the first value. If the header cannot give the statistics,
+    i.e. the maximum of a fully covered genome without positive values is unknown, or the variance would lose more
+    than half of its digits when derived from the sums, the statistics are computed in a single pass over the values
+    as in array_stats.
+    :param bw_path: Path to the bigwig file
+    :type bw_path: str
+    :param bin_size: Not supported. The header summarises single bases, hence the statistics of binned arrays must be
+    computed with array_stats
+    :type bin_size: int
+    :return: Tuple with minimum, maximum, mean and standard deviation
+    """
+    if bin_size is not None:
+        raise ValueError('Header statistics are only available for base-pair resolution. Use array_stats instead.')
+    if not isinstance(bw_path, str):
+        raise ValueError('Header statistics require the path to the bigwig file.')
+    bases_covered, data_min, data_max, sum_data, sum_squared = _read_total_summary(bw_path)
+    with _big_file(bw_path) as bw:
+        chroms = bw.chroms()
+        genome_size = sum(chroms.values())
+        first = _first_value(bw, chroms)
+        # libBigWig starts the maximum at the smallest positive double and only updates it with values above, hence
+        # the maximum of values below zero is unknown
+        max_unknown = data_max == np.finfo(np.float64).tiny
+        if max_unknown:
+            data_max = -np.inf
+        if first is not None:
+            data_max = max(data_max, first)
+        mean = sum_data / genome_size
+        var = sum_squared / genome_size - mean ** 2
+        if (max_unknown and data_max <= 0 and bases_covered == genome_size) or \
+                var <= _MIN_HEADER_VAR * sum_squared / genome_size:
+            return _scan_stats(bw, chroms)
+    if bases_covered < genome_size:
+        data_min, data_max = min(data_min, 0.), max(data_max, 0.)
+    return data_min, data_max, mean, np.sqrt(var)
+
+
+def _first_value(bw, chroms):
+    """
+    Find the first value of a bigwig file. The chromosomes are searched in windows of increasing size, such that
+    only the start of the data is read
+    :param bw: Bigwig file
+    :type bw: bigWigFile
+    :param chroms: Dictionary with chromosome names and sizes
+    :type chroms: dict
+    :return: First value, or None if the file has no values
+    """
+    for chrom, length in chroms.items():
+        start, window = 0, 2**16
+        while start < length:
+            found = bw.intervals(chrom, start, min(start + window, length))
+            if found:
+                return found[0][2]
+            start, window = start + window, 2 * window
+    return None
+
+
+def _scan_stats(bw, chroms, chunk_size=2**22):
+    """
+    Compute the normalisation statistics of a bigwig file in a single pass over chunks of its values, as in
+    array_stats. Missing values count as zero
+    :param bw: Bigwig file
+    :type bw: bigWigFile
+    :param chroms: Dictionary with chromosome names and sizes
+    :type chroms: dict
+    :param chunk_size: Number of values that are read at once
+    :type chunk_size: int
+    :return: Tuple with minimum, maximum, mean and standard deviation
+    """
+    moments = None
+    chunk = np.empty(min(chunk_size, max(chroms.values())), dtype=np.float32)
+    for chrom, length in chroms.items():
+        for start in range(0, length, chunk_size):
+            end = min(start + chunk_size, length)
+            _fill_chrom(chunk[:end - start], bw, chrom, end, start=start)
+            moments = _merge_moments(moments, chunk[:end - start])
+    return _moments_stats(moments)
+
+
+def _read_total_summary(bw_path):
+    """
+    Read the total summary block of a bigwig file
+    :param bw_path: Path to the bigwig file
+    :type bw_path: str
+    :return: Number of covered bases, minimum, maximum, sum and sum of squares of all values
+    """
+    with open(bw_path, 'rb') as bw_file:
+        header = bw_file.read(64)
+        byte_order = '<' if struct.unpack('<I', header[:4])[0] == _BIGWIG_MAGIC else '>'
+        if struct.unpack(byte_order + 'I', header[:4])[0] != _BIGWIG_MAGIC:
+            raise ValueError('%s is not a bigwig file.' % bw_path)
+        summary_offset = struct.unpack(byte_order + 'Q', header[44:52])[0]
+        if summary_offset == 0:
+            raise ValueError('Bigwig file %s does not contain a total summary.' % bw_path)
+        bw_file.seek(summary_offset)
+        return struct.unpack(byte_order + 'Qdddd', bw_file.read(40))
 
 
-def smooth(data, smooth_size=20):
+@profiling.instrument
+def array_stats(data, chunk_size=2**22):
     """
-    Smooth data with a moving-average window
+    Compute the global normalisation statistics of a data array in a single pass over chunks. The moments of the
+    chunks are merged with the pairwise update by Chan et al. (Welford's algorithm for chunks), which is numerically
+    stable. Missing values (NaN) count as zero.
+    :param data: Data array, or two-dimensional array with one track per row
+    :type data: numpy.array
+    :param chunk_size: Number of values (per row) that are processed at once
+    :type chunk_size: int
+    :return: Tuple with minimum, maximum, mean and standard deviation. For two-dimensional data, every statistic is an
+    array with one value per row
+    """
+    moments = None
+    for start in range(0, data.shape[-1], chunk_size):
+        chunk = np.asarray(data[..., start:start + chunk_size])
+        if chunk.dtype.kind == 'f':
+            chunk = np.nan_to_num(chunk, nan=0.)
+        moments = _merge_moments(moments, chunk)
+    if moments is None:
+        raise ValueError('Data array must not be empty.')
+    return _moments_stats(moments)
+
+
+@profiling.instrument
+def smooth(data, smooth_size=20, chrom_start=None, dtype=None, out=None):
+    """
+    Smooth data with a moving-average window. The window sums are computed with running sums, which takes linear time
+    independent of the window size. Values outside of the data array are treated as zero.
     :param data: Data array
     :type data: numpy.array
     :param smooth_size: Size of the moving average window
     :type smooth_size: int
+    :param chrom_start: Dictionary with index positions where the chromosomes start. If passed, every chromosome is
+    smoothed independently such that no signal is mixed between neighbouring chromosomes
+    :type chrom_start: dict
+    :param dtype: Data type of the smoothed data. Ignored if out is passed. Default is float64
+    :type dtype: str or numpy.dtype
+    :param out: Optional output array with the size of data. Pass data itself to smooth in place. If the window is
+    longer than data, the returned array has smooth_size values unless out is passed
+    :type out: numpy.array
     :return: Smoothed data
     """
-    smoothing_window = np.ones(smooth_size) / float(smooth_size)
-    return (np.convolve(data, smoothing_window, mode='same') + np.convolve(smoothing_window, data, mode='same')) / 2.
+    if chrom_start is None and smooth_size > data.size and out is None:
+        # The moving average is longer than the data array (numpy.convolve behaviour, which returns smooth_size
+        # values). With out, the moving average of every data position is written instead
+        smoothing_window = np.ones(smooth_size) / float(smooth_size)
+        return ((np.convolve(data, smoothing_window, mode='same')
+                 + np.convolve(smoothing_window, data, mode='same')) / 2.).astype(dtype or np.float64, copy=False)
+
+    if out is None:
+        out = np.empty(data.size, dtype=np.float64 if dtype is None else dtype)
+    elif out.shape != data.shape:
+        raise ValueError('out must have the same shape as data.')
 
+    for start, end in _smooth_bounds(data.size, chrom_start):
+        _running_mean(data, out, start, end, smooth_size)
+    return out
 
-def annotate_gff_from_bw(bw, gff_path, gff_source_type=[('ensembl_havana', 'gene')]):
+
+def _smooth_bounds(size, chrom_start):
     """
-    Segment bigwig file according to gff annotation file
+    Regions that are smoothed independently
+    :param size: Size of the concatenated genome array
+    :type size: int
+    :param chrom_start: Dictionary with index positions where the chromosomes start or None
+    :type chrom_start: dict
+    :return: List with start and end index per region
+    """
+    if chrom_start is None:
+        return [(0, size)]
+    return [(start, start + c_size) for start, c_size in
+            sorted((chrom_start[c], c_size) for c, c_size in intervals.chrom_sizes(chrom_start, size).items())]
+
+
+def _running_mean(data, out, start, end, smooth_size, chunk_size=2**22):
+    """
+    Moving average over data[..., start:end] with running sums. The values are processed in chunks, and the result of
+    a chunk is only written after the next chunk has read its input, such that out can be the same array as data.
+    :param data: Data array, or two-dimensional array where every row is smoothed
+    :type data: numpy.array
+    :param out: Output array
+    :type out: numpy.array
+    :param start: First index of the smoothed region
+    :type start: int
+    :param end: End index (exclusive) of the smoothed region
+    :type end: int
+    :param smooth_size: Size of the moving average window
+    :type smooth_size: int
+    :param chunk_size: Number of values that are processed at once
+    :type chunk_size: int
+    :return: None
+    """
+    # Same window alignment as numpy.convolve with mode='same'
+    right = (smooth_size - 1) // 2
+    left = smooth_size - 1 - right
+    chunk_size = max(chunk_size, smooth_size)
+    pending = None
+    for c_start in range(start, end, chunk_size):
+        c_end = min(c_start + chunk_size, end)
+        w_start, w_end = max(c_start - left, start), min(c_end + right, end)
+        cum_sum = np.zeros(data.shape[:-1] + (w_end - w_start + 1,))
+        np.cumsum(data[..., w_start:w_end], axis=-1, dtype=np.float64, out=cum_sum[..., 1:])
+        idx = np.arange(c_start, c_end)
+        upper = np.minimum(idx + right + 1, end) - w_start
+        lower = np.maximum(idx - left, start) - w_start
+        result = (cum_sum[..., upper] - cum_sum[..., lower]) / float(smooth_size)
+        if pending is not None:
+            out[..., pending[0]:pending[0] + pending[1].shape[-1]] = pending[1]
+        pending = (c_start, result)
+    if pending is not None:
+        out[..., pending[0]:pending[0] + pending[1].shape[-1]] = pending[1]
+
+
+@profiling.instrument(path_arg='gff_path')
+def annotate_gff_from_bw(bw, gff_path, gff_source_type=[('ensembl_havana', 'gene')], chrom_map='chr%s',
+                         cache_dir=None):
+    """
+    Segment bigwig file according to gff annotation file. The gff file is parsed only once (and can be cached as
+    compiled annotation index), and the values of every chromosome are fetched once from the bigwig file and sliced
+    for all features.
     :param bw: Bigwig file
     :type bw: bigWigFile
     :param gff_path: path to gff file
     :type gff_path: str
     :param gff_source_type: parameters for which the gff file is filtered
     :type gff_source_type: list(tuple(str))
+    :param chrom_map: Mapping from gff sequence ids to bigwig chromosome names. Either a format string, a dictionary
+    or a function
+    :type chrom_map: str or dict or callable
+    :param cache_dir: Directory where the parsed gff file is cached. If None, the gff file is parsed on every call
+    :type cache_dir: str
     :return: Segmented data array
     """
-    gff = load_gff(gff_path, rel_path='', is_abs_path=True)
-    examiner = GFF.GFFExaminer()
-    chrom_list = list(examiner.available_limits(gff)['gff_id'].keys())
-    gff.close()
+    table = intervals.parse_gff(gff_path, gff_source_type=gff_source_type, cache_dir=cache_dir)
+    if isinstance(chrom_map, str):
+        chrom_map = chrom_map.__mod__
+    elif isinstance(chrom_map, dict):
+        chrom_map = chrom_map.__getitem__
 
     gen_mapping = []
-    gff = load_gff(gff_path, rel_path='', is_abs_path=True)
-    for chrom in chrom_list:
-        limit_info = dict(gff_id=chrom, gff_source_type=gff_source_type)
-        for rec in GFF.parse(gff, limit_info=limit_info):
-            for num, r in enumerate(rec.features):
-                anno = bw.values('chr%s' % chrom[0], int(r.location.start), int(r.location.end))
-                if int(r.location.strand) == -1:
-                    anno = np.flip(anno)
-                anno = np.nan_to_num(anno, copy=False, nan=0.)
-                gen_mapping.append(anno)
-
-    gff.close()
+    for c_idx, chrom in enumerate(table.chrom_names):
+        features = np.flatnonzero(table.chrom == c_idx)
+        first, last = int(table.start[features].min()), int(table.end[features].max())
+        if pyBigWig.numpy:
+            chrom_values = bw.values(chrom_map(chrom), first, last, numpy=True)
+        else:
+            chrom_values = np.asarray(bw.values(chrom_map(chrom), first, last))
+        chrom_values = np.nan_to_num(chrom_values, copy=False, nan=0.)
+        for f_start, f_end, f_strand in zip(table.start[features].tolist(), table.end[features].tolist(),
+                                            table.strand[features].tolist()):
+            anno = chrom_values[f_start - first:f_end - first]
+            gen_mapping.append(np.flip(anno) if f_strand == -1 else anno)
+
     return gen_mapping
 
 
-def annotate(data, bed_ref, chrom_start):
+@profiling.instrument
+def annotate(data, bed_ref, chrom_start, ragged=False, bin_size=None):
     """
-    Segment data according to bed annotation file
+    Segment data according to bed annotation file. The interval boundaries are computed for all intervals at once
+    and the returned segments are views on data (reversed for intervals on the minus strand). If ragged is set, all
+    segments are copied into one contiguous Segments container instead.
     :param data: Data array (it is assumed that all chromosomes are concatenated together)
     :type data: numpy.array
-    :param bed_ref: reference to bed file
-    :type bed_ref: str
+    :param bed_ref: reference to bed file or bed file parsed with intervals.parse_bed. Pass an IntervalTable when
+    the same bed file is used several times to avoid parsing it again.
+    :type bed_ref: BedTool or IntervalTable
     :param chrom_start: Dictionary with index positions where the chromosomes start
     :type chrom_start: dict
+    :param ragged: If True, return a Segments container (values buffer, offsets and names) and a dictionary which maps
+    from gene name to segment index
+    :type ragged: bool
+    :param bin_size: Bin size if data is a binned genome array (see get_values). Every segment contains all bins that
+    overlap with the interval
+    :type bin_size: int
     :return: Segmented data array, dictionary which maps from gene name to data array
     """
-    gen_mapping = []
+    table = _interval_table(bed_ref)
+    if ragged:
+        return _annotate_ragged(data, intervals.absolute_bounds(table, chrom_start, bin_size=bin_size), table)
+    return _annotate_slices(data, _segment_slices(table, chrom_start, bin_size=bin_size), table)
+
+
+def _annotate_slices(data, slices, table):
+    """
+    Segment data with precomputed slices
+    :param data: Data array (it is assumed that all chromosomes are concatenated together)
+    :type data: numpy.array
+    :param slices: List with one slice per interval
+    :type slices: list(slice)
+    :param table: Parsed intervals
+    :type table: IntervalTable
+    :return: Segmented data array, dictionary which maps from gene name to data array
+    """
+    gen_mapping = [data[sl] for sl in slices]
+    # Checking the sum is cheaper than testing every segment when there are no missing values
+    if data.dtype.kind == 'f' and not np.isfinite(data.sum()):
+        for frag_values in gen_mapping:
+            np.nan_to_num(frag_values, copy=False, nan=0.)
+
     trans_dict = {}
-    make_trans_dict = True
-    if len(list(bed_ref[0])) < 4:
+    if table.names is None:
         warnings.warn('No annotation names found. Return empty dict for trans_dict', RuntimeWarning)
-        make_trans_dict = False
-
-    for int_num, interval in enumerate(bed_ref):
-        # index 0: Chromosome, 1: start, 2: end, 3: name, 5: strand
-        start = chrom_start[interval[0]]
-        frag_values = data[start + int(interval[1]): start + int(interval[2])]
-        try:
-            if interval[5] == '-':
-                frag_values = np.flip(frag_values)
-        except IndexError:
-            pass
-        frag_values = np.nan_to_num(frag_values, copy=False, nan=0.)
-        gen_mapping.append(frag_values)
-        if make_trans_dict:
-            trans_dict[interval[3]] = frag_values
+    else:
+        trans_dict = {table.names[n]: frag_values for n, frag_values in zip(table.name.tolist(), gen_mapping)
+                      if n >= 0}
 
     return gen_mapping, trans_dict
 
 
-def binning(data, num_bins=6, offset_l=500, offset_r=500, bins_l=2, bins_r=2):
+def _annotate_ragged(data, bounds, table, chunk_size=2**24):
+    """
+    Segment data into a contiguous Segments container. The values are gathered in chunks of intervals to bound the
+    size of the temporary index arrays.
+    :param data: Data array (it is assumed that all chromosomes are concatenated together). If two-dimensional, the
+    values of all rows are gathered at once and the Segments container has a two-dimensional values buffer
+    :type data: numpy.array
+    :param bounds: Absolute start and end indices of the intervals
+    :type bounds: tuple(numpy.array)
+    :param table: Parsed intervals
+    :type table: IntervalTable
+    :param chunk_size: Approximate number of values that are gathered at once
+    :type chunk_size: int
+    :return: Segments, dictionary which maps from gene name to segment index
+    """
+    abs_start, abs_end = bounds
+    seg_len = abs_end - abs_start
+    offsets = np.zeros(seg_len.size + 1, dtype=np.int64)
+    np.cumsum(seg_len, out=offsets[1:])
+    values = np.empty(data.shape[:-1] + (offsets[-1],), dtype=data.dtype)
+
+    chunks = np.unique(np.searchsorted(offsets, np.arange(0, offsets[-1], chunk_size), side='right') - 1)
+    chunks = np.append(chunks, seg_len.size)
+    for first, last in zip(chunks[:-1], chunks[1:]):
+        if first == last:
+            continue
+        c_len = seg_len[first:last]
+        pos = np.arange(offsets[last] - offsets[first]) - np.repeat(offsets[first:last] - offsets[first], c_len)
+        is_minus = np.repeat(table.strand[first:last] == -1, c_len)
+        idx = np.where(is_minus, np.repeat(abs_end[first:last] - 1, c_len) - pos,
+                       np.repeat(abs_start[first:last], c_len) + pos)
+        values[..., offsets[first]:offsets[last]] = data[..., idx]
+    if values.dtype.kind == 'f':
+        np.nan_to_num(values, copy=False, nan=0.)
+
+    names = None
+    name_index = {}
+    if table.names is None:
+        warnings.warn('No annotation names found. Return empty dict for trans_dict', RuntimeWarning)
+    else:
+        names = [table.names[n] if n >= 0 else None for n in table.name.tolist()]
+        name_index = {name: num for num, name in enumerate(names) if name is not None}
+
+    return segments.Segments(values=values, offsets=offsets, names=names), name_index
+
+
+@profiling.instrument
+def binning(data, num_bins=6, offset_l=500, offset_r=500, bins_l=2, bins_r=2, bin_size=None):
     """
     Aggregate data in bins
     :param data: input data array
@@ -140,14 +484,40 @@ def binning(data, num_bins=6, offset_l=500, offset_r=500, bins_l=2, bins_r=2):
     :type bins_l int
     :param bins_r: number of bins that are to be created in the right offset region
     :type bins_r: int
+    :param bin_size: Bin size if data is a segment of a binned genome array. The offsets are given in bases and
+    converted to the binned resolution
+    :type bin_size: int
     :return: Aggregated data in defined bins
     """
-    bins = np.linspace(offset_l, len(data) - offset_r, num_bins + 1)
+    offset_l, offset_r = _binned_offsets(offset_l, offset_r, bin_size)
+    bins = _bin_edges(len(data), num_bins=num_bins, offset_l=offset_l, offset_r=offset_r, bins_l=bins_l, bins_r=bins_r)
+    return np.add.reduceat(data, bins)[:-1]
+
+
+def _bin_edges(length, num_bins=6, offset_l=500, offset_r=500, bins_l=2, bins_r=2):
+    """
+    Compute the start indices of the bins that are used by binning
+    :param length: Length of the data array
+    :type length: int
+    :param num_bins: number of bins that are to be created
+    :type num_bins: int
+    :param offset_l: left offset region that is separately considered
+    :type offset_l: int
+    :param offset_r: right offset region that is separately considered
+    :type offset_r: int
+    :param bins_l: number of bins that are to be created in the left offset region
+    :type bins_l int
+    :param bins_r: number of bins that are to be created in the right offset region
+    :type bins_r: int
+    :return: numpy.array with the start index per bin
+    """
+    bins = np.linspace(offset_l, length - offset_r, num_bins + 1)
     bins = np.insert(bins, np.repeat(0, bins_l), np.linspace(0, offset_l, bins_l + 1)[:-1])
-    bins = np.insert(bins, np.repeat(bins.size, bins_r), np.linspace(len(data) - offset_r, len(data), bins_r + 1)[:-1])
-    return np.add.reduceat(data, bins.astype('int'))[:-1]
+    bins = np.insert(bins, np.repeat(bins.size, bins_r), np.linspace(length - offset_r, length, bins_r + 1)[:-1])
+    return bins.astype('int')
 
 
+@profiling.instrument
 def rescale(data, vec_len=1000):
     """
     Rescale data array
@@ -162,48 +532,169 @@ def rescale(data, vec_len=1000):
     return inter_td(np.linspace(0, data.size - 1, vec_len))
 
 
+@profiling.instrument
 def center_norm_all(all_values):
     """
     Wrapper function to center all data arrays in list
-    :param all_values: List with data arrays
-    :type all_values: list(numpy.array)
-    :return: List with normalised data arrays
+    :param all_values: List with data arrays, two-dimensional array with one track per row, or Segments container,
+    where every segment is normalised separately
+    :type all_values: list(numpy.array) or numpy.array or Segments
+    :return: List with normalised data arrays, two-dimensional array or Segments container
     """
+    if _is_stacked(all_values):
+        return _norm_stacked(all_values, 'center')
+    if isinstance(all_values, segments.Segments):
+        seg_len = segments.lengths(all_values)
+        mean = segments.reduce_segments(np.add, all_values) / seg_len
+        dev = all_values.values - np.repeat(mean, seg_len)
+        std = np.sqrt(segments.reduce_segments(np.add, all_values._replace(values=dev * dev)) / seg_len)
+        return all_values._replace(values=dev / np.repeat(std, seg_len))
     return [center_norm(data) for data in all_values]
 
 
+@profiling.instrument
 def remap_norm_all(all_values):
     """
     Wrapper function to remap all data arrays in list
-    :param all_values: List with data arrays
-    :type all_values: list(numpy.array)
-    :return: List with normalised data arrays
+    :param all_values: List with data arrays, two-dimensional array with one track per row, or Segments container,
+    where every segment is normalised separately
+    :type all_values: list(numpy.array) or numpy.array or Segments
+    :return: List with normalised data arrays, two-dimensional array or Segments container
     """
+    if _is_stacked(all_values):
+        return _norm_stacked(all_values, 'remap')
+    if isinstance(all_values, segments.Segments):
+        seg_len = segments.lengths(all_values)
+        data_min = segments.reduce_segments(np.minimum, all_values)
+        data_max = segments.reduce_segments(np.maximum, all_values)
+        values = all_values.values - np.repeat(data_min, seg_len)
+        return all_values._replace(values=values / np.repeat(data_max - data_min, seg_len))
     return [remap_norm(data) for data in all_values]
 
 
-def smooth_all(all_values, smooth_list):
+def _is_stacked(all_values):
+    """
+    Check whether the data arrays are stacked in a two-dimensional array
+    :param all_values: Data arrays
+    :type all_values: list(numpy.array) or numpy.array or Segments
+    :return: True if all_values is a two-dimensional numpy.array
+    """
+    return isinstance(all_values, np.ndarray) and all_values.ndim == 2
+
+
+def _norm_stacked(all_values, norm, chunk_size=2**22):
+    """
+    Normalise every row of a two-dimensional array. The statistics of all rows are computed at once and the values are
+    normalised in column chunks, which gives the same result as normalising every row separately.
+    :param all_values: Two-dimensional array with one track per row
+    :type all_values: numpy.array
+    :param norm: Normalisation method. Possible are 'center' and 'remap'
+    :type norm: str
+    :param chunk_size: Number of columns that are processed at once
+    :type chunk_size: int
+    :return: Two-dimensional array with normalised tracks
+    """
+    out = _norm_out(all_values, None)
+    if norm == 'center':
+        _, _, shift, scale = array_stats(all_values, chunk_size=chunk_size)
+        shift, scale = shift.astype(out.dtype), scale.astype(out.dtype)
+    else:
+        shift = all_values.min(axis=1).astype(out.dtype)
+        scale = all_values.max(axis=1).astype(out.dtype) - shift
+    for start in range(0, all_values.shape[1], chunk_size):
+        chunk = np.subtract(all_values[:, start:start + chunk_size], shift[:, np.newaxis],
+                            out=out[:, start:start + chunk_size])
+        chunk /= scale[:, np.newaxis]
+    return out
+
+
+@profiling.instrument
+def smooth_all(all_values, smooth_list, chrom_start=None, workers=1):
     """
     Wrapper function to smooth all data arrays in list
-    :param all_values: All data arrays in a list
-    :type all_values: list(data.array)
-    :param smooth_list: List or integer with sizes of the moving-average windows
+    :param all_values: All data arrays in a list, or two-dimensional array with one track per row. All rows with the
+    same window size are smoothed at once
+    :type all_values: list(data.array) or numpy.array
+    :param smooth_list: List or integer with sizes of the moving-average windows. Data arrays with window size None
+    are not smoothed
     :type smooth_list: list(int) or int
-    :return: List with smoothed data arrays
+    :param chrom_start: Dictionary with index positions where the chromosomes start. If passed, every chromosome is
+    smoothed independently
+    :type chrom_start: dict
+    :param workers: Number of processes that smooth the data arrays in parallel. Only used if all_values is a list
+    :type workers: int
+    :return: List with smoothed data arrays, or two-dimensional array if all_values is two-dimensional
     """
+    if _is_stacked(all_values):
+        if isinstance(smooth_list, int):
+            smooth_list = [smooth_list] * all_values.shape[0]
+        elif not isinstance(smooth_list, list):
+            raise ValueError('smooth_list must be either list or int')
+        return _smooth_stacked(all_values, smooth_list, chrom_start)
+
     if type(smooth_list) == list:
-        return [smooth(data, smooth_size=smooth_size) for data, smooth_size in zip(all_values, smooth_list)]
+        tasks = list(zip(all_values, smooth_list, [chrom_start] * len(smooth_list)))
     elif type(smooth_list) == int:
-        return [smooth(data, smooth_size=smooth_list) for data in all_values]
+        tasks = [(data, smooth_list, chrom_start) for data in all_values]
     else:
         raise ValueError('smooth_list must be either list or int')
 
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_smooth_task, tasks))
+    return [_smooth_task(t) for t in tasks]
+
 
-def binning_all(all_data, num_bins=6, offset_r=500, offset_l=500, bins_l=2, bins_r=2):
+def _smooth_stacked(all_values, smooth_list, chrom_start):
+    """
+    Smooth the rows of a two-dimensional array. The rows are grouped by window size and every group is smoothed at
+    once with running sums along the rows.
+    :param all_values: Two-dimensional array with one track per row
+    :type all_values: numpy.array
+    :param smooth_list: Window size per row. Rows with window size None are not smoothed
+    :type smooth_list: list(int)
+    :param chrom_start: Dictionary with index positions where the chromosomes start or None
+    :type chrom_start: dict
+    :return: Two-dimensional array with smoothed tracks
+    """
+    out = np.empty(all_values.shape, dtype=np.float64)
+    for smooth_size in dict.fromkeys(smooth_list):
+        rows = [num for num, s in enumerate(smooth_list) if s == smooth_size]
+        if smooth_size is None or (chrom_start is None and smooth_size > all_values.shape[1]):
+            for num in rows:
+                out[num] = _smooth_task((all_values[num], smooth_size, chrom_start))
+            continue
+        if len(rows) == all_values.shape[0]:
+            data, target = all_values, out
+        else:
+            data, target = all_values[rows], np.empty((len(rows), all_values.shape[1]))
+        for start, end in _smooth_bounds(all_values.shape[1], chrom_start):
+            _running_mean(data, target, start, end, smooth_size)
+        if target is not out:
+            out[rows] = target
+    return out
+
+
+def _smooth_task(task):
+    """
+    Smooth one data array
+    :param task: Tuple with data array, window size and chromosome start indices
+    :type task: tuple
+    :return: Smoothed data array
+    """
+    data, smooth_size, chrom_start = task
+    if smooth_size is None:
+        return data
+    return smooth(data, smooth_size=smooth_size, chrom_start=chrom_start)
+
+
+@profiling.instrument
+def binning_all(all_data, num_bins=6, offset_r=500, offset_l=500, bins_l=2, bins_r=2, bin_size=None):
     """
     Wrapper function for binning
-    :param all_data: list with input data arrays
-    :type all_data: list(array-like)
+    :param all_data: list with input data arrays, two-dimensional array with one data array of the same length per row,
+    or Segments container
+    :type all_data: list(array-like) or numpy.array or Segments
     :param num_bins: number of bins that are to be created
     :type num_bins: int
     :param offset_l: left offset region that is separately considered
@@ -214,72 +705,327 @@ def binning_all(all_data, num_bins=6, offset_r=500, offset_l=500, bins_l=2, bins
     :type bins_l int
     :param bins_r: number of bins that are to be created in the right offset region
     :type bins_r: int
+    :param bin_size: Bin size if the data arrays are segments of a binned genome array. The offsets are given in
+    bases and converted to the binned resolution
+    :type bin_size: int
     :return: Aggregated data in defined bins
     """
+    offset_l, offset_r = _binned_offsets(offset_l, offset_r, bin_size)
+    if _is_stacked(all_data):
+        bins = _bin_edges(all_data.shape[1], num_bins=num_bins, offset_l=offset_l, offset_r=offset_r,
+                          bins_l=bins_l, bins_r=bins_r)
+        return np.add.reduceat(all_data, bins, axis=1)[:, :-1]
+    if isinstance(all_data, segments.Segments):
+        return _binning_segments(all_data, num_bins=num_bins, offset_l=offset_l, offset_r=offset_r,
+                                 bins_l=bins_l, bins_r=bins_r)
     return np.asarray([binning(d, num_bins=num_bins, offset_l=offset_l, offset_r=offset_r, bins_l=bins_l, bins_r=bins_r)
             for d in all_data])
 
 
-def annotate_all(all_values, bed_ref, chrom_start):
+def _binned_offsets(offset_l, offset_r, bin_size):
+    """
+    Convert the offsets of the binning functions from bases to bins
+    :param offset_l: left offset region in bases
+    :type offset_l: int
+    :param offset_r: right offset region in bases
+    :type offset_r: int
+    :param bin_size: Bin size of the data. If None, the offsets are returned unchanged
+    :type bin_size: int
+    :return: left offset, right offset
+    """
+    if bin_size is None:
+        return offset_l, offset_r
+    return int(round(offset_l / float(bin_size))), int(round(offset_r / float(bin_size)))
+
+
+def _linspace_rows(start, stop, num):
     """
-    Wrapper function to segment all data arrays according to the passed bed file
+    Row-wise numpy.linspace with the same rounding as the scalar version
+    :param start: Start value per row
+    :type start: numpy.array
+    :param stop: Stop value per row
+    :type stop: numpy.array
+    :param num: Number of values per row
+    :type num: int
+    :return: Two-dimensional numpy.array with one row per start value
+    """
+    start = np.asarray(start, dtype=np.float64)[:, np.newaxis]
+    stop = np.asarray(stop, dtype=np.float64)[:, np.newaxis]
+    if num == 1:
+        return start.copy()
+    rows = np.arange(num, dtype=np.float64) * ((stop - start) / (num - 1)) + start
+    rows[:, -1] = stop[:, 0]
+    return rows
+
+
+def _binning_segments(all_data, num_bins=6, offset_l=500, offset_r=500, bins_l=2, bins_r=2):
+    """
+    Binning of all segments in a Segments container at once. The result is identical to applying binning to every
+    segment.
+    :param all_data: Segmented data
+    :type all_data: Segments
+    :param num_bins: number of bins that are to be created
+    :type num_bins: int
+    :param offset_l: left offset region that is separately considered
+    :type offset_l: int
+    :param offset_r: right offset region that is separately considered
+    :type offset_r: int
+    :param bins_l: number of bins that are to be created in the left offset region
+    :type bins_l int
+    :param bins_r: number of bins that are to be created in the right offset region
+    :type bins_r: int
+    :return: Aggregated data in defined bins
+    """
+    seg_len = segments.lengths(all_data)
+    zeros = np.zeros(seg_len.size)
+    bins = np.concatenate([
+        _linspace_rows(zeros, zeros + offset_l, bins_l + 1)[:, :-1],
+        _linspace_rows(zeros + offset_l, seg_len - offset_r, num_bins + 1),
+        _linspace_rows(seg_len - offset_r, seg_len, bins_r + 1)[:, :-1]
+    ], axis=1).astype('int')
+    if np.any(bins < 0) or np.any(bins >= seg_len[:, np.newaxis]):
+        raise IndexError('Segments are too short for the passed offsets.')
+    bins += all_data.offsets[:-1, np.newaxis]
+    return np.add.reduceat(all_data.values, bins.reshape(-1)).reshape(bins.shape)[:, :-1]
+
+
+@profiling.instrument
+def annotate_all(all_values, bed_ref, chrom_start, ragged=False, bin_size=None):
+    """
+    Wrapper function to segment all data arrays according to the passed bed file. The bed file is parsed only once
+    for all data arrays.
     :param all_values: List with data array (it is assumed that all chromosomes are concatenated together per data
-    array)
-    :type all_values: list(numpy.array)
-    :param bed_ref: reference to bed file
-    :type bed_ref: str
+    array), or two-dimensional array with one data array per row. For a two-dimensional array and ragged set, the
+    values of all rows are gathered at once
+    :type all_values: list(numpy.array) or numpy.array
+    :param bed_ref: reference to bed file or bed file parsed with intervals.parse_bed
+    :type bed_ref: BedTool or IntervalTable
     :param chrom_start: Dictionary with index positions where the chromosomes start
     :type chrom_start: dict
+    :param ragged: If True, return one Segments container and one dictionary which maps from gene name to segment
+    index per data array
+    :type ragged: bool
+    :param bin_size: Bin size if the data arrays are binned genome arrays (see get_values)
+    :type bin_size: int
     :return: List with segmented data arrays, list with dictionaries which map from gene name to data array
     """
+    table = _interval_table(bed_ref)
+    if ragged:
+        bounds = intervals.absolute_bounds(table, chrom_start, bin_size=bin_size)
+    else:
+        slices = _segment_slices(table, chrom_start, bin_size=bin_size)
+    if ragged and _is_stacked(all_values):
+        seg, name_index = _annotate_ragged(all_values, bounds, table)
+        return [seg._replace(values=values) for values in seg.values], [name_index.copy() for _ in seg.values]
+
     bw_gen_mapping = []
     t_dict_list = []
     for data in all_values:
-        gm, t_d = annotate(data, bed_ref, chrom_start)
+        if ragged:
+            gm, t_d = _annotate_ragged(data, bounds, table)
+        else:
+            gm, t_d = _annotate_slices(data, slices, table)
         bw_gen_mapping.append(gm)
         t_dict_list.append(t_d)
 
     return bw_gen_mapping, t_dict_list
 
 
-def rescale_all(transcript_data, vec_len=1000):
+@profiling.instrument
+def rescale_all(transcript_data, vec_len=1000, out=None):
     """
-    Wrapper function to rescale all data arrays in a list
-    :param transcript_data: List with data arrays
-    :type transcript_data: list(numpy.array)
-    :param vec_len: Length to which all arrays are rescaled
+    Wrapper function to rescale all data arrays in a list. All data arrays are linearly resampled at once in a few
+    vectorised passes, which gives the same result as applying rescale to every data array.
+    :param transcript_data: List with data arrays or Segments container
+    :type transcript_data: list(numpy.array) or Segments
+    :param vec_len: Length to which all arrays are rescaled. If None, the length of the longest data array is used
     :type vec_len: int
+    :param out: Optional output array of shape (number of data arrays, vec_len), e.g. with dtype float32
+    :type out: numpy.array
     :return: numpy.array with rescaled data arrays (two-dim numpy array)
     """
-    vec_len = vec_len if vec_len is not None else len(max(transcript_data, key=len))
-    data_array = np.zeros((len(transcript_data), vec_len))
-    for num, td in enumerate(transcript_data):
-        data_array[num] = rescale(td, vec_len=vec_len)
+    if not isinstance(transcript_data, segments.Segments):
+        dtype = np.result_type(*map(np.asarray, transcript_data)) if len(transcript_data) > 0 else np.float64
+        if not np.issubdtype(dtype, np.inexact):
+            dtype = np.float64
+        transcript_data = segments.from_list(transcript_data, dtype=dtype)
+
+    seg_len = segments.lengths(transcript_data)
+    if vec_len is None:
+        vec_len = int(seg_len.max()) if seg_len.size > 0 else 0
+    if out is None:
+        out = np.zeros((seg_len.size, vec_len))
+    elif out.shape != (seg_len.size, vec_len):
+        raise ValueError('out must have the shape (%d, %d).' % (seg_len.size, vec_len))
+    if np.any(seg_len == 0):
+        raise ValueError('Empty data arrays cannot be rescaled.')
 
-    return data_array
+    _rescale_batch(transcript_data.values, transcript_data.offsets, seg_len, out)
+    return out
 
 
-def get_values(bw_list):
+@profiling.instrument(path_arg='bw_list')
+def get_values(bw_list, dtype='float32', out=None, cache_dir=None, cache_max_size=None, workers=1, bin_size=None,
+               stacked=False, stack_path=None):
     """
-    Retrieve all data values from bigwig file and concatenate them together
-    :param bw_list: List with bigwig files
-    :type bw_list: list(bigWigFile)
-    :return: List with one data array per bigwig file, dictionary with starting indices for chromosomes.
+    Retrieve all data values from bigwig file and concatenate them together. One contiguous array per bigwig file is
+    allocated up front from the chromosome sizes and every chromosome is written in place into its slice, such that
+    the peak memory is about one copy of the genome per bigwig file. Bigwig files store single precision values,
+    hence float32 does not lose any information.
+    :param bw_list: List with bigwig files or paths to bigwig files
+    :type bw_list: list(bigWigFile) or list(str)
+    :param dtype: Data type of the returned arrays
+    :type dtype: str or numpy.dtype
+    :param out: Optional buffers with one array (or row of a two-dimensional array) per bigwig file. Each buffer must
+    have the size of the concatenated genome. If passed, dtype is ignored and the values are written into out.
+    :type out: list(numpy.array) or numpy.array
+    :param cache_dir: If set, the extracted values are cached in this directory and read-only numpy.memmap arrays
+    are returned. Requires that bw_list contains paths.
+    :type cache_dir: str
+    :param cache_max_size: Maximal size of the cache in bytes. Least recently used entries are evicted when the cache
+    grows larger. If None, the cache size is not limited
+    :type cache_max_size: int
+    :param workers: Number of processes that fetch the chromosomes of all bigwig files in parallel. Every process opens
+    its own file handles and writes directly into memory-mapped output arrays. Requires that bw_list contains paths.
+    The result is identical to the serial extraction (workers=1)
+    :type workers: int
+    :param bin_size: If set, every chromosome is split into bins of bin_size bases and the mean value per bin is
+    returned (missing values count as zero, the last bin of a chromosome can be shorter). The bin sums are computed
+    exactly from the base-pair values, which are read in chunks of whole bins, hence only the binned array and one
+    chunk are allocated and the extraction takes about as long as at full resolution. The zoom levels are not used,
+    as pyBigWig cannot select a zoom level that matches bin_size and their sums are not reliable. The returned
+    chromosome start indices refer to the binned array, i.e. position p of a chromosome is at
+    chrom_start[chrom] + p // bin_size
+    :type bin_size: int
+    :param stacked: If True, the values are returned as one two-dimensional array with one row per bigwig file, which
+    can be passed directly to the _all functions
+    :type stacked: bool
+    :param stack_path: If set (together with stacked), the two-dimensional array is created as memory-mapped .npy
+    file at this path
+    :type stack_path: str
+    :return: List with one data array per bigwig file (or two-dimensional array if stacked is set), dictionary with
+    starting indices for chromosomes.
     """
     if len(bw_list) == 0:
         raise ValueError('List with bigwig objects must not be empty.')
+    if cache_dir is not None and not all(isinstance(bw, str) for bw in bw_list):
+        raise ValueError('Caching requires that bw_list contains paths to the bigwig files.')
+    if workers > 1 and not all(isinstance(bw, str) for bw in bw_list):
+        raise ValueError('Parallel extraction requires that bw_list contains paths to the bigwig files.')
 
-    all_values = [[] for _ in bw_list]
+    dtype = np.dtype(dtype) if out is None else out[0].dtype
+    # The cache entries are stamped with the state of the files before they are read
+    infos = [cache.source_info(bw) for bw in bw_list] if cache_dir is not None else None
+    # Binned entries of older versions were computed from the zoom levels and are not reused
+    tag = '' if bin_size is None else '_exactbin%d' % bin_size
+    cached = [None for _ in bw_list]
+    if cache_dir is not None:
+        cached = [cache.load_cached_values(bw, cache_dir, dtype=dtype, tag=tag) for bw in bw_list]
+
+    if cached[0] is not None and bin_size is None:
+        chrom_start, genome_size = cached[0][1], cached[0][0].size
+        chroms = intervals.chrom_sizes(chrom_start, genome_size)
+    else:
+        with _big_file(bw_list[0]) as bw:
+            chroms = bw.chroms()
+        chrom_start, genome_size = intervals.chrom_layout(chroms, bin_size=bin_size)
+    sizes = intervals.chrom_sizes(chrom_start, genome_size)
+    # Cache entries that were created with another chromosome layout cannot be reused
+    cached = [c if c is not None and c[0].size == genome_size and c[1] == chrom_start else None for c in cached]
 
-    counter = 0
-    chrom_start = {}
-    for chrom, length in bw_list[0].chroms().items():
-        chrom_start[chrom] = counter
-        counter += length
-        for num, bw in enumerate(bw_list):
-            values = np.asarray(bw.values(chrom, 0, length))
-            all_values[num].extend(np.nan_to_num(values, nan=0.0).tolist())
+    if stacked and out is None:
+        if stack_path is not None:
+            out = np.lib.format.open_memmap(stack_path, mode='w+', dtype=dtype, shape=(len(bw_list), int(genome_size)))
+        else:
+            out = np.empty((len(bw_list), genome_size), dtype=dtype)
+    if out is not None:
+        if len(out) != len(bw_list):
+            raise ValueError('out must contain one array per bigwig file.')
+        for buffer in out:
+            if buffer.shape != (genome_size,):
+                raise ValueError('Every array in out must have the size of the concatenated genome (%d).'
+                                 % genome_size)
 
-    all_values = [np.asarray(genome) for genome in all_values]
+    all_values = [None for _ in bw_list]
+    missing = []
+    for num, c in enumerate(cached):
+        if c is None:
+            missing.append(num)
+            continue
+        values = c[0]
+        if out is not None:
+            out[num][:] = values
+            values = out[num]
+        all_values[num] = values
+
+    # In parallel mode the workers write into memory-mapped files instead of sending the values back
+    tmp_dir = tempfile.mkdtemp() if workers > 1 and cache_dir is None and missing else None
+    try:
+        targets = {}
+        for num in missing:
+            if cache_dir is not None:
+                targets[num] = cache.create_cached_values(
+                    bw_list[num], cache_dir, chrom_start, genome_size, dtype=dtype, tag=tag)
+            elif tmp_dir is not None:
+                targets[num] = np.lib.format.open_memmap(
+                    os.path.join(tmp_dir, '%d.npy' % num), mode='w+', dtype=dtype, shape=(genome_size,))
+            elif out is not None:
+                targets[num] = out[num]
+            else:
+                targets[num] = np.empty(genome_size, dtype=dtype)
+
+        if workers > 1:
+            tasks = [(bw_list[num], targets[num].filename, chrom, chrom_start[chrom], sizes[chrom], length, bin_size)
+                     for num in missing for chrom, length in chroms.items()]
+            # Largest chromosomes first to balance the load between the workers
+            tasks.sort(key=lambda t: -t[5])
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(_fill_chrom_worker, tasks))
+        else:
+            for num in missing:
+                with _big_file(bw_list[num]) as bw_file:
+                    for chrom, length in chroms.items():
+                        start = chrom_start[chrom]
+                        _fill_chrom(targets[num][start:start + sizes[chrom]], bw_file, chrom, length,
+                                    bin_size=bin_size)
+
+        for num in missing:
+            values = targets[num]
+            if cache_dir is not None:
+                values = cache.commit_cached_values(values, bw_list[num], cache_dir, chrom_start, tag=tag,
+                                                    info=infos[num])
+            if out is not None and values is not out[num]:
+                out[num][:] = values
+                values = out[num]
+            elif tmp_dir is not None:
+                values = np.array(values)
+            all_values[num] = values
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    if cache_dir is not None and cache_max_size is not None:
+        keep = [cache.cache_entry(bw, cache_dir, dtype=dtype, tag=tag)[1] for bw in bw_list]
+        cache.evict(cache_dir, cache_max_size, keep=keep)
+
+    if stacked:
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out, chrom_start
     return all_values, chrom_start
 
+
+def _fill_chrom_worker(task):
+    """
+    Fetch one chromosome of one bigwig file in a worker process and write it into the memory-mapped output array.
+    Bigwig handles cannot be shared between processes, hence every process opens its own handles in the handle pool.
+    :param task: Tuple with path to the bigwig file, path to the .npy output file, chromosome name, starting index
+    of the chromosome, size of the chromosome in the output array, chromosome size and bin size
+    :type task: tuple
+    :return: None
+    """
+    path, out_path, chrom, start, size, length, bin_size = task
+    values = np.load(out_path, mmap_mode='r+')
+    with _big_file(path) as bw:
+        _fill_chrom(values[start:start + size], bw, chrom, length, bin_size=bin_size)
+    values.flush()
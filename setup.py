@@ -9,6 +9,11 @@ setuptools.setup(
     description="Data handler for managing bigwig and bed files and their respective data",
     url="git@github.com:leoTiez/seqDataHandler.git",
     packages=setuptools.find_packages(),
+    entry_points={
+        'console_scripts': [
+            'seqdatahandler-run=datahandler.runner:main'
+        ]
+    },
     install_requires=[
         'roman>=3.3',
         'numpy>=1.18',
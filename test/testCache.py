@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+import unittest
+import os
+import time
+import tempfile
+import shutil
+import numpy as np
+from datahandler import cache
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.source = os.path.join(self.tmp_dir, 'source.bw')
+        with open(self.source, 'w') as source:
+            source.write('test')
+        self.values = np.arange(10, dtype='float32')
+        self.chrom_start = {'chrI': 0, 'chrII': 6}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_store_and_load_cached_values(self):
+        self.assertIsNone(cache.load_cached_values(self.source, self.cache_dir))
+        cache.store_values(self.source, self.cache_dir, self.values, self.chrom_start)
+
+        values, chrom_start = cache.load_cached_values(self.source, self.cache_dir)
+        self.assertIsInstance(values, np.memmap)
+        self.assertListEqual(values.tolist(), self.values.tolist())
+        self.assertDictEqual(chrom_start, self.chrom_start)
+        self.assertIsNone(cache.load_cached_values(self.source, self.cache_dir, dtype='float64'))
+
+        with open(self.source, 'a') as source:
+            source.write('changed')
+        self.assertIsNone(cache.load_cached_values(self.source, self.cache_dir))
+
+    def test_commit_snapshot(self):
+        info = cache.source_info(self.source)
+        values = cache.create_cached_values(self.source, self.cache_dir, self.chrom_start, self.values.size)
+        values[:] = self.values
+        with open(self.source, 'a') as source:
+            source.write('changed')
+        # The file changed while the values were read, hence the entry is discarded
+        committed = cache.commit_cached_values(values, self.source, self.cache_dir, self.chrom_start, info=info)
+        self.assertNotIsInstance(committed, np.memmap)
+        self.assertListEqual(committed.tolist(), self.values.tolist())
+        self.assertIsNone(cache.load_cached_values(self.source, self.cache_dir))
+        self.assertListEqual(os.listdir(self.cache_dir), [])
+
+        info = cache.source_info(self.source)
+        values = cache.create_cached_values(self.source, self.cache_dir, self.chrom_start, self.values.size)
+        values[:] = self.values
+        committed = cache.commit_cached_values(values, self.source, self.cache_dir, self.chrom_start, info=info)
+        self.assertIsInstance(committed, np.memmap)
+        self.assertIsNotNone(cache.load_cached_values(self.source, self.cache_dir))
+
+    def test_invalidate(self):
+        cache.store_values(self.source, self.cache_dir, self.values, self.chrom_start)
+        self.assertEqual(cache.invalidate(self.cache_dir, self.source), 1)
+        self.assertIsNone(cache.load_cached_values(self.source, self.cache_dir))
+        self.assertEqual(cache.cache_size(self.cache_dir), 0)
+
+    def test_foreign_files(self):
+        # Files in cache_dir that were not written by the cache are neither counted nor removed
+        cache.store_values(self.source, self.cache_dir, self.values, self.chrom_start)
+        size = cache.cache_size(self.cache_dir)
+        foreign = []
+        for name, content in (('results', '{"source": "x", "genome_size": 1, "chrom_start": []}'),
+                              ('0123456789abcdef_float32', '{"dtype": "float32"}')):
+            for ext, text in (('.json', content), ('.npy', 'data')):
+                foreign.append(os.path.join(self.cache_dir, name + ext))
+                with open(foreign[-1], 'w') as f:
+                    f.write(text)
+        self.assertEqual(cache.cache_size(self.cache_dir), size)
+        self.assertEqual(cache.evict(self.cache_dir, 0), 1)
+        self.assertEqual(cache.invalidate(self.cache_dir), 0)
+        self.assertTrue(all(os.path.isfile(p) for p in foreign))
+
+    def test_evict(self):
+        other = os.path.join(self.tmp_dir, 'other.bw')
+        with open(other, 'w') as source:
+            source.write('other')
+        cache.store_values(self.source, self.cache_dir, self.values, self.chrom_start)
+        _, meta_path = cache.cache_entry(self.source, self.cache_dir)
+        os.utime(meta_path, (time.time() - 100, time.time() - 100))
+        cache.store_values(other, self.cache_dir, self.values, self.chrom_start)
+
+        size = cache.cache_size(self.cache_dir)
+        self.assertEqual(cache.evict(self.cache_dir, size - 1), 1)
+        self.assertIsNone(cache.load_cached_values(self.source, self.cache_dir))
+        self.assertIsNotNone(cache.load_cached_values(other, self.cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
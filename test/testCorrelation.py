@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+import unittest
+import warnings
+import os
+import tempfile
+import shutil
+import numpy as np
+import scipy.stats
+import pyBigWig
+
+from datahandler import correlation, intervals
+from datahandler import seqDataHandler as seq
+
+
+class TestCorrelation(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.chrom_start = {'chrI': 0, 'chrII': 700}
+        self.values = rng.random((4, 1000))
+        self.values[1] += self.values[0]
+        self.values[2] = np.round(self.values[2] * 4)
+        self.values[:, 100:300] = 0
+
+    def test_correlation_arrays(self):
+        exp = np.corrcoef(self.values)
+        for workers in (1, 3):
+            np.testing.assert_allclose(correlation.correlation(self.values, chunk_size=64, workers=workers), exp,
+                                       atol=1e-12)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            np.testing.assert_allclose(correlation.correlation(list(self.values), method='spearman', chunk_size=99,
+                                                               workers=2), scipy.stats.spearmanr(self.values.T)[0],
+                                       atol=1e-12)
+        # Tracks with more distinct values than rank_bins get approximate ranks, the zeros are counted exactly
+        with self.assertWarnsRegex(RuntimeWarning, 'Tracks 0, 1, 3 have more than 16 distinct values'):
+            approx = correlation.correlation(self.values, method='spearman', rank_bins=16, chunk_size=99, workers=2)
+        np.testing.assert_allclose(approx, scipy.stats.spearmanr(self.values.T)[0], atol=2e-3)
+        self.assertRaises(ValueError, correlation.correlation, self.values, method='spearman', rank_bins=0)
+
+        # NaN values and (with skip_zeros) positions where all tracks are zero are excluded
+        values = self.values.copy()
+        values[3, 500] = np.nan
+        mask = (self.values != 0).any(axis=0)
+        mask[500] = False
+        np.testing.assert_allclose(correlation.correlation(values, skip_zeros=True, chunk_size=128),
+                                   np.corrcoef(self.values[:, mask]), atol=1e-12)
+
+        constant = correlation.correlation([self.values[0], np.ones(1000)])
+        self.assertEqual(constant[0, 0], 1.)
+        self.assertTrue(np.isnan(constant[0, 1]) and np.isnan(constant[1, 1]))
+        self.assertRaises(ValueError, correlation.correlation, self.values, method='kendall')
+        self.assertRaises(ValueError, correlation.correlation, [self.values[0], self.values[1, :10]])
+
+    def test_correlation_bins_and_blacklist(self):
+        # The bins do not cross chromosome boundaries and the last bin of a chromosome is shorter
+        binned = np.concatenate([np.add.reduceat(self.values[:, :700], np.arange(0, 700, 30), axis=1)
+                                 / np.diff(np.append(np.arange(0, 700, 30), 700)),
+                                 self.values[:, 700:].reshape(4, 10, 30).mean(axis=2)], axis=1)
+        np.testing.assert_allclose(correlation.correlation(self.values, chrom_start=self.chrom_start, bin_size=30,
+                                                           chunk_size=7, workers=2), np.corrcoef(binned), atol=1e-12)
+        # Missing values count as zero in the bin means, as for bigwig files
+        values = self.values.copy()
+        values[1, 5:40] = np.nan
+        zeros = np.nan_to_num(values, nan=0.)
+        np.testing.assert_allclose(correlation.correlation(values, chrom_start=self.chrom_start, bin_size=30),
+                                   correlation.correlation(zeros, chrom_start=self.chrom_start, bin_size=30),
+                                   atol=1e-12)
+
+        blacklist = intervals.parse_bed([['chrII', '10', '20'], ['chrI', '650', '710'], ['chrM', '0', '10']])
+        mask = np.ones(1000, dtype=bool)
+        mask[710:720] = False
+        mask[650:700] = False
+        np.testing.assert_allclose(correlation.correlation(self.values, chrom_start=self.chrom_start,
+                                                           blacklist=blacklist, chunk_size=100),
+                                   np.corrcoef(self.values[:, mask]), atol=1e-12)
+        # Bins that overlap with a blacklisted region are excluded
+        bin_mask = np.ones(binned.shape[1], dtype=bool)
+        bin_mask[[21, 22, 23, 24]] = False
+        np.testing.assert_allclose(correlation.correlation(self.values, chrom_start=self.chrom_start, bin_size=30,
+                                                           blacklist=blacklist),
+                                   np.corrcoef(binned[:, bin_mask]), atol=1e-12)
+        self.assertRaises(ValueError, correlation.correlation, self.values, blacklist=blacklist)
+
+    def test_correlation_bigwig(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            bw_paths = [os.path.join(tmp_dir, 'track%d.bw' % num) for num in range(4)]
+            for path, values in zip(bw_paths, self.values):
+                bw = pyBigWig.open(path, 'w')
+                bw.addHeader([('chrI', 700), ('chrII', 300)])
+                bw.addEntries('chrI', 0, values=values[:700].tolist(), span=1, step=1)
+                bw.addEntries('chrII', 0, values=values[700:].tolist(), span=1, step=1)
+                bw.close()
+            all_values, chrom_start = seq.get_values(bw_paths, stacked=True)
+            np.testing.assert_allclose(correlation.correlation(bw_paths, chunk_size=128, workers=2),
+                                       correlation.correlation(all_values), atol=1e-12)
+            np.testing.assert_allclose(correlation.correlation(bw_paths, method='spearman', chunk_size=300),
+                                       scipy.stats.spearmanr(all_values.T)[0], atol=1e-12)
+            with self.assertWarns(RuntimeWarning):
+                approx = correlation.correlation(bw_paths, method='spearman', chunk_size=300, workers=2, rank_bins=16)
+            np.testing.assert_allclose(approx, scipy.stats.spearmanr(all_values.T)[0], atol=2e-3)
+            # The bigwig files store float32 values, the expected bins are computed from the exact per-base values
+            exact = self.values.astype('float32').astype(float)
+            binned = np.concatenate([exact[:, :700].reshape(4, 14, 50).mean(axis=2),
+                                     exact[:, 700:].reshape(4, 6, 50).mean(axis=2)], axis=1)
+            np.testing.assert_allclose(correlation.correlation(bw_paths, bin_size=50, chunk_size=3),
+                                       np.corrcoef(binned), atol=1e-6)
+
+            # Tracks that are large enough to have zoom levels, which are not used for the bin means
+            rng = np.random.default_rng(1)
+            large = rng.random((2, 200000)).astype('float32')
+            large[1] += np.repeat(rng.random(200), 1000).astype('float32')
+            large_paths = [os.path.join(tmp_dir, 'large%d.bw' % num) for num in range(2)]
+            for path, values in zip(large_paths, large):
+                bw = pyBigWig.open(path, 'w')
+                bw.addHeader([('chrI', 200000)])
+                bw.addEntries('chrI', 0, values=values.tolist(), span=1, step=1)
+                bw.close()
+            np.testing.assert_allclose(correlation.correlation(large_paths, bin_size=1000, chunk_size=50),
+                                       np.corrcoef(large.astype(float).reshape(2, 200, 1000).mean(axis=2)), atol=1e-6)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+import unittest
+import os
+import tempfile
+import shutil
+import warnings
+from unittest import mock
+from collections import OrderedDict
+import numpy as np
+
+from datahandler import coverage, intervals
+
+
+class TestCoverage(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.chroms = OrderedDict([('chrI', 500), ('chrII', 300), ('chrIII', 50)])
+        rng = np.random.default_rng(0)
+        self.fields = []
+        for chrom, length in self.chroms.items():
+            for _ in range(200):
+                start = int(rng.integers(0, length))
+                end = start + int(rng.integers(1, 60))
+                self.fields.append([chrom, str(start), str(end), 'read', '0', str(rng.choice(['+', '-']))])
+        self.bed_path = os.path.join(self.tmp_dir, 'reads.bed')
+        with open(self.bed_path, 'w') as bed:
+            bed.write(''.join('\t'.join(f) + '\n' for f in self.fields))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def naive_pileup(self, strand=None, five_prime=False):
+        exp = {chrom: np.zeros(length) for chrom, length in self.chroms.items()}
+        for chrom, start, end, _, _, st in self.fields:
+            start, end = int(start), int(end)
+            if strand is not None and st != strand:
+                continue
+            if five_prime:
+                start = end - 1 if st == '-' else start
+                end = start + 1
+            exp[chrom][start:end] += 1
+        return np.concatenate(list(exp.values()))
+
+    def test_pileup(self):
+        values, chrom_start = coverage.pileup(self.bed_path, self.chroms)
+        self.assertDictEqual(chrom_start, {'chrI': 0, 'chrII': 500, 'chrIII': 800})
+        self.assertEqual(values.dtype, np.float32)
+        np.testing.assert_array_equal(values, self.naive_pileup())
+
+        for strand in ('+', '-'):
+            for five_prime in (False, True):
+                values, _ = coverage.pileup(self.fields, self.chroms, strand=strand, five_prime=five_prime,
+                                            chunk_size=64)
+                np.testing.assert_array_equal(values, self.naive_pileup(strand=strand, five_prime=five_prime))
+
+        out = np.zeros(850, dtype=np.int32)
+        values, _ = coverage.pileup(self.bed_path, self.chroms, five_prime=True, out=out, chunk_size=37)
+        self.assertIs(values, out)
+        np.testing.assert_array_equal(values, self.naive_pileup(five_prime=True))
+        self.assertRaises(ValueError, coverage.pileup, self.bed_path, self.chroms, out=np.zeros(10))
+        self.assertRaises(ValueError, coverage.pileup, self.bed_path, self.chroms, strand='.')
+
+    def test_pileup_skips_names(self):
+        # Reads converted from bam files have one name each, which must not be collected across the chunks
+        fields = [['chrI', str(i), str(i + 10), 'read%d' % i] for i in range(400)]
+        tables = []
+        parse_chunks = intervals.iter_bed_chunks
+
+        def iter_bed_chunks(*args, **kwargs):
+            for table in parse_chunks(*args, **kwargs):
+                tables.append(table)
+                yield table
+
+        with mock.patch.object(coverage.intervals, 'iter_bed_chunks', iter_bed_chunks):
+            values, _ = coverage.pileup(fields, self.chroms, chunk_size=50)
+        self.assertEqual(len(tables), 8)
+        self.assertTrue(all(t.names is None for t in tables))
+        self.assertEqual(values.sum(), 4000)
+
+    def test_pileup_clip_and_missing(self):
+        fields = [['chrIII', '40', '70'], ['chrX', '0', '10'], ['chrI', '10', '20']]
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            values, chrom_start = coverage.pileup(fields, self.chroms)
+        self.assertEqual(len(w), 1)
+        self.assertIn('chrX', str(w[0].message))
+        exp = np.zeros(850)
+        exp[10:20] = 1
+        exp[840:850] = 1
+        np.testing.assert_array_equal(values, exp)
+        # Intervals without strand are ignored when counting strand-specific
+        values, _ = coverage.pileup(fields[:1], self.chroms, strand='+')
+        self.assertEqual(values.sum(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
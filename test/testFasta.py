@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+import unittest
+import os
+import tempfile
+import shutil
+import tracemalloc
+import numpy as np
+from datahandler import reader, fasta, intervals, preprocessing
+
+
+class TestFasta(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'genome.fa')
+        self.seqs = {'chrI': 'ACGTTAGGCANNNNacgtTT' * 3 + 'AC', 'chrII': 'GGATC'}
+        with open(self.path, 'w') as fasta_file:
+            for chrom, seq in self.seqs.items():
+                fasta_file.write('>%s description\n' % chrom)
+                fasta_file.write('\n'.join(seq[i:i + 8] for i in range(0, len(seq), 8)) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_build_index(self):
+        index = fasta.read_index(fasta.build_index(self.path))
+        self.assertListEqual(list(index.keys()), ['chrI', 'chrII'])
+        self.assertTupleEqual(index['chrI'], (62, 18, 8, 9))
+
+    def test_fetch(self):
+        genome = reader.load_fasta_index(self.path, is_abs_path=True)
+        self.assertTrue(os.path.isfile(self.path + '.fai'))
+        self.assertDictEqual(dict(genome.chroms()), {'chrI': 62, 'chrII': 5})
+        for start, end in [(0, None), (3, 6), (7, 9), (5, 50), (60, 100)]:
+            seq = genome.fetch('chrI', start, end)
+            self.assertEqual(seq.dtype, np.uint8)
+            self.assertEqual(seq.tobytes().decode(), self.seqs['chrI'][start:end])
+
+    def test_two_bit(self):
+        genome = reader.load_fasta_index(self.path, is_abs_path=True, two_bit=True)
+        self.assertTrue(os.path.isfile(self.path + '.2bit.npy'))
+        self.assertEqual(genome.fetch('chrI', 5, 25).tobytes().decode(), self.seqs['chrI'][5:25])
+        self.assertEqual(genome.fetch('chrII').tobytes().decode(), self.seqs['chrII'])
+
+        # Caches without the bit mask of the lower case bases are created again
+        os.remove(self.path + '.2bit.mask.npy')
+        genome = fasta.IndexedFasta(self.path, two_bit=True)
+        self.assertEqual(genome.fetch('chrI').tobytes().decode(), self.seqs['chrI'])
+
+    def test_two_bit_large(self):
+        rng = np.random.default_rng(0)
+        seqs = {}
+        for chrom, length in (('chrI', 2**20 + 3), ('chrII', 5001)):
+            bases = rng.choice(np.frombuffer(b'ACGTacgt', dtype=np.uint8), size=length)
+            for start in rng.integers(0, length, size=20).tolist():
+                bases[start:start + int(rng.integers(1, 50))] = ord('N')
+            seqs[chrom] = bases.tobytes().decode()
+        path = os.path.join(self.tmp_dir, 'large.fa')
+        with open(path, 'w') as fasta_file:
+            for chrom, seq in seqs.items():
+                fasta_file.write('>%s\n' % chrom + '\n'.join(seq[i:i + 60] for i in range(0, len(seq), 60)) + '\n')
+        genome = fasta.IndexedFasta(path, two_bit=True)
+
+        tracemalloc.start()
+        whole = genome.fetch('chrI', 1, 2**20 + 2)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertEqual(whole.tobytes().decode(), seqs['chrI'][1:2**20 + 2])
+        # The packed bytes are decoded with a lookup table instead of per-base index arrays
+        self.assertLess(peak, 3 * 2**20)
+
+        starts = rng.integers(0, 5001, size=300)
+        ends = np.minimum(starts + rng.integers(0, 100, size=300), 5001)
+        table = intervals.parse_bed([['chrII', str(s), str(e)] for s, e in zip(starts.tolist(), ends.tolist())])
+        seg = genome.fetch_intervals(table, chunk_size=1000)
+        for num, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            self.assertEqual(seg.values[seg.offsets[num]:seg.offsets[num + 1]].tobytes().decode(),
+                             seqs['chrII'][start:end])
+
+    def test_fetch_intervals(self):
+        table = intervals.parse_bed([['chrII', '1', '4', 'a'], ['chrI', '8', '20', 'b']])
+        for two_bit in (False, True):
+            genome = fasta.IndexedFasta(self.path, two_bit=two_bit)
+            seg = genome.fetch_intervals(table)
+            self.assertListEqual(seg.offsets.tolist(), [0, 3, 15])
+            self.assertEqual(seg.values[:3].tobytes().decode(), 'GAT')
+            self.assertEqual(seg.values[3:].tobytes().decode(), self.seqs['chrI'][8:20])
+            self.assertListEqual(seg.names, ['a', 'b'])
+
+    def test_cancel_noise_cpd(self):
+        cpd = np.ones(67)
+        exp_filtered = preprocessing.cancel_noise_cpd(cpd.copy(), {'chrI': 0, 'chrII': 62}, list(self.seqs.items()))
+        # The soft-masked (lower case) bases give the same result with and without the 2-bit cache
+        for two_bit in (False, True):
+            genome = fasta.IndexedFasta(self.path, two_bit=two_bit)
+            filtered = preprocessing.cancel_noise_cpd(cpd.copy(), {'chrI': 0, 'chrII': 62}, genome)
+            self.assertListEqual(filtered.tolist(), exp_filtered.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+import unittest
+import os
+import tempfile
+import shutil
+import numpy as np
+from datahandler import reader, intervals
+
+
+class TestIntervals(unittest.TestCase):
+    def test_parse_bed(self):
+        bed = reader.load_bam_bed_file('test_bed.bed', rel_path='data', is_abs_path=False)
+        table = intervals.parse_bed(bed)
+        self.assertEqual(table.start.size, 4077)
+        self.assertEqual(table.chrom_names[0], 'chrI')
+        self.assertListEqual(table.end[:2].tolist(), [1453, 4315])
+        self.assertIsNone(table.names)
+        self.assertTrue(np.all(table.strand == 0))
+
+        table = intervals.parse_bed([
+            ['chrII', '10', '20', 'gene1', '0', '+'],
+            ['chrI', '0', '5', 'gene2', '0', '-'],
+            ['chrII', '30', '35', 'gene1', '0', '.']
+        ])
+        self.assertListEqual(table.chrom_names, ['chrII', 'chrI'])
+        self.assertListEqual(table.chrom.tolist(), [0, 1, 0])
+        self.assertListEqual(table.strand.tolist(), [1, -1, 0])
+        self.assertListEqual(table.name.tolist(), [0, 1, 0])
+        self.assertListEqual(table.names, ['gene1', 'gene2'])
+
+        chunks = list(intervals.iter_bed_chunks(bed, chunk_size=1000))
+        full = intervals.parse_bed(bed)
+        self.assertListEqual([c.start.size for c in chunks], [1000, 1000, 1000, 1000, 77])
+        for col in ('chrom', 'start', 'end', 'strand', 'name'):
+            np.testing.assert_array_equal(np.concatenate([getattr(c, col) for c in chunks]), getattr(full, col))
+        self.assertListEqual(chunks[-1].chrom_names, full.chrom_names)
+        for chunk in intervals.iter_bed_chunks(bed, chunk_size=1000, names=False):
+            self.assertIsNone(chunk.names)
+            self.assertTrue(np.all(chunk.name == -1))
+
+    def test_interval_index(self):
+        rng = np.random.default_rng(0)
+        chrom_start = {'chrI': 0, 'chrII': 1000, 'chrIII': 1500}
+        fields = []
+        for chrom, length in (('chrI', 1000), ('chrII', 500)):
+            for _ in range(60):
+                start = int(rng.integers(0, length - 1))
+                fields.append([chrom, str(start), str(min(start + int(rng.integers(1, 80)), length))])
+        table = intervals.parse_bed(fields)
+        abs_start, abs_end = intervals.absolute_bounds(table, chrom_start)
+        index = intervals.build_index(table, chrom_start, genome_size=1600)
+
+        positions = np.arange(1600)
+        overlap = (abs_start[np.newaxis, :] <= positions[:, np.newaxis]) & \
+                  (abs_end[np.newaxis, :] > positions[:, np.newaxis])
+        np.testing.assert_array_equal(intervals.count_overlaps(index, positions), overlap.sum(axis=1))
+        query_idx, feature_idx = intervals.find_overlaps(index, positions, chunk_size=50)
+        exp_query, exp_feature = np.nonzero(overlap)
+        self.assertSetEqual(set(zip(query_idx.tolist(), feature_idx.tolist())),
+                            set(zip(exp_query.tolist(), exp_feature.tolist())))
+        self.assertTrue(np.all(np.diff(query_idx) >= 0))
+
+        q_start = rng.integers(0, 1500, size=300)
+        q_end = q_start + rng.integers(1, 100, size=300)
+        overlap = (abs_start[np.newaxis, :] < q_end[:, np.newaxis]) & (abs_end[np.newaxis, :] > q_start[:, np.newaxis])
+        np.testing.assert_array_equal(intervals.count_overlaps(index, q_start, q_end), overlap.sum(axis=1))
+        query_idx, feature_idx = intervals.find_overlaps(index, q_start, q_end)
+        exp_query, exp_feature = np.nonzero(overlap)
+        self.assertSetEqual(set(zip(query_idx.tolist(), feature_idx.tolist())),
+                            set(zip(exp_query.tolist(), exp_feature.tolist())))
+
+        ids, distance = intervals.nearest(index, positions)
+        chrom_bounds = np.array([0, 1000, 1500, 1600])
+        for p, i, d in zip(positions.tolist(), ids.tolist(), distance.tolist()):
+            c = np.searchsorted(chrom_bounds, p, side='right') - 1
+            on_chrom = (abs_start >= chrom_bounds[c]) & (abs_start < chrom_bounds[c + 1])
+            if not np.any(on_chrom):
+                self.assertEqual((i, d), (-1, -1))
+                continue
+            dist = np.where(p < abs_start, abs_start - p, np.maximum(p - (abs_end - 1), 0))
+            self.assertEqual(d, dist[on_chrom].min())
+            self.assertEqual(dist[i], d)
+            self.assertTrue(on_chrom[i])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'index.npz')
+            intervals.save_index(path, index)
+            loaded = intervals.load_index(path)
+            for field in intervals.IntervalIndex._fields:
+                np.testing.assert_array_equal(getattr(loaded, field), getattr(index, field))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        empty = intervals.build_index(intervals.parse_bed([]), chrom_start, genome_size=1600)
+        np.testing.assert_array_equal(intervals.count_overlaps(empty, [0, 5]), [0, 0])
+        self.assertEqual(intervals.find_overlaps(empty, [0, 5])[0].size, 0)
+        np.testing.assert_array_equal(intervals.nearest(empty, [0, 5])[0], [-1, -1])
+
+    def test_parse_gff(self):
+        tmp_dir = tempfile.mkdtemp()
+        gff_path = os.path.join(tmp_dir, 'test.gff')
+        with open(gff_path, 'w') as gff:
+            gff.write('##gff-version 3\n')
+            gff.write('II\tensembl_havana\tgene\t11\t20\t.\t-\t.\tID=gene1;Name=A\n')
+            gff.write('II\tensembl\tgene\t1\t5\t.\t+\t.\tID=gene2\n')
+            gff.write('I\tensembl_havana\tgene\t1\t5\t.\t+\t.\tName=gene3\n')
+            gff.write('##FASTA\n>I\nACGT\n')
+        try:
+            table = intervals.parse_gff(gff_path, gff_source_type=[('ensembl_havana', 'gene')])
+            self.assertListEqual(table.chrom_names, ['II', 'I'])
+            self.assertListEqual(table.start.tolist(), [10, 0])
+            self.assertListEqual(table.end.tolist(), [20, 5])
+            self.assertListEqual(table.strand.tolist(), [-1, 1])
+            self.assertListEqual(table.names, ['gene1', 'gene3'])
+            self.assertEqual(intervals.parse_gff(gff_path).start.size, 3)
+
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            intervals.parse_gff(gff_path, gff_source_type=[('ensembl_havana', 'gene')], cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            cached = intervals.parse_gff(gff_path, gff_source_type=[('ensembl_havana', 'gene')], cache_dir=cache_dir)
+            self.assertListEqual(cached.chrom_names, table.chrom_names)
+            self.assertListEqual(cached.names, table.names)
+            self.assertListEqual(cached.end.tolist(), table.end.tolist())
+
+            with open(gff_path, 'w') as gff:
+                gff.write('I\tensembl_havana\tgene\t7\t9\t.\t+\t.\tID=gene4\n')
+            stat = os.stat(gff_path)
+            os.utime(gff_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            cached = intervals.parse_gff(gff_path, gff_source_type=[('ensembl_havana', 'gene')], cache_dir=cache_dir)
+            self.assertListEqual(cached.names, ['gene4'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_absolute_bounds(self):
+        table = intervals.parse_bed([['chrII', '10', '20'], ['chrI', '0', '5']])
+        abs_start, abs_end = intervals.absolute_bounds(table, {'chrI': 0, 'chrII': 100})
+        self.assertListEqual(abs_start.tolist(), [110, 0])
+        self.assertListEqual(abs_end.tolist(), [120, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+import unittest
+import pickle
+import numpy as np
+
+from datahandler import metagene, segments
+from datahandler import seqDataHandler as seq
+
+
+class TestMetagene(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.transcripts = [rng.random(int(n)) for n in rng.integers(2, 300, size=500)]
+        self.groups = rng.choice(['low', 'high'], size=500)
+
+    def test_aggregate(self):
+        exp = seq.rescale_all(self.transcripts, vec_len=50)
+        agg = metagene.MetageneAggregator(vec_len=50, value_range=(0, 1), n_bins=200)
+        agg.add(self.transcripts, batch_size=64)
+        self.assertListEqual(agg.groups, [None])
+        self.assertEqual(agg.count(), 500)
+        np.testing.assert_allclose(agg.mean(), exp.mean(axis=0), rtol=1e-10)
+        np.testing.assert_allclose(agg.std(), exp.std(axis=0), rtol=1e-10)
+        np.testing.assert_allclose(agg.var(ddof=1), exp.var(axis=0, ddof=1), rtol=1e-10)
+        np.testing.assert_array_equal(agg.min(), exp.min(axis=0))
+        np.testing.assert_array_equal(agg.max(), exp.max(axis=0))
+        quantiles = agg.quantile([0.1, 0.5, 0.9])
+        self.assertEqual(quantiles.shape, (3, 50))
+        np.testing.assert_allclose(quantiles, np.quantile(exp, [0.1, 0.5, 0.9], axis=0), atol=2. / 200)
+        np.testing.assert_array_equal(agg.quantile(0.), exp.min(axis=0))
+        np.testing.assert_array_equal(agg.quantile(1.), exp.max(axis=0))
+        self.assertSetEqual(set(agg.summary().keys()), {'count', 'mean', 'std', 'min', 'max', 'quantiles'})
+
+        # Segments containers give the same result
+        agg_seg = metagene.MetageneAggregator(vec_len=50, value_range=(0, 1), n_bins=200)
+        agg_seg.add(segments.from_list(self.transcripts), batch_size=100)
+        np.testing.assert_allclose(agg_seg.mean(), agg.mean(), rtol=1e-12)
+        np.testing.assert_array_equal(agg_seg.quantile(0.5), agg.quantile(0.5))
+
+        no_hist = metagene.MetageneAggregator(vec_len=50).add(self.transcripts)
+        self.assertRaises(ValueError, no_hist.quantile, 0.5)
+        self.assertRaises(KeyError, no_hist.mean, 'low')
+        self.assertRaises(ValueError, no_hist.add, [np.zeros(0)])
+
+    def test_groups_and_merge(self):
+        exp = seq.rescale_all(self.transcripts, vec_len=20)
+        agg = metagene.MetageneAggregator(vec_len=20, value_range=(0, 1))
+        agg.add(self.transcripts, groups=self.groups, batch_size=77)
+        self.assertListEqual(sorted(agg.groups), ['high', 'low'])
+        for label in ('low', 'high'):
+            self.assertEqual(agg.count(label), np.count_nonzero(self.groups == label))
+            np.testing.assert_allclose(agg.mean(label), exp[self.groups == label].mean(axis=0), rtol=1e-10)
+            np.testing.assert_array_equal(agg.max(label), exp[self.groups == label].max(axis=0))
+
+        # Aggregators of separate workers are merged, also after sending them between processes
+        parts = [metagene.MetageneAggregator(vec_len=20, value_range=(0, 1)).add(self.transcripts[n::3])
+                 for n in range(3)]
+        merged = metagene.merge_all([pickle.loads(pickle.dumps(p)) for p in parts])
+        full = metagene.MetageneAggregator(vec_len=20, value_range=(0, 1)).add(self.transcripts)
+        self.assertEqual(merged.count(), 500)
+        self.assertEqual(parts[0].count(), 167)
+        np.testing.assert_allclose(merged.mean(), full.mean(), rtol=1e-10)
+        np.testing.assert_allclose(merged.std(), full.std(), rtol=1e-10)
+        np.testing.assert_array_equal(merged.quantile(0.5), full.quantile(0.5))
+        self.assertRaises(ValueError, merged.merge, metagene.MetageneAggregator(vec_len=10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+import unittest
+import os
+import tempfile
+import shutil
+import numpy as np
+import pyBigWig
+
+from datahandler import pipeline, intervals, reader
+from datahandler import seqDataHandler as seq
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        chroms = [('chrI', 500), ('chrII', 300), ('chrIII', 50)]
+        self.bw_paths = []
+        for num in range(2):
+            path = os.path.join(self.tmp_dir, 'test%d.bw' % num)
+            bw = pyBigWig.open(path, 'w')
+            bw.addHeader(chroms)
+            for chrom, length in chroms:
+                # Leave gaps without values at the beginning of every chromosome
+                bw.addEntries(chrom, 10, values=rng.random(length - 10).astype('float32').tolist(), span=1, step=1)
+            bw.close()
+            self.bw_paths.append(path)
+        self.bed = intervals.parse_bed([
+            ['chrII', '5', '120', 'gene1', '0', '+'], ['chrI', '0', '100', 'gene2', '0', '-'],
+            ['chrIII', '10', '40', 'gene3', '0', '+'], ['chrI', '300', '480', 'gene4', '0', '-']
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_iter_chroms(self):
+        all_values, chrom_start = seq.get_values(self.bw_paths)
+        chunks = list(pipeline.iter_chroms(self.bw_paths))
+        self.assertListEqual([c for c, _ in chunks], ['chrI', 'chrII', 'chrIII'])
+        for num in range(2):
+            np.testing.assert_array_equal(np.concatenate([v[num] for _, v in chunks]), all_values[num])
+
+    def test_norm_stats(self):
+        all_values, _ = seq.get_values(self.bw_paths)
+        stats = pipeline.norm_stats(pipeline.iter_chroms(self.bw_paths))
+        for (t_min, t_max, mean, std), values in zip(stats, all_values):
+            self.assertEqual(t_min, values.min())
+            self.assertEqual(t_max, values.max())
+            self.assertAlmostEqual(mean, values.mean(dtype=np.float64), 10)
+            self.assertAlmostEqual(std, values.std(dtype=np.float64), 10)
+
+    def test_run_pipeline(self):
+        for norm, norm_func in ((None, None), ('remap', seq.remap_norm_all), ('center', seq.center_norm_all)):
+            all_values, chrom_start = seq.get_values(self.bw_paths)
+            if norm_func is not None:
+                all_values = norm_func(all_values)
+            all_values = seq.smooth_all(all_values, smooth_list=[10, None], chrom_start=chrom_start)
+            exp_anno, exp_dict = seq.annotate_all(all_values, self.bed, chrom_start)
+
+            anno, t_dict = pipeline.run_pipeline(self.bw_paths, self.bed, norm=norm, smooth_list=[10, None])
+            for exp_track, track in zip(exp_anno, anno):
+                for exp_seg, seg in zip(exp_track, track):
+                    if norm == 'center':
+                        np.testing.assert_allclose(seg, exp_seg, rtol=1e-5, atol=1e-5)
+                    else:
+                        np.testing.assert_array_equal(seg, exp_seg)
+            self.assertListEqual(list(t_dict[1].keys()), list(exp_dict[1].keys()))
+
+        all_values, chrom_start = seq.get_values(self.bw_paths)
+        exp_anno, _ = seq.annotate_all(all_values, self.bed, chrom_start)
+        rescaled, _ = pipeline.run_pipeline(self.bw_paths, self.bed, vec_len=50)
+        np.testing.assert_array_equal(rescaled[0], seq.rescale_all(exp_anno[0], vec_len=50))
+
+        missing = intervals.parse_bed([['chrX', '0', '10']])
+        self.assertRaises(KeyError, pipeline.run_pipeline, self.bw_paths, missing)
+
+    def test_run_pipeline_remap_written(self):
+        # Files written by libBigWig can store a wrong maximum in the total summary of the header
+        values = np.zeros(500, dtype='float32')
+        values[:50], values[100:300], values[400:450] = 1.5, 1., 0.25
+        path = os.path.join(self.tmp_dir, 'written.bw')
+        reader.write_big_file(path, values, {'chrI': 0}, is_abs_path=True)
+        bed = intervals.parse_bed([['chrI', '0', '120', 'gene1', '0', '+'], ['chrI', '380', '500', 'gene2', '0', '-']])
+
+        all_values, chrom_start = seq.get_values([path])
+        exp_anno, _ = seq.annotate_all(seq.remap_norm_all(all_values), bed, chrom_start)
+        anno, _ = pipeline.run_pipeline([path], bed, norm='remap')
+        for exp_seg, seg in zip(exp_anno[0], anno[0]):
+            np.testing.assert_array_equal(seg, exp_seg)
+        self.assertEqual(max(seg.max() for seg in anno[0]), 1.)
+        self.assertEqual(min(seg.min() for seg in anno[0]), 0.)
+
+    def test_run_pipeline_binned_large(self):
+        rng = np.random.default_rng(1)
+        chroms = [('chrI', 210000), ('chrII', 120500)]
+        path = os.path.join(self.tmp_dir, 'large.bw')
+        bw = pyBigWig.open(path, 'w')
+        bw.addHeader(chroms)
+        exp_binned = []
+        for chrom, length in chroms:
+            values = (rng.random(length) * 5).astype('float32')
+            bw.addEntries(chrom, 0, values=values.tolist(), span=1, step=1)
+            bin_start = np.arange(0, length, 1000)
+            exp_binned.append(np.add.reduceat(values, bin_start, dtype=np.float64)
+                              / np.diff(np.append(bin_start, length)))
+        bw.close()
+        # Binned means computed from the exact base-pair values
+        exp_binned = seq.remap_norm(np.concatenate(exp_binned))
+        chrom_start, _ = intervals.chrom_layout(dict(chroms), bin_size=1000)
+        bed = intervals.parse_bed([['chrI', '5000', '80000', 'gene1', '0', '+'],
+                                   ['chrII', '100', '120500', 'gene2', '0', '-']])
+        exp_anno, _ = seq.annotate(exp_binned, bed, chrom_start, bin_size=1000)
+
+        anno, _ = pipeline.run_pipeline([path], bed, norm='remap', bin_size=1000, dtype='float64')
+        for exp_seg, seg in zip(exp_anno, anno[0]):
+            np.testing.assert_allclose(seg, exp_seg, rtol=1e-6, atol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,10 @@
 #!/usr/bin/python3
 import unittest
 import numpy as np
+from scipy.signal import argrelmax
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
-from datahandler import reader, preprocessing, seqDataHandler
+from datahandler import preprocessing
 
 
 class TestPreprocessing(unittest.TestCase):
@@ -15,8 +16,27 @@ class TestPreprocessing(unittest.TestCase):
         peaks = preprocessing.peak_detect_smooth(test_seq, peak_range=peak_range)
         self.assertListEqual(peaks.tolist(), exp_peaks)
 
+    def test_peak_detect_smooth_argrelmax_semantics(self):
+        rng = np.random.default_rng(0)
+        test_seq = rng.integers(0, 10, 500).astype('float')
+        for mode in ('wrap', 'clip'):
+            for peak_range in (1, 3, 50, 600):
+                exp_peaks, = argrelmax(test_seq, order=peak_range, mode=mode)
+                peaks = preprocessing.peak_detect_smooth(test_seq, peak_range=peak_range, mode=mode)
+                self.assertListEqual(peaks.tolist(), exp_peaks.tolist())
+
+    def test_peak_detect_smooth_chrom_start(self):
+        test_seq = np.asarray([0, 1, 0, 2, 3, 3, 3, 3, 4, 3, 2, 1, 0, 1, 1, 2, 0])
+        chrom_start = {'chrI': 0, 'chrII': 10}
+        peaks = preprocessing.peak_detect_smooth(test_seq, peak_range=3, mode='clip', chrom_start=chrom_start)
+        self.assertListEqual(peaks.tolist(), [8, 15])
+        exp_peaks = np.concatenate([argrelmax(test_seq[:10], order=2, mode='wrap')[0],
+                                    argrelmax(test_seq[10:], order=2, mode='wrap')[0] + 10])
+        peaks = preprocessing.peak_detect_smooth(test_seq, peak_range=2, mode='wrap', chrom_start=chrom_start)
+        self.assertListEqual(peaks.tolist(), exp_peaks.tolist())
+
     def test_cancel_noise_cpd(self):
-        genome = [SeqRecord(Seq('ACGACGTTA'))]
+        genome = [SeqRecord(Seq('ACGACGTTA'), id='chrI')]
         cpd = np.arange(1, 10)
         exp_filtered = np.arange(1, 10)
         exp_filtered_idx = np.asarray([2, 3, 6, 7])
@@ -28,6 +48,17 @@ class TestPreprocessing(unittest.TestCase):
         filtered_cpd = preprocessing.cancel_noise_cpd(cpd, chrom_start, genome)
         self.assertListEqual(exp_filtered.tolist(), filtered_cpd.tolist())
 
+    def test_cancel_noise_cpd_by_name(self):
+        genome = iter([('chrII', 'TTTAC'), SeqRecord(Seq('ACGACGTTA'), id='chrI'), ('chrM', 'CC')])
+        cpd = np.arange(1, 15)
+        chrom_start = {'chrI': 0, 'chrII': 9}
+        exp_filtered = [0, 0, 3, 4, 0, 0, 7, 8, 0, 10, 11, 12, 0, 0]
+
+        with self.assertWarns(RuntimeWarning):
+            filtered_cpd = preprocessing.cancel_noise_cpd(cpd, chrom_start, genome)
+        self.assertListEqual(exp_filtered, filtered_cpd.tolist())
+        self.assertRaises(ValueError, preprocessing.cancel_noise_cpd, cpd, chrom_start, [('chrI', 'ACGT')])
+
 
 if __name__ == '__main__':
     unittest.main()
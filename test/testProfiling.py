@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+import unittest
+import os
+import json
+import tempfile
+import shutil
+import numpy as np
+import pyBigWig
+
+from datahandler import profiling, preprocessing
+from datahandler import seqDataHandler as seq
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bw_path = os.path.join(self.tmp_dir, 'test.bw')
+        bw = pyBigWig.open(self.bw_path, 'w')
+        bw.addHeader([('chrI', 200), ('chrII', 100)])
+        bw.addEntries('chrI', 0, values=np.arange(200, dtype='float32').tolist(), span=1, step=1)
+        bw.addEntries('chrII', 0, values=np.arange(100, dtype='float32').tolist(), span=1, step=1)
+        bw.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_disabled(self):
+        records = []
+        self.assertFalse(profiling.enabled())
+        values, _ = seq.get_values([self.bw_path])
+        seq.remap_norm(values[0])
+        profiling.add_hook(records.append)
+        self.assertTrue(profiling.enabled())
+        profiling.remove_hook(records.append)
+        seq.remap_norm(values[0])
+        self.assertFalse(profiling.enabled())
+        self.assertListEqual(records, [])
+        self.assertEqual(seq.remap_norm.__name__, 'remap_norm')
+
+    def test_profile(self):
+        records = []
+        profiling.add_hook(records.append)
+        try:
+            with profiling.profile(trace_memory=True) as prof:
+                values, chrom_start = seq.get_values([self.bw_path])
+                seq.smooth(values[0], smooth_size=10, chrom_start=chrom_start)
+                preprocessing.peak_detect_smooth(values[0], peak_range=5, chrom_start=chrom_start)
+        finally:
+            profiling.remove_hook(records.append)
+        self.assertFalse(profiling.enabled())
+        self.assertListEqual(records, prof.records)
+
+        summary = prof.aggregate()
+        self.assertEqual(summary['seqDataHandler.get_values']['calls'], 1)
+        self.assertEqual(summary['seqDataHandler.get_values']['input_size'], os.path.getsize(self.bw_path))
+        self.assertEqual(summary['seqDataHandler.smooth']['in_size'], 300)
+        self.assertEqual(summary['seqDataHandler.smooth']['out_size'], 300)
+        self.assertGreaterEqual(summary['seqDataHandler.smooth']['peak_bytes'], 300 * 4)
+        # The peak of the nested calls is contained in the peak of the enclosing call
+        self.assertGreaterEqual(summary['seqDataHandler.get_values']['peak_bytes'],
+                                summary['_internal.fill_chrom']['peak_bytes'])
+
+        by_chrom = prof.aggregate(by_chrom=True)
+        self.assertSetEqual(set(by_chrom.keys()), {
+            ('_internal.fill_chrom', 'chrI'), ('_internal.fill_chrom', 'chrII'),
+            ('preprocessing.peak_detect_smooth:chrom', 'chrI'), ('preprocessing.peak_detect_smooth:chrom', 'chrII')
+        })
+        self.assertEqual(by_chrom[('preprocessing.peak_detect_smooth:chrom', 'chrI')]['in_size'], 200)
+
+        json_path = os.path.join(self.tmp_dir, 'profile.json')
+        prof.to_json(json_path)
+        with open(json_path) as json_file:
+            content = json.load(json_file)
+        self.assertEqual(len(content['records']), len(prof.records))
+        self.assertEqual(len(content['chromosomes']), 4)
+        self.assertIn('seqDataHandler.get_values', prof.format_summary())
+        self.assertIn('chrII', prof.format_summary(by_chrom=True))
+
+    def test_exception(self):
+        with profiling.profile() as prof:
+            self.assertRaises(ValueError, seq.header_stats, self.bw_path, bin_size=10)
+        self.assertEqual(len(prof.records), 1)
+        self.assertEqual(prof.records[0]['function'], 'seqDataHandler.header_stats')
+
+
+if __name__ == '__main__':
+    unittest.main()
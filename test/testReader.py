@@ -1,7 +1,12 @@
 #!/usr/bin/python3
 import unittest
 import os
-from datahandler import reader
+import tempfile
+import shutil
+import numpy as np
+import pyBigWig
+from datahandler import reader, intervals
+from datahandler import seqDataHandler as seq
 import wget
 
 
@@ -54,6 +59,148 @@ class TestReader(unittest.TestCase):
         fasta = reader.load_fast(name, rel_path='', is_abs_path=False, is_fastq=False)
         self.assertIsNot(fasta, None)
 
+    def test_create_bed_random_fragments(self):
+        chrom_dict = {'chrI': 10000, 'chrII': 2500}
+        table = reader.create_bed_random_fragments(chrom_dict, max_chunk=300, seed=3, in_memory=True)
+        self.assertListEqual(table.chrom_names, ['chrI', 'chrII'])
+        for num, length in enumerate(chrom_dict.values()):
+            mask = table.chrom == num
+            self.assertEqual(table.start[mask][0], 0)
+            self.assertEqual(table.end[mask][-1], length)
+            self.assertListEqual(table.start[mask][1:].tolist(), table.end[mask][:-1].tolist())
+        fragment_len = table.end - table.start
+        self.assertTrue(np.all(fragment_len[table.end != 10000][:-1] <= 300))
+        self.assertTrue(np.all(fragment_len > 0))
+
+        same = reader.create_bed_random_fragments(chrom_dict, max_chunk=300, seed=3, in_memory=True)
+        self.assertListEqual(same.end.tolist(), table.end.tolist())
+
+        ref_lengths = [50, 80]
+        replicates = reader.create_bed_random_fragments(chrom_dict, lengths=ref_lengths, seed=1, replicates=3,
+                                                        in_memory=True)
+        self.assertEqual(len(replicates), 3)
+        self.assertNotEqual(replicates[0].end.tolist(), replicates[1].end.tolist())
+        for rep in replicates:
+            inner = np.concatenate([np.diff(rep.end[rep.chrom == c])[:-1] for c in range(2)])
+            self.assertTrue(np.all(np.isin(inner, ref_lengths)))
+
+        tmp_dir = tempfile.mkdtemp(dir=os.getcwd())
+        try:
+            reader.create_bed_random_fragments(chrom_dict, max_chunk=300, seed=3, path=os.path.relpath(tmp_dir),
+                                               name='frag')
+            written = intervals.parse_bed(os.path.join(tmp_dir, 'frag.bed'))
+            self.assertListEqual(written.start.tolist(), table.start.tolist())
+            self.assertListEqual(written.end.tolist(), table.end.tolist())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_write_big_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            rng = np.random.default_rng(0)
+            values = np.repeat(rng.integers(0, 3, 200).astype('float32'), rng.integers(1, 20, 200))
+            values[5:9] = np.nan
+            chrom_start = {'chrI': 0, 'chrII': 1000, 'chrIII': values.size - 7}
+            chroms = {'chrI': 1000, 'chrII': values.size - 1007, 'chrIII': 7}
+            path = os.path.join(tmp_dir, 'test.bw')
+            reader.write_big_file(path, values, chrom_start, is_abs_path=True, batch_size=100)
+            bw = pyBigWig.open(path)
+            self.assertDictEqual(bw.chroms(), chroms)
+            written = np.concatenate([bw.values(c, 0, l, numpy=True) for c, l in chroms.items()])
+            np.testing.assert_array_equal(written, np.where(values == 0, np.nan, values))
+            bw.close()
+
+            reader.write_big_file(path, values, chrom_start, is_abs_path=True, skip_zeros=False)
+            bw = pyBigWig.open(path)
+            np.testing.assert_array_equal(np.concatenate([bw.values(c, 0, l, numpy=True) for c, l in chroms.items()]),
+                                          values)
+            bw.close()
+
+            reader.write_big_file(path, values, chrom_start, is_abs_path=True, bin_size=10, batch_size=3)
+            binned_values, binned_start = seq.get_values([path], bin_size=10)
+            exp = []
+            for chrom, length in chroms.items():
+                edges = np.arange(0, length, 10)
+                exp.append(np.add.reduceat(np.nan_to_num(values[chrom_start[chrom]:chrom_start[chrom] + length]),
+                                           edges) / np.diff(np.append(edges, length)))
+            np.testing.assert_allclose(binned_values[0], np.concatenate(exp), rtol=1e-6)
+
+            binned = np.arange(100 + -(-chroms['chrII'] // 10) + 1, dtype='float32')
+            binned_start = {'chrI': 0, 'chrII': 100, 'chrIII': binned.size - 1}
+            reader.write_big_file(path, binned, binned_start, is_abs_path=True, bin_size=10, chroms=chroms)
+            bw = pyBigWig.open(path)
+            self.assertDictEqual(bw.chroms(), chroms)
+            self.assertTrue(np.isnan(bw.values('chrI', 0, 1)[0]))
+            self.assertEqual(bw.values('chrI', 15, 16)[0], 1.)
+            self.assertEqual(bw.values('chrIII', 6, 7)[0], binned[-1])
+            bw.close()
+            self.assertRaises(ValueError, reader.write_big_file, path, binned, binned_start, is_abs_path=True,
+                              chroms=chroms)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_handle_pool(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            paths = []
+            for num in range(3):
+                path = os.path.join(tmp_dir, 'test%d.bw' % num)
+                bw = pyBigWig.open(path, 'w')
+                bw.addHeader([('chrI', 100)])
+                bw.addEntries('chrI', 0, values=[float(num)] * 100, span=1, step=1)
+                bw.close()
+                paths.append(path)
+            gff_path = os.path.join(tmp_dir, 'test.gff')
+            with open(gff_path, 'w') as gff:
+                gff.write('##gff-version 3\n')
+
+            pool = reader.HandlePool(max_open=2)
+            with pool.open(paths[0]) as bw:
+                with pool.open(os.path.join(tmp_dir, '.', 'test0.bw')) as bw_nested:
+                    self.assertIs(bw_nested, bw)
+                self.assertEqual(bw.values('chrI', 0, 1)[0], 0.)
+            with pool.open(paths[1]) as bw:
+                self.assertEqual(bw.values('chrI', 0, 1)[0], 1.)
+            self.assertEqual(len(pool), 2)
+            with pool.open(paths[2]):
+                pass
+            # The least recently used handle is closed
+            self.assertEqual(len(pool), 2)
+            self.assertNotIn(('bigwig', os.path.realpath(paths[0])), pool._handles)
+
+            # A forked process does not use the inherited handles
+            pool._pid = -1
+            with pool.open(paths[1]) as bw:
+                self.assertEqual(len(pool), 1)
+
+            with pool.open(gff_path, kind='text') as gff:
+                self.assertEqual(gff.readline(), '##gff-version 3\n')
+                with pool.open(gff_path, kind='text') as gff_nested:
+                    self.assertIsNot(gff_nested, gff)
+                    self.assertEqual(gff_nested.readline(), '##gff-version 3\n')
+                self.assertTrue(gff_nested.closed)
+            with pool.open(gff_path, kind='text') as gff_reused:
+                self.assertIs(gff_reused, gff)
+                self.assertEqual(gff_reused.readline(), '##gff-version 3\n')
+
+            try:
+                with pool.open(gff_path, kind='text'):
+                    raise RuntimeError()
+            except RuntimeError:
+                pass
+            self.assertEqual(pool._handles[('text', os.path.realpath(gff_path))][1], 0)
+
+            self.assertEqual(len(pool), 2)
+            pool.close()
+            self.assertEqual(len(pool), 0)
+            self.assertRaises(ValueError, pool.open(paths[0], kind='fasta').__enter__)
+
+            with reader.open_big_file(paths[2], is_abs_path=True) as bw:
+                self.assertEqual(bw.values('chrI', 0, 1)[0], 2.)
+            reader.close_files()
+        finally:
+            shutil.rmtree(tmp_dir)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+import unittest
+import os
+import io
+import json
+import tempfile
+import shutil
+import numpy as np
+import pyBigWig
+
+from datahandler import runner, intervals, segments, reader
+from datahandler import seqDataHandler as seq
+
+
+class TestRunner(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.default_rng(0)
+        chroms = [('chrI', 500), ('chrII', 300)]
+        for num in range(3):
+            bw = pyBigWig.open(os.path.join(self.tmp_dir, 'track%d.bw' % num), 'w')
+            bw.addHeader(chroms)
+            for chrom, length in chroms:
+                bw.addEntries(chrom, 0, values=rng.random(length).tolist(), span=1, step=1)
+            bw.close()
+        with open(os.path.join(self.tmp_dir, 'genes.bed'), 'w') as bed:
+            bed.write('chrI\t10\t100\tgene1\t0\t+\nchrII\t50\t250\tgene2\t0\t-\nchrI\t300\t310\tgene3\t0\t+\n')
+        self.manifest = {
+            'output_dir': 'results',
+            'annotation': 'genes.bed',
+            'steps': {'norm': 'remap', 'smooth': 10, 'vec_len': 20},
+            'samples': [{'name': 'a', 'tracks': ['track0.bw', 'track1.bw']}, {'name': 'b', 'tracks': ['track2.bw']}]
+        }
+        self.manifest_path = os.path.join(self.tmp_dir, 'manifest.json')
+        self.write_manifest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_manifest(self):
+        with open(self.manifest_path, 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file)
+
+    def test_run_manifest(self):
+        progress = io.StringIO()
+        self.assertEqual(runner.main([self.manifest_path, '--workers', '2', '--quiet']), 0)
+        manifest = runner.load_manifest(self.manifest_path)
+        bw_paths = [os.path.join(self.tmp_dir, 'track%d.bw' % num) for num in range(2)]
+        bed = intervals.parse_bed(os.path.join(self.tmp_dir, 'genes.bed'))
+        all_values, chrom_start = seq.get_values(bw_paths)
+        all_values = seq.smooth_all(seq.remap_norm_all(all_values), [10, 10], chrom_start=chrom_start)
+        exp, _ = seq.annotate_all(all_values, bed, chrom_start)
+        with np.load(os.path.join(self.tmp_dir, 'results', 'a.npz')) as result:
+            np.testing.assert_allclose(result['track1'], seq.rescale_all(exp[1], vec_len=20), rtol=1e-6)
+            self.assertListEqual(result['names'].tolist(), ['gene1', 'gene2', 'gene3'])
+
+        # Completed samples are skipped; changed parameters or inputs are processed again
+        done, skipped, failed = runner.run_manifest(manifest, progress=progress)
+        self.assertListEqual(done, [])
+        self.assertListEqual(failed, [])
+        self.assertListEqual(skipped, ['a', 'b'])
+        self.assertIn('Skipping 2', progress.getvalue())
+
+        os.remove(os.path.join(self.tmp_dir, 'results', 'b.npz'))
+        done, skipped, _ = runner.run_manifest(manifest, progress=progress)
+        self.assertListEqual([d['name'] for d in done], ['b'])
+        self.assertIn('[1/1] b finished', progress.getvalue())
+
+        self.manifest['steps'] = {'smooth': [5, None]}
+        self.write_manifest()
+        done, _, _ = runner.run_manifest(runner.load_manifest(self.manifest_path))
+        self.assertListEqual(sorted(d['name'] for d in done), ['a', 'b'])
+        with np.load(os.path.join(self.tmp_dir, 'results', 'a.npz')) as result:
+            container = segments.Segments(values=result['track1_values'], offsets=result['track1_offsets'],
+                                          names=None)
+            raw, _ = seq.annotate_all(seq.get_values(bw_paths)[0], bed, chrom_start)
+            for seg, exp_seg in zip(segments.to_list(container), raw[1]):
+                np.testing.assert_array_equal(seg, exp_seg)
+
+    def test_remap_bounds(self):
+        # The maximum in the header of files written by libBigWig is not reliable
+        values = np.zeros(800, dtype='float32')
+        values[:20], values[60:280], values[320:] = 4., 1., 2.
+        path = os.path.join(self.tmp_dir, 'written.bw')
+        reader.write_big_file(path, values, {'chrI': 0}, is_abs_path=True)
+        with open(os.path.join(self.tmp_dir, 'genes.bed'), 'w') as bed:
+            bed.write('chrI\t0\t100\tgene1\t0\t+\nchrI\t300\t700\tgene2\t0\t-\n')
+        self.manifest['samples'] = [{'name': 'w', 'tracks': ['written.bw']}]
+        self.manifest['steps'] = {'norm': 'remap', 'vec_len': 50}
+        self.write_manifest()
+        self.assertEqual(runner.main([self.manifest_path, '--quiet']), 0)
+        with np.load(os.path.join(self.tmp_dir, 'results', 'w.npz')) as result:
+            self.assertEqual(result['track0'].min(), 0.)
+            self.assertEqual(result['track0'].max(), 1.)
+
+    def test_genome_output_and_validation(self):
+        del self.manifest['annotation']
+        self.manifest['steps'] = {'bin_size': 100}
+        self.write_manifest()
+        runner.main([self.manifest_path, '--quiet'])
+        all_values, chrom_start = seq.get_values([os.path.join(self.tmp_dir, 'track2.bw')], bin_size=100)
+        with np.load(os.path.join(self.tmp_dir, 'results', 'b.npz')) as result:
+            np.testing.assert_array_equal(result['track0'], all_values[0])
+            self.assertListEqual(result['chrom_start'].tolist(), list(chrom_start.values()))
+
+        for steps in ({'norm': 'log'}, {'vec_len': 10}, {'unknown': 1}):
+            self.manifest['steps'] = steps
+            self.write_manifest()
+            self.assertRaises(ValueError, runner.load_manifest, self.manifest_path)
+
+    def test_failures_and_gff(self):
+        # A missing track and a failing sample do not stop the other samples
+        self.manifest['samples'].append({'name': 'c', 'tracks': ['missing.bw']})
+        self.manifest['samples'].append({'name': 'd', 'tracks': ['broken.bw']})
+        with open(os.path.join(self.tmp_dir, 'broken.bw'), 'w') as broken:
+            broken.write('not a bigwig file')
+        self.write_manifest()
+        progress = io.StringIO()
+        for workers in (1, 2):
+            done, _, failed = runner.run_manifest(runner.load_manifest(self.manifest_path), workers=workers,
+                                                  force=True, progress=progress)
+            self.assertListEqual(sorted(d['name'] for d in done), ['a', 'b'])
+            self.assertListEqual(sorted(name for name, _ in failed), ['c', 'd'])
+        self.assertIn('c failed', progress.getvalue())
+        self.assertEqual(runner.main([self.manifest_path, '--quiet']), 1)
+
+        # The gff sequence ids are mapped to the chromosome names of the bigwig files
+        with open(os.path.join(self.tmp_dir, 'genes.gff'), 'w') as gff:
+            gff.write('I\tsrc\tgene\t11\t100\t.\t+\t.\tID=gene1\nII\tsrc\tgene\t51\t250\t.\t-\t.\tID=gene2\n')
+        self.manifest['samples'] = self.manifest['samples'][1:2]
+        self.manifest['annotation'] = 'genes.gff'
+        self.manifest['steps'] = {}
+        for chrom_map in (None, 'chr%s', {'I': 'chrI', 'II': 'chrII'}):
+            self.manifest['chrom_map'] = chrom_map
+            self.write_manifest()
+            done, _, failed = runner.run_manifest(runner.load_manifest(self.manifest_path), force=True)
+            self.assertListEqual(failed, [])
+            bed = intervals.parse_bed(os.path.join(self.tmp_dir, 'genes.bed'))
+            all_values, chrom_start = seq.get_values([os.path.join(self.tmp_dir, 'track2.bw')])
+            exp, _ = seq.annotate(all_values[0], bed, chrom_start)
+            with np.load(os.path.join(self.tmp_dir, 'results', 'b.npz')) as result:
+                np.testing.assert_array_equal(result['track0_values'][:90], exp[0])
+                np.testing.assert_array_equal(result['track0_values'][90:], exp[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
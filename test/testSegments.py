@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+import unittest
+import os
+import tempfile
+import shutil
+import numpy as np
+from datahandler import segments
+
+
+class TestSegments(unittest.TestCase):
+    def test_from_list_and_to_list(self):
+        arrays = [np.arange(3.), np.arange(0.), np.arange(5.)]
+        seg = segments.from_list(arrays, names=['a', 'b', 'c'])
+        self.assertListEqual(seg.offsets.tolist(), [0, 3, 3, 8])
+        self.assertListEqual(segments.lengths(seg).tolist(), [3, 0, 5])
+        for exp, res in zip(arrays, segments.to_list(seg)):
+            self.assertListEqual(exp.tolist(), res.tolist())
+
+        seg = segments.from_list([[1, 2], [], [3]])
+        self.assertEqual(seg.values.dtype, np.float64)
+        self.assertListEqual(seg.values.tolist(), [1., 2., 3.])
+        self.assertListEqual(segments.from_list([[1, 2], [3]]).values.tolist(), [1, 2, 3])
+
+    def test_reduce_segments(self):
+        seg = segments.from_list([np.arange(3.), np.arange(0.), np.arange(5.)])
+        sums = segments.reduce_segments(np.add, seg)
+        self.assertListEqual(sums[[0, 2]].tolist(), [3., 10.])
+        self.assertTrue(np.isnan(sums[1]))
+
+    def test_save_and_load_segments(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'segments')
+            seg = segments.from_list([np.arange(3.), np.arange(5.)], names=['a', 'b'])
+            segments.save_segments(path, seg)
+            loaded = segments.load_segments(path, mmap_mode='r')
+            self.assertIsInstance(loaded.values, np.memmap)
+            self.assertListEqual(loaded.values.tolist(), seg.values.tolist())
+            self.assertListEqual(loaded.offsets.tolist(), seg.offsets.tolist())
+            self.assertListEqual(loaded.names, ['a', 'b'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,38 @@
 #!/usr/bin/python3
 import unittest
 import os
+import tempfile
+import shutil
 import numpy as np
+import pyBigWig
 import wget
 
-from datahandler import reader
+from datahandler import reader, intervals, segments, cache
 
 from datahandler import seqDataHandler as seq
 
 
+def write_test_bigwig(path):
+    bw = pyBigWig.open(path, 'w')
+    bw.addHeader([('chrI', 100), ('chrII', 60)])
+    bw.addEntries(['chrI', 'chrI', 'chrII'], [0, 40, 10], ends=[20, 60, 30], values=[1.5, 2., 3.])
+    bw.close()
+    exp_values = np.zeros(160)
+    exp_values[0:20] = 1.5
+    exp_values[40:60] = 2.
+    exp_values[110:130] = 3.
+    return exp_values
+
+
 class TestSeqDataHandler(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bw_path = os.path.join(self.tmp_dir, 'test.bw')
+        self.exp_values = write_test_bigwig(self.bw_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
     def test_center_norm_and_center_norm_all(self):
         data = np.arange(9)
         mean = 4.
@@ -129,6 +152,314 @@ class TestSeqDataHandler(unittest.TestCase):
 
         self.assertEqual(chrom_dict[test_chrom], test_chrom_start)
 
+    def test_get_values_preallocated(self):
+        bigwig = reader.load_big_file(self.bw_path, is_abs_path=True)
+        all_values, chrom_dict = seq.get_values([bigwig, bigwig])
+        self.assertDictEqual(chrom_dict, {'chrI': 0, 'chrII': 100})
+        self.assertEqual(all_values[0].dtype, np.float32)
+        self.assertListEqual(all_values[1].tolist(), self.exp_values.tolist())
+
+        out = np.full((2, 160), np.nan)
+        all_values, _ = seq.get_values([bigwig, bigwig], out=out)
+        self.assertIs(all_values[0].base, out)
+        self.assertListEqual(out[0].tolist(), self.exp_values.tolist())
+        self.assertRaises(ValueError, seq.get_values, [bigwig], out=[np.zeros(10)])
+
+    def test_get_values_cached(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        all_values, chrom_dict = seq.get_values([self.bw_path], cache_dir=cache_dir)
+        self.assertIsInstance(all_values[0], np.memmap)
+        self.assertListEqual(all_values[0].tolist(), self.exp_values.tolist())
+
+        cached_values, cached_chrom_dict = seq.get_values([self.bw_path], cache_dir=cache_dir, cache_max_size=0)
+        self.assertIsInstance(cached_values[0], np.memmap)
+        self.assertListEqual(cached_values[0].tolist(), self.exp_values.tolist())
+        self.assertDictEqual(cached_chrom_dict, chrom_dict)
+
+        bigwig = reader.load_big_file(self.bw_path, is_abs_path=True)
+        self.assertRaises(ValueError, seq.get_values, [bigwig], cache_dir=cache_dir)
+
+    def test_get_values_parallel(self):
+        serial_values, chrom_dict = seq.get_values([self.bw_path, self.bw_path])
+        parallel_values, parallel_chrom_dict = seq.get_values([self.bw_path, self.bw_path], workers=2)
+        self.assertDictEqual(parallel_chrom_dict, chrom_dict)
+        for serial, parallel in zip(serial_values, parallel_values):
+            self.assertNotIsInstance(parallel, np.memmap)
+            self.assertEqual(serial.tobytes(), parallel.tobytes())
+
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        cached_values, _ = seq.get_values([self.bw_path], cache_dir=cache_dir, workers=2)
+        self.assertEqual(cached_values[0].tobytes(), serial_values[0].tobytes())
+
+        bigwig = reader.load_big_file(self.bw_path, is_abs_path=True)
+        self.assertRaises(ValueError, seq.get_values, [bigwig], workers=2)
+
+    def test_get_values_rewritten_file(self):
+        all_values, chrom_dict = seq.get_values([self.bw_path])
+        self.assertListEqual(all_values[0].tolist(), self.exp_values.tolist())
+
+        # The pooled handle of the old file must not be reused
+        reader.write_big_file(self.bw_path, np.ones(3, dtype='float32'), {'chrI': 0, 'chrII': 2}, is_abs_path=True)
+        all_values, chrom_dict = seq.get_values([self.bw_path])
+        self.assertDictEqual(chrom_dict, {'chrI': 0, 'chrII': 2})
+        self.assertListEqual(all_values[0].tolist(), [1., 1., 1.])
+        self.assertEqual(seq.header_stats(self.bw_path)[2], 1.)
+
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        seq.get_values([self.bw_path], cache_dir=cache_dir)
+        write_test_bigwig(self.bw_path)
+        cached_values, chrom_dict = seq.get_values([self.bw_path], cache_dir=cache_dir)
+        self.assertDictEqual(chrom_dict, {'chrI': 0, 'chrII': 100})
+        self.assertListEqual(cached_values[0].tolist(), self.exp_values.tolist())
+        # The new entry is stamped with the state of the file that was read
+        self.assertListEqual(cache.load_cached_values(self.bw_path, cache_dir)[0].tolist(), self.exp_values.tolist())
+
+    def test_annotate_interval_table(self):
+        data = np.arange(160.)
+        data[5] = np.nan
+        bed = [['chrI', '2', '8', 'gene1', '0', '+'], ['chrII', '0', '4', 'gene2', '0', '-'],
+               ['chrI', '0', '3', 'gene3', '0', '-']]
+        table = intervals.parse_bed(bed)
+        chrom_start = {'chrI': 0, 'chrII': 100}
+
+        anno, trans_dict = seq.annotate(data.copy(), table, chrom_start)
+        self.assertListEqual(anno[0].tolist(), [2., 3., 4., 0., 6., 7.])
+        self.assertListEqual(anno[1].tolist(), [103., 102., 101., 100.])
+        self.assertListEqual(anno[2].tolist(), [2., 1., 0.])
+        self.assertIs(trans_dict['gene2'], anno[1])
+
+        anno_l, t_dict_l = seq.annotate_all([data.copy(), 2 * data], bed, chrom_start)
+        self.assertListEqual(anno_l[0][1].tolist(), anno[1].tolist())
+        self.assertListEqual(t_dict_l[1]['gene3'].tolist(), [4., 2., 0.])
+
+        # Empty intervals on the minus strand give empty segments, also at the start of the genome
+        empty = intervals.parse_bed([['chrI', '0', '0', 'gene4', '0', '-'], ['chrII', '2', '2', 'gene5', '0', '-']])
+        anno, _ = seq.annotate(data, empty, chrom_start)
+        self.assertListEqual([a.size for a in anno], [0, 0])
+        seg, _ = seq.annotate(data, empty, chrom_start, ragged=True)
+        self.assertListEqual(seg.offsets.tolist(), [0, 0, 0])
+
+    def test_annotate_ragged(self):
+        data = np.arange(160.)
+        bed = [['chrI', '2', '8', 'gene1', '0', '+'], ['chrII', '0', '4', 'gene2', '0', '-']]
+        chrom_start = {'chrI': 0, 'chrII': 100}
+        anno, _ = seq.annotate(data, bed, chrom_start)
+
+        seg, name_index = seq.annotate(data, bed, chrom_start, ragged=True)
+        self.assertIsInstance(seg, segments.Segments)
+        self.assertListEqual(seg.offsets.tolist(), [0, 6, 10])
+        self.assertListEqual(seg.values[6:].tolist(), anno[1].tolist())
+        self.assertDictEqual(name_index, {'gene1': 0, 'gene2': 1})
+
+        seg_l, _ = seq.annotate_all([data, data], bed, chrom_start, ragged=True)
+        self.assertListEqual(seg_l[1].values.tolist(), seg.values.tolist())
+
+    def test_all_functions_with_segments(self):
+        rng = np.random.default_rng(0)
+        arrays = [rng.random(n) for n in (1200, 1500, 2100)]
+        seg = segments.from_list(arrays)
+        for func in (seq.center_norm_all, seq.remap_norm_all):
+            for exp, res in zip(func([a.copy() for a in arrays]), segments.to_list(func(seg))):
+                np.testing.assert_allclose(exp, res)
+
+        np.testing.assert_array_equal(seq.binning_all(arrays), seq.binning_all(seg))
+        np.testing.assert_array_equal(seq.rescale_all(arrays, vec_len=100), seq.rescale_all(seg, vec_len=100))
+
+    def test_rescale_all_batched(self):
+        rng = np.random.default_rng(0)
+        arrays = [rng.random(n) for n in (2, 17, 1000, 2500)]
+        for vec_len in (1, 10, 1000, None):
+            exp_len = vec_len if vec_len is not None else 2500
+            exp_result = np.asarray([seq.rescale(a, vec_len=exp_len) for a in arrays])
+            np.testing.assert_allclose(seq.rescale_all(arrays, vec_len=vec_len), exp_result, rtol=1e-12)
+
+        out = np.zeros((len(arrays), 10), dtype='float32')
+        rescaled = seq.rescale_all(segments.from_list(arrays), vec_len=10, out=out)
+        self.assertIs(rescaled, out)
+        np.testing.assert_allclose(out[2], seq.rescale(arrays[2], vec_len=10), rtol=1e-6)
+        self.assertRaises(ValueError, seq.rescale_all, [np.zeros(0)])
+
+        lists = [a.tolist() for a in arrays]
+        np.testing.assert_allclose(seq.rescale_all(lists, vec_len=10), seq.rescale_all(arrays, vec_len=10), rtol=1e-12)
+        np.testing.assert_allclose(seq.rescale_all([[1, 2], [3, 4, 5]], vec_len=2), [[1., 2.], [3., 5.]])
+
+    def test_smooth_chrom_start_and_in_place(self):
+        data = np.arange(12.)
+        chrom_start = {'chrI': 0, 'chrII': 6}
+        exp_result = np.concatenate([seq.smooth(data[:6], smooth_size=3), seq.smooth(data[6:], smooth_size=3)])
+        smooth_data = seq.smooth(data, smooth_size=3, chrom_start=chrom_start)
+        np.testing.assert_allclose(smooth_data, exp_result)
+        self.assertAlmostEqual(smooth_data[5], 3., 10)
+
+        exp_result = seq.smooth(data, smooth_size=4)
+        smooth_data = seq.smooth(data, smooth_size=4, out=data)
+        self.assertIs(smooth_data, data)
+        np.testing.assert_allclose(data, exp_result)
+
+        # Windows longer than the data array use dtype and write the moving average of every position into out
+        short = np.arange(5.)
+        self.assertEqual(seq.smooth(short, smooth_size=8, dtype='float32').dtype, np.float32)
+        padded = np.concatenate([np.zeros(4), short, np.zeros(3)])
+        exp_result = np.asarray([padded[i:i + 8].sum() / 8. for i in range(5)])
+        smooth_data = seq.smooth(short, smooth_size=8, out=short)
+        self.assertIs(smooth_data, short)
+        np.testing.assert_allclose(short, exp_result)
+
+        smooth_data_all = seq.smooth_all([data, data], smooth_list=[3, None], chrom_start=chrom_start, workers=2)
+        self.assertListEqual(smooth_data_all[1].tolist(), data.tolist())
+
+    def test_annotate_gff_from_bw(self):
+        gff_path = os.path.join(self.tmp_dir, 'test.gff')
+        with open(gff_path, 'w') as gff:
+            gff.write('I\tensembl_havana\tgene\t16\t25\t.\t+\t.\tID=gene1\n')
+            gff.write('II\tensembl_havana\tgene\t9\t12\t.\t-\t.\tID=gene2\n')
+            gff.write('I\tensembl\tgene\t1\t5\t.\t+\t.\tID=gene3\n')
+            gff.write('I\tensembl_havana\tgene\t38\t42\t.\t-\t.\tID=gene4\n')
+        bw = pyBigWig.open(self.bw_path)
+        anno = seq.annotate_gff_from_bw(bw, gff_path)
+        self.assertEqual(len(anno), 3)
+        self.assertListEqual(anno[0].tolist(), self.exp_values[15:25].tolist())
+        self.assertListEqual(anno[1].tolist(), self.exp_values[37:42][::-1].tolist())
+        self.assertListEqual(anno[2].tolist(), self.exp_values[108:112][::-1].tolist())
+
+        anno_map = seq.annotate_gff_from_bw(bw, gff_path, chrom_map={'I': 'chrI', 'II': 'chrII'},
+                                            cache_dir=os.path.join(self.tmp_dir, 'cache'))
+        for a, b in zip(anno, anno_map):
+            self.assertListEqual(a.tolist(), b.tolist())
+        bw.close()
+
+    def test_get_values_binned(self):
+        values, chrom_start = seq.get_values([self.bw_path], bin_size=15)
+        self.assertDictEqual(chrom_start, {'chrI': 0, 'chrII': 7})
+        bin_start = np.append(np.arange(0, 100, 15), np.arange(100, 160, 15))
+        exp_result = np.add.reduceat(self.exp_values, bin_start) / np.diff(np.append(bin_start, 160))
+        np.testing.assert_allclose(values[0], exp_result, rtol=1e-6)
+
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        cached, _ = seq.get_values([self.bw_path], bin_size=15, cache_dir=cache_dir)
+        cached, cached_start = seq.get_values([self.bw_path], bin_size=15, cache_dir=cache_dir)
+        self.assertIsInstance(cached[0], np.memmap)
+        self.assertDictEqual(cached_start, chrom_start)
+        np.testing.assert_array_equal(cached[0], values[0])
+        full, _ = seq.get_values([self.bw_path], cache_dir=cache_dir)
+        self.assertEqual(full[0].size, 160)
+
+        parallel, _ = seq.get_values([self.bw_path, self.bw_path], bin_size=15, workers=2)
+        np.testing.assert_array_equal(parallel[1], values[0])
+
+        bed = [['chrI', '10', '31', 'gene1', '0', '+'], ['chrII', '10', '12', 'gene2', '0', '-']]
+        anno, _ = seq.annotate(values[0], bed, chrom_start, bin_size=15)
+        self.assertListEqual(anno[0].tolist(), values[0][0:3].tolist())
+        self.assertListEqual(anno[1].tolist(), values[0][7:8].tolist())
+        seg, _ = seq.annotate(values[0], bed, chrom_start, ragged=True, bin_size=15)
+        self.assertListEqual(seg.offsets.tolist(), [0, 3, 4])
+
+        data = np.arange(40.)
+        self.assertListEqual(seq.binning(data, num_bins=2, offset_l=50, offset_r=50, bins_l=1, bins_r=1,
+                                         bin_size=10).tolist(),
+                             seq.binning(data, num_bins=2, offset_l=5, offset_r=5, bins_l=1, bins_r=1).tolist())
+
+    def test_get_values_binned_large(self):
+        # Large bin sizes on a track that is large enough to have zoom levels, which are not used for the bin means
+        rng = np.random.default_rng(0)
+        chroms = [('chrI', 200003), ('chrII', 150000)]
+        exp_values = {}
+        path = os.path.join(self.tmp_dir, 'large.bw')
+        bw = pyBigWig.open(path, 'w')
+        bw.addHeader(chroms)
+        for chrom, length in chroms:
+            exp_values[chrom] = rng.random(length) * 5
+            # Missing values count as zero
+            exp_values[chrom][1000:25000] = 0
+            bw.addEntries(chrom, 0, values=exp_values[chrom][:1000].tolist(), span=1, step=1)
+            bw.addEntries(chrom, 25000, values=exp_values[chrom][25000:].tolist(), span=1, step=1)
+        bw.close()
+
+        for bin_size in (1000, 10000):
+            values, chrom_start = seq.get_values([path], bin_size=bin_size, dtype='float64')
+            for chrom, length in chroms:
+                bin_start = np.arange(0, length, bin_size)
+                exp_result = np.add.reduceat(exp_values[chrom], bin_start) / np.diff(np.append(bin_start, length))
+                np.testing.assert_allclose(values[0][chrom_start[chrom]:chrom_start[chrom] + bin_start.size],
+                                           exp_result, rtol=1e-6)
+
+    def test_norm_stats_and_out(self):
+        values, _ = seq.get_values([self.bw_path])
+        data_min, data_max, mean, std = seq.header_stats(self.bw_path)
+        self.assertEqual(data_min, 0.)
+        self.assertEqual(data_max, 3.)
+        self.assertAlmostEqual(mean, values[0].mean(dtype=np.float64), 10)
+        self.assertAlmostEqual(std, values[0].std(dtype=np.float64), 10)
+        np.testing.assert_allclose(seq.array_stats(values[0], chunk_size=7), (data_min, data_max, mean, std))
+        self.assertRaises(ValueError, seq.header_stats, self.bw_path, bin_size=10)
+
+        # Files written by libBigWig do not store a reliable minimum and maximum in the total summary
+        written_path = os.path.join(self.tmp_dir, 'written.bw')
+        reader.write_big_file(written_path, np.full(160, 5., dtype='float32'), {'chrI': 0}, is_abs_path=True)
+        self.assertTupleEqual(tuple(map(float, seq.header_stats(written_path))), (5., 5., 5., 0.))
+        written = np.zeros(160, dtype='float32')
+        written[:20], written[50:70], written[120:150] = 3., 2., 1.
+        reader.write_big_file(written_path, written, {'chrI': 0}, is_abs_path=True)
+        np.testing.assert_allclose(seq.header_stats(written_path), seq.array_stats(written))
+        written[:20], written[50:70], written[120:150] = 4., 1., 3.
+        reader.write_big_file(written_path, written, {'chrI': 0}, is_abs_path=True)
+        np.testing.assert_allclose(seq.header_stats(written_path), seq.array_stats(written))
+        # Without uncovered bases and positive values the maximum is not in the header
+        reader.write_big_file(written_path, -1. - written, {'chrI': 0}, is_abs_path=True)
+        np.testing.assert_allclose(seq.header_stats(written_path), seq.array_stats(-1. - written))
+
+        # The variance is derived from the sums in the header, where the offset cancels. With a mean of 1000 and a
+        # standard deviation of 1, about six digits are lost and the standard deviation agrees to 1e-6. Tracks with
+        # a larger offset are computed in a pass over the values
+        noise = np.random.default_rng(1).standard_normal(10000)
+        for offset in (1e3, 1e5):
+            offset_track = (offset + noise).astype('float32')
+            reader.write_big_file(written_path, offset_track, {'chrI': 0, 'chrII': 6000}, is_abs_path=True)
+            np.testing.assert_allclose(seq.header_stats(written_path), seq.array_stats(offset_track), rtol=1e-6)
+
+        data = np.random.default_rng(0).random(100).astype('float32')
+        original = data.copy()
+        remapped = seq.remap_norm(data, chunk_size=16)
+        np.testing.assert_array_equal(data, original)
+        np.testing.assert_array_equal(remapped, (original - original.min()) / (original.max() - original.min()))
+
+        centered = seq.center_norm(data, out=data, chunk_size=16)
+        self.assertIs(centered, data)
+        np.testing.assert_allclose(data, (original - original.mean()) / original.std(), rtol=1e-5, atol=1e-6)
+
+        data_int = np.arange(10)
+        np.testing.assert_allclose(seq.center_norm(data_int, stats=(0, 9, 4.5, 1.)), data_int - 4.5)
+
+    def test_stacked_tracks(self):
+        values, chrom_start = seq.get_values([self.bw_path, self.bw_path])
+        stack_path = os.path.join(self.tmp_dir, 'stack.npy')
+        stack, stack_start = seq.get_values([self.bw_path, self.bw_path], stacked=True, stack_path=stack_path)
+        self.assertIsInstance(stack, np.memmap)
+        self.assertEqual(stack.shape, (2, 160))
+        self.assertDictEqual(stack_start, chrom_start)
+        np.testing.assert_array_equal(np.load(stack_path)[1], values[1])
+
+        rng = np.random.default_rng(0)
+        tracks = rng.random((3, 160)).astype('float32')
+        track_list = list(tracks)
+        np.testing.assert_array_equal(seq.remap_norm_all(tracks), np.asarray(seq.remap_norm_all(track_list)))
+        np.testing.assert_allclose(seq.center_norm_all(tracks), np.asarray(seq.center_norm_all(track_list)), rtol=1e-5)
+        for smooth_list in (5, [5, None, 7]):
+            np.testing.assert_allclose(seq.smooth_all(tracks, smooth_list, chrom_start=chrom_start),
+                                       np.asarray(seq.smooth_all(track_list, smooth_list, chrom_start=chrom_start)))
+        np.testing.assert_array_equal(seq.binning_all(tracks, offset_l=20, offset_r=20),
+                                      seq.binning_all(track_list, offset_l=20, offset_r=20))
+
+        bed = [['chrI', '2', '8', 'gene1', '0', '+'], ['chrII', '0', '4', 'gene2', '0', '-']]
+        seg_list, name_list = seq.annotate_all(tracks, bed, chrom_start, ragged=True)
+        exp_seg, exp_names = seq.annotate_all(track_list, bed, chrom_start, ragged=True)
+        for seg, exp in zip(seg_list, exp_seg):
+            np.testing.assert_array_equal(seg.values, exp.values)
+            np.testing.assert_array_equal(seg.offsets, exp.offsets)
+        self.assertListEqual(name_list, exp_names)
+        anno, _ = seq.annotate_all(tracks, bed, chrom_start)
+        self.assertListEqual(anno[2][1].tolist(), exp_seg[2].values[6:].tolist())
+
 
 if __name__ == '__main__':
     unittest.main()